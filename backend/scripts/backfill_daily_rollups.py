@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Backfill user_daily_rollups (one document per user per day with habit
+completions, mood, tags, craving and relapse flag) from habit_logs,
+emotional_logs and relapses. Safe to re-run: rollups are upserted.
+
+Usage: python scripts/backfill_daily_rollups.py [user_id ...]
+"""
+import asyncio
+import os
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+async def run(user_ids):
+    await server.ensure_indexes()
+    written = await server.backfill_daily_rollups(user_ids or None)
+    print(f"✅ Wrote {written} daily rollups")
+
+
+def main():
+    print(f"Connecting to MongoDB: {server.MONGO_URL}")
+    asyncio.run(run(sys.argv[1:]))
+
+
+if __name__ == "__main__":
+    main()
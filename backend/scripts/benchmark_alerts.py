@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Benchmark the professional alert engine at 100/500/1000 linked patients.
+
+Seeds a scratch database with one professional and N patients (each with
+30 days of habit and emotional logs, a share of them with recent relapses,
+low moods or inactivity), then times and counts the MongoDB round-trips of:
+- scan: scan_patient_alerts(), the rule evaluation over every patient
+  (fixed number of aggregations per batch of 500 patients)
+- read: GET /api/professional/alerts, an indexed read of stored alerts
+Both counts should stay flat as N grows.
+
+Usage: python scripts/benchmark_alerts.py [sizes...]
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+import server
+
+MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+BENCH_DB = 'sinadicciones_alert_benchmark'
+DAYS = 30
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Count read commands sent to the server"""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name in ("find", "getMore", "aggregate"):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def seed(database, patients):
+    for collection in ("users", "user_profiles", "relapses", "emotional_logs", "habit_logs", "alerts"):
+        await database[collection].delete_many({})
+
+    now = datetime.now(timezone.utc)
+    await database.users.insert_many(
+        [{"user_id": "user_pro", "name": "Profesional", "email": "pro@bench.org"}]
+        + [{"user_id": f"user_p{i}", "name": f"Paciente {i}", "email": f"p{i}@bench.org"} for i in range(patients)]
+    )
+    await database.user_profiles.insert_many(
+        [{"user_id": "user_pro", "role": "professional"}]
+        + [{"user_id": f"user_p{i}", "role": "patient", "linked_therapist_id": "user_pro"} for i in range(patients)]
+    )
+
+    relapses, emotional_logs, habit_logs = [], [], []
+    for i in range(patients):
+        patient_id = f"user_p{i}"
+        # Every 4th patient went quiet a week ago
+        last_day = 7 if i % 4 == 0 else 0
+        for d in range(last_day, last_day + DAYS):
+            date = (now - timedelta(days=d)).strftime("%Y-%m-%d")
+            emotional_logs.append({
+                "log_id": f"elog_{i}_{d}",
+                "user_id": patient_id,
+                "date": date,
+                "mood": random.randint(1, 3) if i % 5 == 0 else random.randint(3, 5),
+                "mood_scale": random.randint(1, 10)
+            })
+            habit_logs.append({
+                "log_id": f"log_{i}_{d}",
+                "habit_id": f"habit_{i}",
+                "user_id": patient_id,
+                "date": date,
+                "completed": random.random() < 0.7
+            })
+        if i % 10 == 0:
+            relapses.append({
+                "relapse_id": f"relapse_{i}",
+                "user_id": patient_id,
+                "date": (now - timedelta(days=2)).strftime("%Y-%m-%d"),
+                "substance": "alcohol",
+                "trigger": "estrés",
+                "reported_at": now - timedelta(days=2)
+            })
+
+    await database.emotional_logs.insert_many(emotional_logs)
+    await database.habit_logs.insert_many(habit_logs)
+    if relapses:
+        await database.relapses.insert_many(relapses)
+
+
+async def run(sizes):
+    counter = RoundTripCounter()
+    client = AsyncIOMotorClient(MONGO_URL, event_listeners=[counter])
+    database = client[BENCH_DB]
+    server.db = database
+    professional = server.User(user_id="user_pro", email="pro@bench.org", name="Profesional", created_at=datetime.now(timezone.utc))
+
+    try:
+        await server.ensure_indexes(database)
+        for size in sizes:
+            await seed(database, size)
+
+            counter.count = 0
+            started = time.perf_counter()
+            await server.scan_patient_alerts()
+            scan_ms = (time.perf_counter() - started) * 1000
+            scan_trips = counter.count
+
+            counter.count = 0
+            started = time.perf_counter()
+            response = await server.get_professional_alerts(professional)
+            read_ms = (time.perf_counter() - started) * 1000
+
+            print(f"{size:5d} patients: {len(response['alerts']):5d} alerts  "
+                  f"scan {scan_trips:3d} round-trips {scan_ms:9.1f} ms  "
+                  f"read {counter.count:3d} round-trips {read_ms:7.1f} ms")
+    finally:
+        await client.drop_database(BENCH_DB)
+        client.close()
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 500, 1000]
+    print(f"Connecting to MongoDB: {MONGO_URL}")
+    asyncio.run(run(sizes))
+
+
+if __name__ == "__main__":
+    main()
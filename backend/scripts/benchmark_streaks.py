@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Benchmark the habit streak engine against the old per-day lookup.
+
+Seeds a scratch database with N habits and D days of completed logs, then
+counts the MongoDB round-trips (find/getMore commands) needed to compute
+every habit's streak:
+- legacy: one find_one per habit per streak day (what get_patient_detail did)
+- rebuild: refresh_habit_counters(), one $in query over habit_logs for all habits
+- counters: get_habit_streaks() on habit documents carrying the counters,
+  i.e. what the dashboards do (only the habits query itself)
+
+Usage: python scripts/benchmark_streaks.py [habits] [days]
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+
+import server
+
+MONGO_URL = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
+BENCH_DB = 'sinadicciones_streak_benchmark'
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Count read commands sent to the server"""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name in ("find", "getMore", "aggregate"):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def legacy_streaks(database, habit_ids, today):
+    """The per-day algorithm the endpoints used before the streak engine"""
+    streaks = {}
+    for habit_id in habit_ids:
+        streak = 0
+        check_date = datetime.strptime(today, "%Y-%m-%d")
+        for _ in range(365):
+            day_log = await database.habit_logs.find_one({
+                "habit_id": habit_id,
+                "date": check_date.strftime("%Y-%m-%d"),
+                "completed": True
+            })
+            if not day_log:
+                break
+            streak += 1
+            check_date -= timedelta(days=1)
+        streaks[habit_id] = streak
+    return streaks
+
+
+async def seed(database, habits, days, today):
+    await database.habit_logs.delete_many({})
+    await database.habits.delete_many({})
+    habit_ids = [f"habit_bench_{i}" for i in range(habits)]
+    await database.habits.insert_many([
+        {"habit_id": habit_id, "user_id": "user_bench", "name": habit_id, "is_active": True}
+        for habit_id in habit_ids
+    ])
+    start = datetime.strptime(today, "%Y-%m-%d")
+    logs = [
+        {
+            "log_id": f"log_{habit_id}_{d}",
+            "habit_id": habit_id,
+            "user_id": "user_bench",
+            "date": (start - timedelta(days=d)).strftime("%Y-%m-%d"),
+            "completed": True,
+            "logged_at": datetime.now(timezone.utc)
+        }
+        for habit_id in habit_ids
+        for d in range(days)
+    ]
+    if logs:
+        await database.habit_logs.insert_many(logs)
+    return habit_ids
+
+
+async def run(habits, days):
+    counter = RoundTripCounter()
+    client = AsyncIOMotorClient(MONGO_URL, event_listeners=[counter])
+    database = client[BENCH_DB]
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    try:
+        await server.ensure_indexes(database)
+        habit_ids = await seed(database, habits, days, today)
+        print(f"Seeded {habits} habits x {days} days of completed logs")
+
+        counter.count = 0
+        started = time.perf_counter()
+        legacy = await legacy_streaks(database, habit_ids, today)
+        legacy_ms = (time.perf_counter() - started) * 1000
+        legacy_trips = counter.count
+
+        server.db = database
+        counter.count = 0
+        started = time.perf_counter()
+        await server.refresh_habit_counters(habit_ids)
+        rebuild_ms = (time.perf_counter() - started) * 1000
+        rebuild_trips = counter.count
+
+        counter.count = 0
+        started = time.perf_counter()
+        habit_docs = await database.habits.find({"user_id": "user_bench"}, {"_id": 0}).to_list(None)
+        engine = await server.get_habit_streaks(habit_docs, today)
+        engine_ms = (time.perf_counter() - started) * 1000
+        engine_trips = counter.count
+
+        mismatches = [h for h in habit_ids if legacy[h] != engine[h]["current_streak"]]
+        print(f"legacy: {legacy_trips:6d} round-trips  {legacy_ms:9.1f} ms")
+        print(f"rebuild: {rebuild_trips:5d} round-trips  {rebuild_ms:9.1f} ms")
+        print(f"counters: {engine_trips:4d} round-trips  {engine_ms:9.1f} ms")
+        print("✅ streaks match" if not mismatches else f"❌ {len(mismatches)} habits differ: {mismatches[:5]}")
+    finally:
+        await client.drop_database(BENCH_DB)
+        client.close()
+
+
+def main():
+    habits = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    print(f"Connecting to MongoDB: {MONGO_URL}")
+    asyncio.run(run(habits, days))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Rebuild the activity counters stored on every user profile
+(activity_counts.emotional_logs, activity_counts.habits) from emotional_logs
+and habits. Use it to backfill existing profiles or repair drift.
+"""
+import asyncio
+import os
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+async def run():
+    rebuilt = await server.rebuild_activity_counters()
+    print(f"✅ Rebuilt activity counters for {rebuilt} profiles")
+
+
+def main():
+    print(f"Connecting to MongoDB: {server.MONGO_URL}")
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Rebuild the streak counters stored on every habit document
+(current_streak, longest_streak, last_completed_date, total_completions)
+from habit_logs. Use it to backfill existing habits or repair drift.
+"""
+import asyncio
+import os
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+async def run():
+    rebuilt = await server.rebuild_habit_counters()
+    print(f"✅ Rebuilt counters for {rebuilt} habits")
+
+
+def main():
+    print(f"Connecting to MongoDB: {server.MONGO_URL}")
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
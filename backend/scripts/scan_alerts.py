@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Run the professional alert scan once: evaluates relapse, inactivity and
+negative-emotion rules for every linked patient and upserts the results
+into the alerts collection, then rebuilds the per-professional alert
+counters from the stored alerts. The server runs the same scan nightly;
+use this to backfill alerts after deploying, to catch up after downtime
+or to repair counter drift.
+"""
+import asyncio
+import os
+import sys
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+async def run():
+    await server.ensure_indexes()
+    stats = await server.scan_patient_alerts()
+    print(f"✅ Scanned {stats['last_patients']} patients, {stats['last_alerts']} new alerts in {stats['last_duration_ms']} ms")
+    professionals = await server.rebuild_alert_counters()
+    print(f"✅ Rebuilt alert counters for {professionals} professionals")
+
+
+def main():
+    print(f"Connecting to MongoDB: {server.MONGO_URL}")
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Send the scheduled reminders for one hour, split across worker processes.
+
+Every process streams the users once and handles only the ones whose
+user_id hashes to its shard; reminders are claimed per user per day, so
+rerunning a shard (or the whole run) never reminds anyone twice.
+
+Workers are spawned, not forked, and every run opens its own MongoDB client:
+Motor clients are bound to the event loop of their first operation and
+can't be shared across processes.
+
+Usage: python scripts/send_reminders.py [hour] [shards]
+       (defaults: current UTC hour, 1 shard)
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+from motor.motor_asyncio import AsyncIOMotorClient
+
+# Add parent directory to path
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+
+def connect():
+    """Point server.db at a new client owned by the running event loop"""
+    client = AsyncIOMotorClient(server.MONGO_URL, serverSelectionTimeoutMS=5000)
+    server.client, server.db = client, client[server.db.name]
+    return client
+
+
+async def prepare():
+    client = connect()
+    try:
+        await server.ensure_indexes()
+    finally:
+        client.close()
+
+
+async def run(hour, shard, shards):
+    client = connect()
+    try:
+        result = await server.run_reminders(hour, shard, shards)
+        # Reminders are only queued; deliver them before the process exits
+        await server.push_outbox.drain()
+        return result
+    finally:
+        await server.outbound_http.close()
+        client.close()
+
+
+def run_shard(hour, shard, shards):
+    return asyncio.run(run(hour, shard, shards))
+
+
+def main():
+    hour = int(sys.argv[1]) if len(sys.argv) > 1 else datetime.now(timezone.utc).hour
+    shards = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    print(f"Connecting to MongoDB: {server.MONGO_URL}")
+    asyncio.run(prepare())
+
+    with ProcessPoolExecutor(max_workers=shards, mp_context=multiprocessing.get_context("spawn")) as pool:
+        results = pool.map(run_shard, [hour] * shards, range(shards), [shards] * shards)
+        for result in results:
+            print(f"✅ Shard {result['shard']}/{result['shards']}: {result['users_processed']} users, "
+                  f"{result['sent_count']} notifications, {result['skipped']} already reminded"
+                  + (f", {len(result['errors'])} failed chunks" if result["errors"] else ""))
+
+
+if __name__ == "__main__":
+    main()
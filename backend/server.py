@@ -1,8 +1,9 @@
 from fastapi import FastAPI, HTTPException, Depends, Response, Request, status
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne
 from datetime import datetime, timezone, timedelta
 from typing import Optional, List
 from enum import Enum
@@ -11,11 +12,38 @@ import httpx
 import uuid
 import json
 import asyncio
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: make sure every collection has the indexes the endpoints rely on
+    await ensure_indexes()
+    session_maintenance_task = asyncio.create_task(session_maintenance_loop())
+    alert_scan_task = asyncio.create_task(alert_scan_loop())
+    admin_stats_task = asyncio.create_task(admin_stats_loop())
+    outbound_http.start({urlsplit(url).hostname for url in (EMERGENT_AUTH_URL, EXPO_PUSH_URL, EXPO_RECEIPTS_URL)})
+    push_receipt_task = asyncio.create_task(push_receipt_loop())
+    push_outbox.start()
+    reminder_task = asyncio.create_task(reminder_loop()) if REMINDER_SCHEDULER_ENABLED else None
+    yield
+    # Shutdown
+    session_maintenance_task.cancel()
+    alert_scan_task.cancel()
+    admin_stats_task.cancel()
+    push_receipt_task.cancel()
+    if reminder_task:
+        reminder_task.cancel()
+    await push_outbox.stop()
+    await outbound_http.close()
+    try:
+        await flush_session_renewals()
+    except Exception as e:
+        print(f"Could not flush session renewals on shutdown: {e}")
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS Configuration - Allow all origins for production
 app.add_middleware(
@@ -24,6 +52,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
 # MongoDB Connection
@@ -39,6 +68,207 @@ db = client.sinadicciones
 # Emergent Auth URL
 EMERGENT_AUTH_URL = "https://demobackend.emergentagent.com/auth/v1/env/oauth/session-data"
 
+# ============== DATABASE INDEXES ==============
+
+# Indexes required by the queries in this file, declared per collection.
+# Each entry: (name, keys, options). Names are stable so reconciliation can
+# detect drift between what is declared here and what exists in MongoDB.
+INDEX_SPECS = {
+    "users": [
+        ("user_id_unique", [("user_id", 1)], {"unique": True}),
+        ("email_1", [("email", 1)], {}),
+    ],
+    "user_sessions": [
+        ("session_token_unique", [("session_token", 1)], {"unique": True}),
+        ("user_id_1", [("user_id", 1)], {}),
+        # TTL: MongoDB removes the session as soon as expires_at is in the past
+        ("expires_at_ttl", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "user_profiles": [
+        ("user_id_unique", [("user_id", 1)], {"unique": True}),
+        ("linked_therapist_id_1", [("linked_therapist_id", 1)], {}),
+        ("role_1", [("role", 1)], {}),
+    ],
+    "habits": [
+        ("habit_id_1", [("habit_id", 1)], {}),
+        ("user_id_is_active_created_at", [("user_id", 1), ("is_active", 1), ("created_at", -1)], {}),
+    ],
+    "habit_logs": [
+        ("habit_id_date_completed", [("habit_id", 1), ("date", -1), ("completed", 1)], {}),
+        ("user_id_date", [("user_id", 1), ("date", -1)], {}),
+        ("logged_at_1", [("logged_at", 1)], {}),
+    ],
+    "emotional_logs": [
+        ("user_id_date", [("user_id", 1), ("date", -1)], {}),
+        ("user_id_created_at", [("user_id", 1), ("created_at", -1)], {}),
+        ("logged_at_1", [("logged_at", 1)], {}),
+    ],
+    "relapses": [
+        ("user_id_reported_at", [("user_id", 1), ("reported_at", -1)], {}),
+    ],
+    "notifications": [
+        ("user_id_read_created_at", [("user_id", 1), ("read", 1), ("created_at", -1)], {}),
+        ("user_id_created_at", [("user_id", 1), ("created_at", -1)], {}),
+        ("notification_id_1", [("notification_id", 1)], {}),
+    ],
+    "messages": [
+        ("from_to_created_at", [("from_user_id", 1), ("to_user_id", 1), ("created_at", 1)], {}),
+        ("to_user_id_read", [("to_user_id", 1), ("read", 1)], {}),
+    ],
+    "push_tokens": [
+        ("user_id_1", [("user_id", 1)], {}),
+        ("push_token_1", [("push_token", 1)], {}),
+    ],
+    "push_outbox": [
+        ("status_available_at", [("status", 1), ("available_at", 1)], {}),
+        ("status_locked_until", [("status", 1), ("locked_until", 1)], {}),
+        ("job_id_1", [("job_id", 1)], {}),
+        ("claim_id_1", [("claim_id", 1)], {}),
+        ("expires_at_ttl", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "nelson_contexts": [
+        ("user_id_1", [("user_id", 1)], {"unique": True}),
+    ],
+    "llm_cache": [
+        ("key_1", [("key", 1)], {"unique": True}),
+        ("expires_at_ttl", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "reminder_runs": [
+        ("user_id_date", [("user_id", 1), ("date", 1)], {"unique": True}),
+        ("expires_at_ttl", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ],
+    "push_receipts": [
+        ("created_at_1", [("created_at", 1)], {}),
+        ("receipt_id_1", [("receipt_id", 1)], {}),
+    ],
+    "notification_settings": [
+        ("user_id_1", [("user_id", 1)], {}),
+        ("preferred_time_1", [("preferred_time", 1)], {}),
+    ],
+    "therapist_tasks": [
+        ("patient_id_therapist_id", [("patient_id", 1), ("therapist_id", 1)], {}),
+        ("task_id_1", [("task_id", 1)], {}),
+    ],
+    "session_notes": [
+        ("patient_id_therapist_id", [("patient_id", 1), ("therapist_id", 1)], {}),
+    ],
+    "purpose_tests": [
+        ("user_id_completed_at", [("user_id", 1), ("completed_at", -1)], {}),
+    ],
+    "purpose_goals": [
+        ("user_id_status_created_at", [("user_id", 1), ("status", 1), ("created_at", -1)], {}),
+        ("goal_id_1", [("goal_id", 1)], {}),
+    ],
+    "purpose_analyses": [
+        ("user_id_1", [("user_id", 1)], {}),
+    ],
+    "weekly_checkins": [
+        ("user_id_week_start", [("user_id", 1), ("week_start", -1)], {}),
+    ],
+    "challenges": [
+        ("user_id_status", [("user_id", 1), ("status", 1)], {}),
+    ],
+    "family_link_requests": [
+        ("patient_user_id_status", [("patient_user_id", 1), ("status", 1)], {}),
+    ],
+    "nelson_conversations": [
+        ("user_id_1", [("user_id", 1)], {}),
+    ],
+    "alerts": [
+        ("alert_id_unique", [("alert_id", 1)], {"unique": True}),
+        ("professional_resolved_severity_newest", [("professional_id", 1), ("is_resolved", 1), ("severity_rank", 1), ("created_at", -1)], {}),
+        ("patient_resolved_type", [("patient_id", 1), ("is_resolved", 1), ("alert_type", 1)], {}),
+        ("resolved_expires", [("is_resolved", 1), ("expires_at", 1)], {}),
+    ],
+    "alert_counters": [
+        ("professional_id_unique", [("professional_id", 1)], {"unique": True}),
+    ],
+    "user_daily_rollups": [
+        ("user_id_date_unique", [("user_id", 1), ("date", 1)], {"unique": True}),
+    ],
+}
+
+# Options that make two indexes with the same keys behave differently
+INDEX_COMPARED_OPTIONS = ("unique", "expireAfterSeconds", "partialFilterExpression", "sparse")
+
+# Result of the last reconciliation, exposed to admins
+index_report = {"checked_at": None, "created": [], "drift": [], "unmanaged": [], "errors": []}
+
+async def ensure_indexes(database=None, fix_drift: bool = False) -> dict:
+    """Create missing indexes and report drift against INDEX_SPECS.
+
+    Safe to run on every startup: existing matching indexes are left untouched.
+    Indexes whose keys/options differ from the declaration are only rebuilt
+    when fix_drift is True (or INDEX_FIX_DRIFT=1), otherwise they are reported.
+    """
+    database = database if database is not None else db
+    fix_drift = fix_drift or os.getenv("INDEX_FIX_DRIFT") == "1"
+    report = {"checked_at": datetime.now(timezone.utc).isoformat(), "created": [], "drift": [], "unmanaged": [], "errors": []}
+    
+    try:
+        await database.command("ping")
+    except Exception as e:
+        # Don't block startup if MongoDB is unreachable; the next restart will retry
+        print(f"Index check skipped, MongoDB unreachable: {e}")
+        report["errors"].append({"error": str(e)})
+        return report
+    
+    for collection_name, specs in INDEX_SPECS.items():
+        collection = database[collection_name]
+        try:
+            existing = {}
+            async for index in collection.list_indexes():
+                existing[index["name"]] = index
+        except Exception as e:
+            report["errors"].append({"collection": collection_name, "error": str(e)})
+            continue
+        
+        declared_names = set()
+        for name, keys, options in specs:
+            declared_names.add(name)
+            current = existing.get(name)
+            
+            if current is not None:
+                same_keys = list(current["key"].items()) == keys
+                same_options = all(current.get(opt) == options.get(opt) for opt in INDEX_COMPARED_OPTIONS)
+                if same_keys and same_options:
+                    continue
+                report["drift"].append({
+                    "collection": collection_name,
+                    "index": name,
+                    "expected": {"key": keys, **options},
+                    "actual": {"key": list(current["key"].items()), **{opt: current[opt] for opt in INDEX_COMPARED_OPTIONS if opt in current}}
+                })
+                if not fix_drift:
+                    continue
+                try:
+                    await collection.drop_index(name)
+                except Exception as e:
+                    report["errors"].append({"collection": collection_name, "index": name, "error": str(e)})
+                    continue
+            
+            try:
+                await collection.create_index(keys, name=name, **options)
+                report["created"].append(f"{collection_name}.{name}")
+            except Exception as e:
+                # e.g. duplicate keys for a unique index, or same keys under another name
+                report["errors"].append({"collection": collection_name, "index": name, "error": str(e)})
+        
+        for name in existing:
+            if name != "_id_" and name not in declared_names:
+                report["unmanaged"].append(f"{collection_name}.{name}")
+    
+    if database is db:
+        index_report.update(report)
+    
+    print(f"Index check: {len(report['created'])} created, {len(report['drift'])} drifted, {len(report['errors'])} errors")
+    for drift in report["drift"]:
+        print(f"Index drift on {drift['collection']}.{drift['index']}: expected {drift['expected']}, found {drift['actual']}")
+    for error in report["errors"]:
+        print(f"Index error: {error}")
+    
+    return report
+
 # ============== MODELS ==============
 
 class User(BaseModel):
@@ -200,8 +430,115 @@ class UpdateNotificationSettingsRequest(BaseModel):
 
 # ============== AUTH HELPERS ==============
 
-async def get_current_user(request: Request) -> Optional[User]:
-    # Try to get token from cookie first, then from Authorization header
+from collections import OrderedDict
+import time
+
+# Authenticated users are cached per session token so most requests skip the
+# user_sessions + users round-trips. The cache is per process: a logout handled
+# by another worker is only seen here once the entry's TTL runs out.
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "60"))  # seconds
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_CACHE_SINGLE_FLIGHT = os.getenv("SESSION_CACHE_SINGLE_FLIGHT", "1") == "1"
+
+class SessionCache:
+    """Bounded LRU cache of session_token -> User with a per-entry TTL"""
+    
+    def __init__(self, max_size: int, ttl: int, single_flight: bool = True):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.single_flight = single_flight
+        self._entries = OrderedDict()  # token -> (User, monotonic deadline)
+        self._inflight = {}  # token -> Task loading that token
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, token: str) -> Optional[User]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        user, deadline = entry
+        if deadline <= time.monotonic():
+            del self._entries[token]
+            return None
+        self._entries.move_to_end(token)
+        return user
+    
+    def set(self, token: str, user: User, session_expires_at: Optional[datetime] = None):
+        ttl = self.ttl
+        if session_expires_at is not None:
+            # Never serve a session from cache past its own expiry
+            ttl = min(ttl, (session_expires_at - datetime.now(timezone.utc)).total_seconds())
+        if ttl <= 0:
+            return
+        self._entries[token] = (user, time.monotonic() + ttl)
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def invalidate(self, token: str):
+        if self._entries.pop(token, None) is not None:
+            self.invalidations += 1
+    
+    def invalidate_user(self, user_id: str):
+        tokens = [token for token, (user, _) in self._entries.items() if user.user_id == user_id]
+        for token in tokens:
+            self.invalidate(token)
+    
+    async def get_or_load(self, token: str, loader) -> User:
+        """Return the cached user for token, or load it with loader(token).
+        
+        loader must return (User, session_expires_at). With single-flight
+        enabled, concurrent misses for the same token share one load.
+        """
+        user = self.get(token)
+        if user is not None:
+            self.hits += 1
+            return user
+        
+        if not self.single_flight:
+            self.misses += 1
+            user, expires_at = await loader(token)
+            self.set(token, user, expires_at)
+            return user
+        
+        pending = self._inflight.get(token)
+        if pending is not None:
+            self.coalesced += 1
+            user, _ = await asyncio.shield(pending)
+            return user
+        
+        self.misses += 1
+        task = asyncio.ensure_future(loader(token))
+        self._inflight[token] = task
+        try:
+            user, expires_at = await asyncio.shield(task)
+        finally:
+            self._inflight.pop(token, None)
+        self.set(token, user, expires_at)
+        return user
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0
+        }
+
+session_cache = SessionCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL, SESSION_CACHE_SINGLE_FLIGHT)
+
+def get_request_session_token(request: Request) -> Optional[str]:
+    """Session token from the cookie, or from the Authorization header (mobile)"""
     session_token = request.cookies.get("session_token")
     
     if not session_token:
@@ -209,14 +546,29 @@ async def get_current_user(request: Request) -> Optional[User]:
         if auth_header and auth_header.startswith("Bearer "):
             session_token = auth_header.replace("Bearer ", "")
     
-    if not session_token:
-        raise HTTPException(status_code=401, detail="Not authenticated")
+    return session_token
+
+async def load_session_user(session_token: str):
+    """Resolve a session token to (User, expires_at) from the database.
     
-    # Find session in database
-    session = await db.user_sessions.find_one(
-        {"session_token": session_token},
-        {"_id": 0}
-    )
+    Session and user are fetched in a single round-trip with a $lookup
+    (served by the user_sessions.session_token and users.user_id indexes).
+    """
+    pipeline = [
+        {"$match": {"session_token": session_token}},
+        {"$limit": 1},
+        {"$lookup": {
+            "from": "users",
+            "localField": "user_id",
+            "foreignField": "user_id",
+            "as": "user"
+        }},
+        {"$unwind": {"path": "$user", "preserveNullAndEmptyArrays": True}},
+        {"$project": {"_id": 0, "expires_at": 1, "user": 1}},
+        {"$project": {"user._id": 0, "user.password_hash": 0}}
+    ]
+    results = await db.user_sessions.aggregate(pipeline).to_list(1)
+    session = results[0] if results else None
     
     if not session:
         raise HTTPException(status_code=401, detail="Invalid session")
@@ -226,20 +578,457 @@ async def get_current_user(request: Request) -> Optional[User]:
     if expires_at.tzinfo is None:
         expires_at = expires_at.replace(tzinfo=timezone.utc)
     
-    if expires_at < datetime.now(timezone.utc):
-        await db.user_sessions.delete_one({"session_token": session_token})
+    # Expired sessions are removed by the TTL index and the session sweeper,
+    # never from the request path
+    now = datetime.now(timezone.utc)
+    if expires_at < now:
         raise HTTPException(status_code=401, detail="Session expired")
     
-    # Get user from database
-    user_doc = await db.users.find_one(
-        {"user_id": session["user_id"]},
-        {"_id": 0}
-    )
-    
+    user_doc = session.get("user")
     if not user_doc:
         raise HTTPException(status_code=401, detail="User not found")
     
-    return User(**user_doc)
+    # Sliding sessions: queue active sessions close to expiry for a batched renewal
+    if expires_at - now < SESSION_RENEW_BEFORE:
+        pending_session_renewals.add(session_token)
+    
+    return User(**user_doc), expires_at
+
+# ============== SESSION MAINTENANCE ==============
+
+SESSION_DURATION = timedelta(days=7)
+SESSION_RENEW_BEFORE = timedelta(days=3)  # renew sessions with less than this left
+SESSION_SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", "300"))  # seconds
+
+# Tokens seen in use that should get a fresh expires_at on the next flush
+pending_session_renewals = set()
+
+session_maintenance_stats = {
+    "runs": 0,
+    "expired_deleted": 0,
+    "sessions_renewed": 0,
+    "errors": 0,
+    "last_run_at": None,
+    "last_error": None
+}
+
+async def flush_session_renewals() -> int:
+    """Extend every queued session with a single update_many"""
+    if not pending_session_renewals:
+        return 0
+    tokens = list(pending_session_renewals)
+    pending_session_renewals.clear()
+    result = await db.user_sessions.update_many(
+        {"session_token": {"$in": tokens}},
+        {"$set": {"expires_at": datetime.now(timezone.utc) + SESSION_DURATION}}
+    )
+    session_maintenance_stats["sessions_renewed"] += result.modified_count
+    return result.modified_count
+
+async def sweep_expired_sessions() -> int:
+    """Delete expired sessions.
+    
+    The TTL index on expires_at does this on its own about once a minute; the
+    sweep also covers sessions created before the index existed.
+    """
+    result = await db.user_sessions.delete_many({"expires_at": {"$lt": datetime.now(timezone.utc)}})
+    session_maintenance_stats["expired_deleted"] += result.deleted_count
+    return result.deleted_count
+
+async def session_maintenance_loop():
+    """Background task: batch session renewals and sweep expired sessions"""
+    while True:
+        try:
+            await flush_session_renewals()
+            await sweep_expired_sessions()
+            session_maintenance_stats["runs"] += 1
+        except Exception as e:
+            session_maintenance_stats["errors"] += 1
+            session_maintenance_stats["last_error"] = str(e)
+            print(f"Session maintenance error: {e}")
+        session_maintenance_stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+
+async def get_current_user(request: Request) -> Optional[User]:
+    # Try to get token from cookie first, then from Authorization header
+    session_token = get_request_session_token(request)
+    
+    if not session_token:
+        raise HTTPException(status_code=401, detail="Not authenticated")
+    
+    return await session_cache.get_or_load(session_token, load_session_user)
+
+# ============== BATCH LOADERS ==============
+
+class BatchLoader:
+    """DataLoader-style batching of lookups by key within one request.
+    
+    load() calls made in the same event loop turn are collected and resolved
+    with a single {key_field: {"$in": keys}} query; results are memoized for
+    the lifetime of the loader, so repeated keys cost nothing.
+    """
+    
+    def __init__(self, collection, key_field: str = "user_id", projection: Optional[dict] = None):
+        self.collection = collection
+        self.key_field = key_field
+        self.projection = dict(projection or {"_id": 0})
+        if any(value for key, value in self.projection.items() if key != "_id"):
+            # Inclusion projection: the key is needed to match documents back
+            self.projection[key_field] = 1
+        self.queries = 0
+        self._results = {}
+        self._queue = []
+        self._dispatches = set()
+    
+    def load(self, key) -> asyncio.Future:
+        """Future resolving to the document for key (None if missing)"""
+        if key in self._results:
+            return self._results[key]
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._results[key] = future
+        if key is None:
+            future.set_result(None)
+            return future
+        
+        self._queue.append(key)
+        if len(self._queue) == 1:
+            loop.call_soon(self._schedule_dispatch)
+        return future
+    
+    async def load_many(self, keys) -> dict:
+        """Documents for many keys at once: key -> document (or None)"""
+        keys = list(dict.fromkeys(keys))
+        documents = await asyncio.gather(*(self.load(key) for key in keys))
+        return dict(zip(keys, documents))
+    
+    def _schedule_dispatch(self):
+        # Keep a reference until the batch query finishes so the task is not
+        # garbage-collected mid-flight
+        task = asyncio.ensure_future(self._dispatch())
+        self._dispatches.add(task)
+        task.add_done_callback(self._dispatches.discard)
+    
+    async def _dispatch(self):
+        keys, self._queue = self._queue, []
+        self.queries += 1
+        try:
+            documents = await self.collection.find(
+                {self.key_field: {"$in": keys}},
+                self.projection
+            ).to_list(None)
+        except Exception as e:
+            for key in keys:
+                future = self._results.pop(key)
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        by_key = {document.get(self.key_field): document for document in documents}
+        for key in keys:
+            future = self._results[key]
+            if not future.done():
+                future.set_result(by_key.get(key))
+
+class RequestLoaders:
+    """The batch loaders of one request (use through Depends(get_loaders))"""
+    
+    def __init__(self, database=None):
+        database = database if database is not None else db
+        self.database = database
+        self.users = BatchLoader(database.users)
+        self.profiles = BatchLoader(database.user_profiles)
+        self.count_queries = 0
+    
+    async def count_by_user(self, collection: str, user_ids: list, query: Optional[dict] = None) -> dict:
+        """Document counts per user for many users with one $group aggregation"""
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return {}
+        self.count_queries += 1
+        counts = await self.database[collection].aggregate([
+            {"$match": {**(query or {}), "user_id": {"$in": user_ids}}},
+            {"$group": {"_id": "$user_id", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        by_user = {user_id: 0 for user_id in user_ids}
+        by_user.update({row["_id"]: row["count"] for row in counts})
+        return by_user
+    
+    @property
+    def queries(self) -> int:
+        return self.users.queries + self.profiles.queries + self.count_queries
+
+def get_loaders() -> RequestLoaders:
+    """FastAPI dependency: fresh loaders (and memo) per request"""
+    return RequestLoaders()
+
+# ============== CONCURRENT FAN-OUT ==============
+
+FANOUT_BRANCH_TIMEOUT = float(os.getenv("FANOUT_BRANCH_TIMEOUT", "5"))  # seconds
+
+fanout_stats = {
+    "fanouts": 0,
+    "branches": 0,
+    "timeouts": 0,
+    "errors": 0,
+    "last_error": None
+}
+
+class FanOutResult(dict):
+    """Results of fan_out(); fallbacks holds the branches replaced by their default"""
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fallbacks = set()
+
+async def fan_out(
+    branches: dict,
+    defaults: Optional[dict] = None,
+    required: tuple = (),
+    timeout: Optional[float] = None
+) -> FanOutResult:
+    """Await independent queries concurrently: {name: awaitable} -> {name: result}.
+
+    The whole fan-out takes as long as its slowest branch instead of the sum of
+    all of them. Every branch gets its own timeout; a branch that times out or
+    fails is logged and replaced by its entry in defaults (None if absent) so
+    the other branches still return, and its name is added to the result's
+    fallbacks. Failures of branches listed in required are re-raised once
+    every branch has finished.
+    """
+    timeout = FANOUT_BRANCH_TIMEOUT if timeout is None else timeout
+    defaults = defaults or {}
+    names = list(branches)
+    fanout_stats["fanouts"] += 1
+    fanout_stats["branches"] += len(names)
+
+    results = await asyncio.gather(
+        *(asyncio.wait_for(branches[name], timeout) for name in names),
+        return_exceptions=True
+    )
+
+    values = FanOutResult()
+    for name, result in zip(names, results):
+        if not isinstance(result, BaseException):
+            values[name] = result
+            continue
+        if isinstance(result, asyncio.TimeoutError):
+            fanout_stats["timeouts"] += 1
+            print(f"Fan-out branch '{name}' timed out after {timeout}s")
+        else:
+            fanout_stats["errors"] += 1
+            fanout_stats["last_error"] = f"{name}: {result}"
+            print(f"Fan-out branch '{name}' failed: {result}")
+        if name in required:
+            raise result
+        values[name] = defaults.get(name)
+        values.fallbacks.add(name)
+    return values
+
+# ============== PAGINATION ==============
+
+import base64
+from bson import ObjectId
+
+# Upper bound for any ?limit= on paginated list endpoints
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "500"))
+
+def _cursor_dump(value):
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    return value
+
+def _cursor_load(value):
+    if isinstance(value, dict):
+        if "$date" in value:
+            return datetime.fromisoformat(value["$date"])
+        if "$oid" in value:
+            return ObjectId(value["$oid"])
+    return value
+
+def encode_cursor(sort_value, document_id) -> str:
+    """Opaque cursor pointing just after the document with (sort_value, _id)"""
+    raw = json.dumps([_cursor_dump(sort_value), _cursor_dump(document_id)], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str) -> tuple:
+    """(sort_value, _id) from a cursor made by encode_cursor; 400 if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, document_id = json.loads(raw)
+        return _cursor_load(sort_value), _cursor_load(document_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor inválido")
+
+def keyset_filter(cursor: str, sort_field: Optional[str] = None, descending: bool = True) -> dict:
+    """Filter matching the documents that sort after the cursor's key"""
+    sort_value, last_id = decode_cursor(cursor)
+    after = "$lt" if descending else "$gt"
+    if not sort_field:
+        return {"_id": {after: last_id}}
+    return {"$or": [
+        {sort_field: {after: sort_value}},
+        {sort_field: sort_value, "_id": {after: last_id}}
+    ]}
+
+async def paginate(
+    collection,
+    query: dict,
+    sort_field: Optional[str] = None,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    projection: Optional[dict] = None,
+    descending: bool = True
+) -> tuple:
+    """One keyset page of collection: (documents, next_cursor).
+    
+    Documents are ordered by (sort_field, _id), _id breaking ties so the order
+    is total and stable while documents are inserted. Instead of skipping,
+    the next page starts strictly after the last returned key. next_cursor is
+    None on the last page; _id is stripped from the returned documents.
+    """
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
+    direction = -1 if descending else 1
+    
+    if cursor:
+        query = {"$and": [query, keyset_filter(cursor, sort_field, descending)]}
+    
+    # The key fields are needed to build the next cursor
+    projection = {key: value for key, value in (projection or {}).items() if key != "_id"}
+    if sort_field and any(projection.values()):
+        projection[sort_field] = 1
+    
+    sort = ([(sort_field, direction)] if sort_field else []) + [("_id", direction)]
+    documents = await collection.find(query, projection or None).sort(sort).limit(limit + 1).to_list(limit + 1)
+    
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        last = documents[-1]
+        next_cursor = encode_cursor(last.get(sort_field) if sort_field else None, last["_id"])
+    for document in documents:
+        document.pop("_id", None)
+    return documents, next_cursor
+
+def set_next_cursor(response: Response, next_cursor: Optional[str]):
+    """Expose the next page of a bare-list endpoint in the X-Next-Cursor header"""
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+
+# ============== OUTBOUND HTTP ==============
+# One pooled client per remote host for the whole process, so outbound calls
+# reuse connections instead of paying DNS + TCP + TLS setup every time.
+
+import importlib.util
+from urllib.parse import urlsplit
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None  # httpx[http2]
+OUTBOUND_DEFAULT_PROFILE = {
+    "timeout": httpx.Timeout(10.0, connect=5.0),
+    "max_connections": 10,
+    "follow_redirects": False,
+}
+# Per-host overrides: Expo gets more connections for push batches, LLM
+# completions are slow, the centers site is slow and redirects
+OUTBOUND_HOST_PROFILES = {
+    "exp.host": {"timeout": httpx.Timeout(15.0, connect=5.0), "max_connections": 20},
+    "api.openai.com": {"timeout": httpx.Timeout(90.0, connect=5.0), "max_connections": 20},
+    "sinadicciones.org": {"timeout": httpx.Timeout(30.0, connect=10.0), "max_connections": 4, "follow_redirects": True},
+}
+OUTBOUND_KEEPALIVE_EXPIRY = 60.0  # seconds
+
+class OutboundHTTP:
+    """Process-wide outbound HTTP layer: pooled clients per host plus metrics.
+    
+    Clients are opened by start() in the lifespan (or lazily, for scripts)
+    and closed on shutdown. Every request records latency and errors per
+    host; see stats().
+    """
+    
+    def __init__(self, profiles: dict = None, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.profiles = OUTBOUND_HOST_PROFILES if profiles is None else profiles
+        self.transport = transport  # tests route every host to a local app
+        self._clients = {}
+        self._metrics = {}
+    
+    def _open(self, host: str) -> httpx.AsyncClient:
+        profile = {**OUTBOUND_DEFAULT_PROFILE, **self.profiles.get(host, {})}
+        return httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE and self.transport is None,
+            timeout=profile["timeout"],
+            follow_redirects=profile["follow_redirects"],
+            limits=httpx.Limits(
+                max_connections=profile["max_connections"],
+                max_keepalive_connections=profile["max_connections"],
+                keepalive_expiry=OUTBOUND_KEEPALIVE_EXPIRY
+            ),
+            transport=self.transport
+        )
+    
+    def client_for(self, host: str) -> httpx.AsyncClient:
+        client = self._clients.get(host)
+        if client is None or client.is_closed:
+            client = self._clients[host] = self._open(host)
+        return client
+    
+    def start(self, hosts=()):
+        """Open the pools of the hosts we know we'll call"""
+        for host in {*self.profiles, *hosts}:
+            self.client_for(host)
+    
+    async def close(self):
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+    
+    def _record(self, host: str, elapsed_ms: float, status_code: Optional[int] = None, error: Optional[str] = None):
+        metrics = self._metrics.setdefault(host, {
+            "requests": 0, "errors": 0, "status_5xx": 0, "total_ms": 0.0, "max_ms": 0.0, "last_error": None
+        })
+        metrics["requests"] += 1
+        metrics["total_ms"] += elapsed_ms
+        metrics["max_ms"] = max(metrics["max_ms"], elapsed_ms)
+        if status_code is not None and status_code >= 500:
+            metrics["status_5xx"] += 1
+        if error:
+            metrics["errors"] += 1
+            metrics["last_error"] = error
+    
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        host = urlsplit(url).hostname or ""
+        started = time.monotonic()
+        try:
+            response = await self.client_for(host).request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self._record(host, (time.monotonic() - started) * 1000, error=f"{type(e).__name__}: {e}")
+            raise
+        self._record(host, (time.monotonic() - started) * 1000, status_code=response.status_code)
+        return response
+    
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+    
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+    
+    def stats(self) -> dict:
+        return {
+            "http2": HTTP2_AVAILABLE,
+            "open_pools": sorted(host for host, client in self._clients.items() if not client.is_closed),
+            "hosts": {
+                host: {
+                    **metrics,
+                    "total_ms": round(metrics["total_ms"], 1),
+                    "max_ms": round(metrics["max_ms"], 1),
+                    "avg_ms": round(metrics["total_ms"] / metrics["requests"], 1) if metrics["requests"] else 0.0
+                }
+                for host, metrics in self._metrics.items()
+            }
+        }
+
+outbound_http = OutboundHTTP()
 
 # ============== AUTH ENDPOINTS ==============
 
@@ -252,17 +1041,12 @@ async def create_session(request: Request, response: Response):
         raise HTTPException(status_code=400, detail="Missing X-Session-ID header")
     
     # Exchange session_id for user data with Emergent Auth
-    async with httpx.AsyncClient() as client:
-        try:
-            auth_response = await client.get(
-                EMERGENT_AUTH_URL,
-                headers={"X-Session-ID": session_id},
-                timeout=10.0
-            )
-            auth_response.raise_for_status()
-            user_data = auth_response.json()
-        except Exception as e:
-            raise HTTPException(status_code=400, detail=f"Failed to validate session: {str(e)}")
+    try:
+        auth_response = await outbound_http.get(EMERGENT_AUTH_URL, headers={"X-Session-ID": session_id})
+        auth_response.raise_for_status()
+        user_data = auth_response.json()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to validate session: {str(e)}")
     
     # Parse response
     session_data = SessionDataResponse(**user_data)
@@ -310,7 +1094,7 @@ async def create_session(request: Request, response: Response):
     await db.user_sessions.insert_one({
         "user_id": user_id,
         "session_token": session_data.session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+        "expires_at": datetime.now(timezone.utc) + SESSION_DURATION,
         "created_at": datetime.now(timezone.utc)
     })
     
@@ -333,10 +1117,11 @@ async def get_me(current_user: User = Depends(get_current_user)):
 
 @app.post("/api/auth/logout")
 async def logout(request: Request, response: Response):
-    session_token = request.cookies.get("session_token")
+    session_token = get_request_session_token(request)
     
     if session_token:
         await db.user_sessions.delete_one({"session_token": session_token})
+        session_cache.invalidate(session_token)
     
     response.delete_cookie(key="session_token", path="/")
     
@@ -427,7 +1212,7 @@ async def register_with_email(data: EmailRegisterRequest, response: Response):
     await db.user_sessions.insert_one({
         "user_id": user_id,
         "session_token": session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+        "expires_at": datetime.now(timezone.utc) + SESSION_DURATION,
         "created_at": datetime.now(timezone.utc)
     })
     
@@ -467,7 +1252,7 @@ async def login_with_email(data: EmailLoginRequest, response: Response):
     await db.user_sessions.insert_one({
         "user_id": user["user_id"],
         "session_token": session_token,
-        "expires_at": datetime.now(timezone.utc) + timedelta(days=7),
+        "expires_at": datetime.now(timezone.utc) + SESSION_DURATION,
         "created_at": datetime.now(timezone.utc)
     })
     
@@ -514,6 +1299,7 @@ async def change_password(data: ChangePasswordRequest, current_user: User = Depe
         {"user_id": current_user.user_id},
         {"$set": {"password_hash": hash_password(data.new_password)}}
     )
+    session_cache.invalidate_user(current_user.user_id)
     
     return {"success": True, "message": "Contraseña actualizada correctamente"}
 
@@ -539,6 +1325,7 @@ async def set_user_role(data: SetRoleRequest, current_user: User = Depends(get_c
             "updated_at": datetime.now(timezone.utc)
         }}
     )
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True, "role": data.role}
 
@@ -572,6 +1359,7 @@ async def professional_onboarding(data: ProfessionalOnboardingRequest, current_u
             "updated_at": datetime.now(timezone.utc)
         }}
     )
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True}
 
@@ -689,6 +1477,9 @@ async def professional_link_patient(data: LinkPatientRequest, current_user: User
         {"user_id": current_user.user_id},
         {"$addToSet": {"linked_patients": data.patient_id}}
     )
+    invalidate_dashboard(data.patient_id, current_user.user_id)
+    # The professional sees the patient's current alerts right away
+    await refresh_patient_alerts(data.patient_id)
     
     return {"success": True, "message": "Paciente vinculado correctamente"}
 
@@ -696,7 +1487,10 @@ async def professional_link_patient(data: LinkPatientRequest, current_user: User
 # Only professionals can link patients via /api/professional/link-patient
 
 @app.get("/api/professional/patients")
-async def get_professional_patients(current_user: User = Depends(get_current_user)):
+async def get_professional_patients(
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_loaders)
+):
     """Get all patients linked to this professional"""
     # Check if user is a professional
     profile = await db.user_profiles.find_one({"user_id": current_user.user_id})
@@ -711,9 +1505,10 @@ async def get_professional_patients(current_user: User = Depends(get_current_use
     ).to_list(100)
     
     # Enrich with user data
+    users = await loaders.users.load_many(patient["user_id"] for patient in patients)
     results = []
     for patient in patients:
-        user = await db.users.find_one({"user_id": patient["user_id"]}, {"_id": 0})
+        user = users[patient["user_id"]]
         if user:
             results.append({
                 "user_id": patient["user_id"],
@@ -730,67 +1525,52 @@ async def get_professional_patients(current_user: User = Depends(get_current_use
 @app.get("/api/professional/patient/{patient_id}")
 async def get_patient_detail(patient_id: str, current_user: User = Depends(get_current_user)):
     """Get detailed information about a specific patient"""
-    # Check if user is a professional
-    profile = await db.user_profiles.find_one({"user_id": current_user.user_id})
+    # Access checks: the caller must be a professional linked to the patient
+    checks = await fan_out({
+        "profile": db.user_profiles.find_one({"user_id": current_user.user_id}),
+        "patient_profile": db.user_profiles.find_one(
+            {
+                "user_id": patient_id,
+                "linked_therapist_id": current_user.user_id
+            },
+            {"_id": 0}
+        )
+    }, required=("profile", "patient_profile"))
+    profile = checks["profile"]
+    patient_profile = checks["patient_profile"]
     
     if not profile or profile.get("role") != "professional":
         raise HTTPException(status_code=403, detail="Solo profesionales pueden ver pacientes")
     
-    # Check if patient is linked to this professional
-    patient_profile = await db.user_profiles.find_one(
-        {
-            "user_id": patient_id,
-            "linked_therapist_id": current_user.user_id
-        },
-        {"_id": 0}
-    )
-    
     if not patient_profile:
         raise HTTPException(status_code=404, detail="Paciente no encontrado o no vinculado")
     
-    # Get user data
-    patient_user = await db.users.find_one({"user_id": patient_id}, {"_id": 0})
-    
-    # Get emotional logs (last 30)
-    emotional_logs = await db.emotional_logs.find(
-        {"user_id": patient_id},
-        {"_id": 0}
-    ).sort("date", -1).limit(30).to_list(30)
-    
-    # Get habits with today's completion status
-    habits = await db.habits.find(
-        {"user_id": patient_id, "is_active": True},
-        {"_id": 0}
-    ).to_list(50)
+    # User data, last 30 emotional logs and habits with today's completion status
+    data = await fan_out({
+        "patient_user": db.users.find_one({"user_id": patient_id}, {"_id": 0}),
+        "emotional_logs": db.emotional_logs.find(
+            {"user_id": patient_id},
+            {"_id": 0}
+        ).sort("date", -1).limit(30).to_list(30),
+        "habits": db.habits.find(
+            {"user_id": patient_id, "is_active": True},
+            {"_id": 0}
+        ).to_list(50)
+    }, defaults={"emotional_logs": [], "habits": []})
+    patient_user = data["patient_user"]
+    emotional_logs = data["emotional_logs"]
+    habits = data["habits"]
     
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    streaks = await get_habit_streaks(habits)
     habit_data = []
     for habit in habits:
-        log = await db.habit_logs.find_one(
-            {"habit_id": habit["habit_id"], "date": today},
-            {"_id": 0}
-        )
-        # Calculate streak
-        streak = 0
-        check_date = datetime.now(timezone.utc)
-        for _ in range(365):
-            date_str = check_date.strftime("%Y-%m-%d")
-            day_log = await db.habit_logs.find_one({
-                "habit_id": habit["habit_id"],
-                "date": date_str,
-                "completed": True
-            })
-            if day_log:
-                streak += 1
-                check_date -= timedelta(days=1)
-            else:
-                break
-        
+        habit_streak = streaks[habit["habit_id"]]
         habit_data.append({
             "habit_id": habit["habit_id"],
             "name": habit["name"],
-            "completed_today": log.get("completed", False) if log else False,
-            "streak": streak
+            "completed_today": habit_streak["completed_today"],
+            "streak": habit_streak["current_streak"],
+            "longest_streak": habit_streak["longest_streak"]
         })
     
     return {
@@ -817,6 +1597,9 @@ async def unlink_therapist(current_user: User = Depends(get_current_user)):
             "updated_at": datetime.now(timezone.utc)
         }}
     )
+    invalidate_dashboard(current_user.user_id)
+    # The former therapist no longer follows this patient's alerts
+    await resolve_alerts({"patient_id": current_user.user_id})
     
     return {"success": True, "message": "Terapeuta desvinculado"}
 
@@ -1225,182 +2008,558 @@ async def get_my_progress_report(days: int = 7, current_user: User = Depends(get
 
 # ============== ALERT SYSTEM ENDPOINTS ==============
 
-@app.get("/api/professional/alerts")
-async def get_professional_alerts(current_user: User = Depends(get_current_user)):
-    """Get all alerts for a professional, generating them dynamically"""
-    # Verify user is a professional
-    profile = await db.user_profiles.find_one({"user_id": current_user.user_id})
-    if not profile or profile.get("role") != "professional":
-        raise HTTPException(status_code=403, detail="Solo profesionales pueden ver alertas")
+ALERT_SEVERITY_ORDER = {"critical": 0, "high": 1, "medium": 2, "low": 3}
+ALERT_RELAPSE_DAYS = 7  # relapses reported in the last week
+ALERT_RELAPSES_PER_PATIENT = 5
+ALERT_RECENT_EMOTIONS = 7  # emotional logs considered for negative emotion
+ALERT_INACTIVITY_DAYS = 3  # days without habit or emotional logs
+ALERT_EMOTION_DAYS = ALERT_RELAPSE_DAYS + ALERT_INACTIVITY_DAYS  # older emotional logs raise no alert
+ALERT_LOW_MOOD = 3  # on the 1-5 mood scale
+ALERT_SCAN_HOUR = int(os.environ.get("ALERT_SCAN_HOUR", "3"))  # UTC hour of the nightly scan
+ALERT_SCAN_BATCH = 500
+ALERT_LIST_LIMIT = 200
+
+alert_scan_stats = {"runs": 0, "last_run_at": None, "last_patients": 0, "last_alerts": 0, "last_duration_ms": 0.0}
+
+def emotion_mood(log: dict) -> float:
+    """Mood of an emotional log on the 1-5 scale the alert rules use.
     
-    alerts = []
-    today = datetime.now(timezone.utc)
-    three_days_ago = today - timedelta(days=3)
+    Older logs carry "mood" (1-5); logs from POST /api/emotional-logs carry
+    "mood_scale" (1-10), which is halved.
+    """
+    if log.get("mood") is not None:
+        return log["mood"]
+    if log.get("mood_scale") is not None:
+        return log["mood_scale"] / 2
+    return 5
+
+def relapse_alert(professional_id: str, patient_id: str, patient_name: str, relapse: dict, today: datetime) -> Optional[dict]:
+    reported_at = relapse.get("reported_at")
+    if not isinstance(reported_at, datetime):
+        return None
+    if reported_at.tzinfo is None:
+        reported_at = reported_at.replace(tzinfo=timezone.utc)
+    if (today - reported_at).days > ALERT_RELAPSE_DAYS:
+        return None
+    return {
+        "alert_id": f"relapse_{relapse.get('relapse_id', '')}",
+        "professional_id": professional_id,
+        "patient_id": patient_id,
+        "patient_name": patient_name,
+        "alert_type": "relapse",
+        "severity": "critical",
+        "title": "🚨 Recaída Reportada",
+        "description": f"{patient_name} reportó una recaída el {relapse.get('date', 'fecha desconocida')}. Sustancia: {relapse.get('substance', 'No especificada')}. Trigger: {relapse.get('trigger', 'No especificado')}.",
+        "created_at": reported_at,
+        "expires_at": reported_at + timedelta(days=ALERT_RELAPSE_DAYS + 1),
+        "data": relapse
+    }
+
+def inactivity_alert(professional_id: str, patient_id: str, patient_name: str, last_dates: list, today: datetime) -> Optional[dict]:
+    last_activity = None
+    for last_date in last_dates:
+        try:
+            activity_date = datetime.strptime(last_date or "", "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        except (ValueError, TypeError):
+            continue
+        if not last_activity or activity_date > last_activity:
+            last_activity = activity_date
     
-    # Get all patients linked to this professional
-    patients = await db.user_profiles.find(
-        {"linked_therapist_id": current_user.user_id},
-        {"_id": 0}
-    ).to_list(100)
+    if not last_activity:
+        return None
+    days_inactive = (today - last_activity).days
+    if days_inactive < ALERT_INACTIVITY_DAYS:
+        return None
     
-    for patient_profile in patients:
-        patient_id = patient_profile.get("user_id")
-        patient_user = await db.users.find_one({"user_id": patient_id}, {"_id": 0})
-        patient_name = patient_user.get("name", "Paciente") if patient_user else "Paciente"
-        
-        # 1. Check for RELAPSES (Critical)
-        recent_relapses = await db.relapses.find(
-            {"user_id": patient_id},
-            {"_id": 0}
-        ).sort("reported_at", -1).limit(5).to_list(5)
-        
-        for relapse in recent_relapses:
-            reported_at = relapse.get("reported_at")
-            if isinstance(reported_at, datetime):
-                days_since = (today - reported_at).days
-                if days_since <= 7:  # Show relapses from last 7 days
-                    alerts.append({
-                        "alert_id": f"relapse_{relapse.get('relapse_id', '')}",
-                        "professional_id": current_user.user_id,
-                        "patient_id": patient_id,
-                        "patient_name": patient_name,
-                        "alert_type": "relapse",
-                        "severity": "critical",
-                        "title": "🚨 Recaída Reportada",
-                        "description": f"{patient_name} reportó una recaída el {relapse.get('date', 'fecha desconocida')}. Sustancia: {relapse.get('substance', 'No especificada')}. Trigger: {relapse.get('trigger', 'No especificado')}.",
-                        "created_at": reported_at.isoformat() if isinstance(reported_at, datetime) else str(reported_at),
-                        "is_read": False,
-                        "is_resolved": False,
-                        "data": relapse
-                    })
-        
-        # 2. Check for INACTIVITY (3+ days without activity)
-        last_emotional_log = await db.emotional_logs.find_one(
-            {"user_id": patient_id},
-            {"_id": 0}
-        )
-        
-        last_habit_log = await db.habit_logs.find_one(
-            {"user_id": patient_id},
-            {"_id": 0}
-        )
-        
-        # Determine last activity date
-        last_activity = None
-        if last_emotional_log:
-            try:
-                log_date = datetime.strptime(last_emotional_log.get("date", ""), "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                last_activity = log_date
-            except:
-                pass
-        
-        if last_habit_log:
-            try:
-                habit_date = datetime.strptime(last_habit_log.get("date", ""), "%Y-%m-%d").replace(tzinfo=timezone.utc)
-                if not last_activity or habit_date > last_activity:
-                    last_activity = habit_date
-            except:
-                pass
-        
-        if last_activity:
-            days_inactive = (today - last_activity).days
-            if days_inactive >= 3:
-                severity = "high" if days_inactive >= 7 else "medium"
-                alerts.append({
-                    "alert_id": f"inactivity_{patient_id}_{today.strftime('%Y%m%d')}",
-                    "professional_id": current_user.user_id,
-                    "patient_id": patient_id,
-                    "patient_name": patient_name,
-                    "alert_type": "inactivity",
-                    "severity": severity,
-                    "title": f"⚠️ {days_inactive} días sin actividad",
-                    "description": f"{patient_name} no ha registrado actividad en los últimos {days_inactive} días. Última actividad: {last_activity.strftime('%d/%m/%Y')}.",
-                    "created_at": today.isoformat(),
-                    "is_read": False,
-                    "is_resolved": False,
-                    "data": {"days_inactive": days_inactive, "last_activity": last_activity.isoformat()}
-                })
+    # One alert per inactivity episode; the nightly scan updates its days count
+    return {
+        "alert_id": f"inactivity_{patient_id}_{last_activity.strftime('%Y%m%d')}",
+        "professional_id": professional_id,
+        "patient_id": patient_id,
+        "patient_name": patient_name,
+        "alert_type": "inactivity",
+        "severity": "high" if days_inactive >= 7 else "medium",
+        "title": f"⚠️ {days_inactive} días sin actividad",
+        "description": f"{patient_name} no ha registrado actividad en los últimos {days_inactive} días. Última actividad: {last_activity.strftime('%d/%m/%Y')}.",
+        "created_at": today,
+        "data": {"days_inactive": days_inactive, "last_activity": last_activity.isoformat()}
+    }
+
+def negative_emotion_alert(professional_id: str, patient_id: str, patient_name: str, recent_logs: list, today: datetime) -> Optional[dict]:
+    """recent_logs: the patient's latest emotional logs, newest first"""
+    negative_count = 0
+    very_negative_found = False
+    for log in recent_logs:
+        mood = emotion_mood(log)
+        anxiety = log.get("anxiety") or 0
         
-        # 3. Check for NEGATIVE EMOTIONS
-        recent_emotions = await db.emotional_logs.find(
-            {"user_id": patient_id},
-            {"_id": 0}
-        ).sort("date", -1).limit(7).to_list(7)
+        if mood <= 2:  # Very low mood
+            very_negative_found = True
+            negative_count += 1
+        elif mood <= ALERT_LOW_MOOD:  # Low mood
+            negative_count += 1
         
-        negative_count = 0
-        very_negative_found = False
-        for log in recent_emotions:
-            mood = log.get("mood", 5)
-            anxiety = log.get("anxiety", 0)
-            
-            if mood <= 2:  # Very low mood
-                very_negative_found = True
-                negative_count += 1
-            elif mood <= 3:  # Low mood
-                negative_count += 1
-            
-            if anxiety >= 4:  # High anxiety
-                negative_count += 1
-        
-        if very_negative_found or negative_count >= 3:
-            severity = "high" if very_negative_found else "medium"
-            alerts.append({
-                "alert_id": f"emotion_{patient_id}_{today.strftime('%Y%m%d')}",
-                "professional_id": current_user.user_id,
-                "patient_id": patient_id,
-                "patient_name": patient_name,
-                "alert_type": "negative_emotion",
-                "severity": severity,
-                "title": "😔 Emociones Negativas Detectadas",
-                "description": f"{patient_name} ha reportado estados emocionales negativos en los últimos días. Se recomienda seguimiento.",
-                "created_at": today.isoformat(),
-                "is_read": False,
-                "is_resolved": False,
-                "data": {"negative_count": negative_count, "very_negative": very_negative_found}
-            })
+        if anxiety >= 4:  # High anxiety
+            negative_count += 1
     
-    # Sort alerts by severity and date
-    severity_order = {"critical": 0, "high": 1, "medium": 2, "low": 3}
-    alerts.sort(key=lambda x: (severity_order.get(x["severity"], 4), x["created_at"]), reverse=False)
+    if not (very_negative_found or negative_count >= 3):
+        return None
     
-    return {"alerts": alerts}
+    try:
+        latest_day = datetime.strptime(recent_logs[0].get("date") or "", "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        latest_day = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    return {
+        "alert_id": f"emotion_{patient_id}_{latest_day.strftime('%Y%m%d')}",
+        "professional_id": professional_id,
+        "patient_id": patient_id,
+        "patient_name": patient_name,
+        "alert_type": "negative_emotion",
+        "severity": "high" if very_negative_found else "medium",
+        "title": "😔 Emociones Negativas Detectadas",
+        "description": f"{patient_name} ha reportado estados emocionales negativos en los últimos días. Se recomienda seguimiento.",
+        "created_at": today,
+        "expires_at": latest_day + timedelta(days=ALERT_EMOTION_DAYS + 1),
+        "data": {"negative_count": negative_count, "very_negative": very_negative_found}
+    }
 
-@app.get("/api/professional/alerts/summary")
-async def get_alerts_summary(current_user: User = Depends(get_current_user)):
-    """Get a summary count of alerts by type"""
-    alerts_response = await get_professional_alerts(current_user)
-    alerts = alerts_response.get("alerts", [])
+async def evaluate_patient_alerts(patients: dict, patient_users: dict, today: datetime) -> list:
+    """Relapse, inactivity and negative-emotion alerts for many patients.
     
-    summary = {
-        "total": len(alerts),
-        "critical": len([a for a in alerts if a["severity"] == "critical"]),
-        "high": len([a for a in alerts if a["severity"] == "high"]),
-        "medium": len([a for a in alerts if a["severity"] == "medium"]),
-        "by_type": {
-            "relapse": len([a for a in alerts if a["alert_type"] == "relapse"]),
-            "inactivity": len([a for a in alerts if a["alert_type"] == "inactivity"]),
-            "negative_emotion": len([a for a in alerts if a["alert_type"] == "negative_emotion"])
-        }
-    }
+    patients maps patient_id -> professional_id. Runs a fixed set of
+    aggregations ($in over the patient ids, grouped by user_id) whatever
+    the number of patients, instead of several queries per patient.
+    """
+    patient_ids = list(patients)
+    if not patient_ids:
+        return []
+    
+    emotion_since = (today - timedelta(days=ALERT_EMOTION_DAYS)).strftime("%Y-%m-%d")
+    relapse_rows, emotion_rows, emotion_date_rows, habit_rows = await asyncio.gather(
+        # Latest relapses of the window per patient
+        db.relapses.aggregate([
+            {"$match": {
+                "user_id": {"$in": patient_ids},
+                "reported_at": {"$gte": today - timedelta(days=ALERT_RELAPSE_DAYS + 1)}
+            }},
+            {"$project": {"_id": 0}},
+            {"$sort": {"user_id": 1, "reported_at": -1}},
+            {"$group": {"_id": "$user_id", "relapses": {"$push": "$$ROOT"}}},
+            {"$project": {"relapses": {"$slice": ["$relapses", ALERT_RELAPSES_PER_PATIENT]}}}
+        ]).to_list(None),
+        # Most recent moods per patient, only from the alert window so the
+        # pushed list stays a few documents whatever the patient's history
+        db.emotional_logs.aggregate([
+            {"$match": {"user_id": {"$in": patient_ids}, "date": {"$gte": emotion_since}}},
+            {"$project": {"_id": 0, "user_id": 1, "date": 1, "mood": 1, "mood_scale": 1, "anxiety": 1}},
+            {"$sort": {"user_id": 1, "date": -1}},
+            {"$group": {"_id": "$user_id", "recent": {"$push": "$$ROOT"}}},
+            {"$project": {"recent": {"$slice": ["$recent", ALERT_RECENT_EMOTIONS]}}}
+        ]).to_list(None),
+        # Last emotional log date per patient
+        db.emotional_logs.aggregate([
+            {"$match": {"user_id": {"$in": patient_ids}}},
+            {"$group": {"_id": "$user_id", "last_date": {"$max": "$date"}}}
+        ]).to_list(None),
+        # Last habit log date per patient
+        db.habit_logs.aggregate([
+            {"$match": {"user_id": {"$in": patient_ids}}},
+            {"$group": {"_id": "$user_id", "last_date": {"$max": "$date"}}}
+        ]).to_list(None)
+    )
     
-    return summary
-
-@app.post("/api/patient/report-relapse")
-async def report_relapse(data: ReportRelapseRequest, current_user: User = Depends(get_current_user)):
-    """Patient reports a relapse"""
-    relapse_id = f"relapse_{uuid.uuid4().hex[:12]}"
+    relapses_by_patient = {row["_id"]: row["relapses"] for row in relapse_rows}
+    emotions_by_patient = {row["_id"]: row["recent"] for row in emotion_rows}
+    last_emotion_dates = {row["_id"]: row.get("last_date") for row in emotion_date_rows}
+    last_habit_dates = {row["_id"]: row.get("last_date") for row in habit_rows}
     
-    relapse = {
-        "relapse_id": relapse_id,
-        "user_id": current_user.user_id,
-        "date": data.date,
-        "substance": data.substance,
+    alerts = []
+    for patient_id, professional_id in patients.items():
+        patient_user = patient_users.get(patient_id)
+        patient_name = patient_user.get("name", "Paciente") if patient_user else "Paciente"
+        
+        candidates = [
+            relapse_alert(professional_id, patient_id, patient_name, relapse, today)
+            for relapse in relapses_by_patient.get(patient_id, [])
+        ]
+        candidates.append(inactivity_alert(
+            professional_id, patient_id, patient_name,
+            [last_emotion_dates.get(patient_id), last_habit_dates.get(patient_id)], today
+        ))
+        candidates.append(negative_emotion_alert(professional_id, patient_id, patient_name, emotions_by_patient.get(patient_id, []), today))
+        alerts.extend(alert for alert in candidates if alert)
+    
+    return alerts
+
+def alert_counter_inc(alert: dict, sign: int, unread: bool = True) -> dict:
+    """$inc for a professional's alert counters when an unresolved alert comes or goes"""
+    inc = {
+        "total": sign,
+        alert["severity"]: sign,
+        f"by_type.{alert['alert_type']}": sign
+    }
+    if unread:
+        inc["unread"] = sign
+    return inc
+
+async def apply_alert_counters(increments: dict):
+    """Apply professional_id -> {field: delta} to alert_counters (one bulk write)"""
+    now = datetime.now(timezone.utc)
+    operations = [
+        UpdateOne(
+            {"professional_id": professional_id},
+            {"$inc": inc, "$set": {"updated_at": now}},
+            upsert=True
+        )
+        for professional_id, inc in increments.items()
+        if any(inc.values())
+    ]
+    if operations:
+        await db.alert_counters.bulk_write(operations, ordered=False)
+
+def merge_increments(increments: dict, professional_id: str, inc: dict):
+    target = increments.setdefault(professional_id, {})
+    for field, delta in inc.items():
+        target[field] = target.get(field, 0) + delta
+
+async def store_alerts(alerts: list) -> int:
+    """Upsert alerts by their deterministic alert_id and keep counters in step.
+    
+    Re-evaluating an alert that already exists refreshes its content but
+    keeps its created_at and read/resolved state. New alerts are counted
+    from the upsert result; an open alert moving to another severity or
+    professional is moved with a guarded update so each change counts once.
+    """
+    if not alerts:
+        return 0
+    now = datetime.now(timezone.utc)
+    
+    existing = {
+        alert["alert_id"]: alert
+        for alert in await db.alerts.find(
+            {"alert_id": {"$in": [alert["alert_id"] for alert in alerts]}},
+            {"_id": 0, "alert_id": 1, "professional_id": 1, "severity": 1, "alert_type": 1, "is_read": 1, "is_resolved": 1}
+        ).to_list(None)
+    }
+    
+    operations = []
+    moved = []
+    for alert in alerts:
+        fields = {key: value for key, value in alert.items() if key not in ("alert_id", "created_at")}
+        fields["severity_rank"] = ALERT_SEVERITY_ORDER.get(alert["severity"], 4)
+        fields["updated_at"] = now
+        
+        previous = existing.get(alert["alert_id"])
+        if previous and not previous.get("is_resolved") and (
+            previous.get("severity"), previous.get("professional_id")
+        ) != (alert["severity"], alert["professional_id"]):
+            moved.append((alert, previous, fields))
+            continue
+        
+        operations.append((alert, UpdateOne(
+            {"alert_id": alert["alert_id"]},
+            {
+                "$set": fields,
+                "$setOnInsert": {"created_at": alert["created_at"], "is_read": False, "is_resolved": False}
+            },
+            upsert=True
+        )))
+    
+    increments = {}
+    created = 0
+    if operations:
+        result = await db.alerts.bulk_write([operation for _, operation in operations], ordered=False)
+        created = result.upserted_count
+        for index in result.upserted_ids:
+            alert = operations[index][0]
+            merge_increments(increments, alert["professional_id"], alert_counter_inc(alert, 1))
+    
+    for alert, previous, fields in moved:
+        result = await db.alerts.update_one(
+            {
+                "alert_id": alert["alert_id"],
+                "severity": previous["severity"],
+                "professional_id": previous["professional_id"],
+                "is_resolved": False
+            },
+            {"$set": fields}
+        )
+        if result.modified_count:
+            unread = not previous.get("is_read")
+            merge_increments(increments, previous["professional_id"], alert_counter_inc(previous, -1, unread))
+            merge_increments(increments, alert["professional_id"], alert_counter_inc(alert, 1, unread))
+    
+    await apply_alert_counters(increments)
+    return created
+
+async def resolve_alerts(query: dict) -> int:
+    """Resolve the open alerts matching query whose condition no longer holds.
+    
+    Each alert is closed with a guarded update, so one a professional
+    resolves at the same time is only closed (and uncounted) once.
+    """
+    now = datetime.now(timezone.utc)
+    stale = await db.alerts.find(
+        {**query, "is_resolved": False},
+        {"_id": 0, "alert_id": 1, "professional_id": 1, "severity": 1, "alert_type": 1, "is_read": 1}
+    ).to_list(None)
+    
+    increments = {}
+    resolved = 0
+    for alert in stale:
+        result = await db.alerts.update_one(
+            {"alert_id": alert["alert_id"], "is_resolved": False},
+            {"$set": {"is_resolved": True, "auto_resolved": True, "updated_at": now}, "$min": {"resolved_at": now}}
+        )
+        if result.modified_count:
+            resolved += 1
+            merge_increments(increments, alert["professional_id"], alert_counter_inc(alert, -1, unread=not alert.get("is_read")))
+    
+    await apply_alert_counters(increments)
+    return resolved
+
+async def sync_patient_alerts(patients: dict, patient_users: dict, today: datetime) -> int:
+    """Store the current alerts of some patients and resolve the ones that went away"""
+    alerts = await evaluate_patient_alerts(patients, patient_users, today)
+    created = await store_alerts(alerts)
+    await resolve_alerts({
+        "patient_id": {"$in": list(patients)},
+        "alert_id": {"$nin": [alert["alert_id"] for alert in alerts]}
+    })
+    return created
+
+async def resolve_inactivity_alerts(patient_id: str, date: str):
+    """Close a patient's inactivity alerts once they log a habit or emotion again.
+    
+    Backdated logs don't count as activity. Never fails the calling request.
+    """
+    recent = (datetime.now(timezone.utc) - timedelta(days=ALERT_INACTIVITY_DAYS)).strftime("%Y-%m-%d")
+    if date < recent:
+        return
+    try:
+        await resolve_alerts({"patient_id": patient_id, "alert_type": "inactivity"})
+    except Exception as e:
+        print(f"Could not resolve inactivity alerts for {patient_id}: {e}")
+
+async def rebuild_alert_counters() -> int:
+    """Recompute every professional's alert counters from the alerts collection (repair)"""
+    rows = await db.alerts.aggregate([
+        {"$match": {"is_resolved": False}},
+        {"$group": {
+            "_id": {"professional_id": "$professional_id", "severity": "$severity", "alert_type": "$alert_type"},
+            "count": {"$sum": 1},
+            "unread": {"$sum": {"$cond": ["$is_read", 0, 1]}}
+        }}
+    ]).to_list(None)
+    
+    counters = {}
+    for row in rows:
+        professional_id = row["_id"]["professional_id"]
+        counter = counters.setdefault(professional_id, {
+            "total": 0, "unread": 0, "critical": 0, "high": 0, "medium": 0, "low": 0,
+            "by_type": {"relapse": 0, "inactivity": 0, "negative_emotion": 0}
+        })
+        counter["total"] += row["count"]
+        counter["unread"] += row["unread"]
+        counter[row["_id"]["severity"]] = counter.get(row["_id"]["severity"], 0) + row["count"]
+        counter["by_type"][row["_id"]["alert_type"]] = counter["by_type"].get(row["_id"]["alert_type"], 0) + row["count"]
+    
+    now = datetime.now(timezone.utc)
+    await db.alert_counters.delete_many({"professional_id": {"$nin": list(counters)}})
+    if counters:
+        await db.alert_counters.bulk_write([
+            UpdateOne({"professional_id": professional_id}, {"$set": {**counter, "updated_at": now}}, upsert=True)
+            for professional_id, counter in counters.items()
+        ], ordered=False)
+    return len(counters)
+
+async def refresh_patient_alerts(patient_id: str):
+    """Re-evaluate one patient's alerts after a write (relapse, low mood).
+    
+    Never fails the calling request: errors are logged and the nightly scan
+    catches up.
+    """
+    try:
+        profile = await db.user_profiles.find_one({"user_id": patient_id}, {"_id": 0, "linked_therapist_id": 1})
+        if not profile or not profile.get("linked_therapist_id"):
+            return
+        patient_user = await db.users.find_one({"user_id": patient_id}, {"_id": 0, "name": 1})
+        await sync_patient_alerts(
+            {patient_id: profile["linked_therapist_id"]},
+            {patient_id: patient_user},
+            datetime.now(timezone.utc)
+        )
+    except Exception as e:
+        print(f"Could not refresh alerts for {patient_id}: {e}")
+
+async def scan_patient_alerts(batch_size: int = ALERT_SCAN_BATCH) -> dict:
+    """Evaluate every linked patient's alerts (nightly inactivity scan).
+    
+    Patients are processed in batches of batch_size, each batch costing a
+    fixed number of queries. Also backfills alerts for existing data,
+    resolves open alerts the evaluation no longer produces and expires
+    relapse and negative-emotion alerts past their window.
+    """
+    started = time.monotonic()
+    today = datetime.now(timezone.utc)
+    scanned = 0
+    stored = 0
+    
+    async def process(batch):
+        loaders = RequestLoaders()
+        patient_users = await loaders.users.load_many(batch)
+        return await sync_patient_alerts(batch, patient_users, today)
+    
+    batch = {}
+    async for profile in db.user_profiles.find(
+        {"linked_therapist_id": {"$nin": [None, ""]}},
+        {"_id": 0, "user_id": 1, "linked_therapist_id": 1}
+    ):
+        batch[profile["user_id"]] = profile["linked_therapist_id"]
+        if len(batch) >= batch_size:
+            stored += await process(batch)
+            scanned += len(batch)
+            batch = {}
+    if batch:
+        stored += await process(batch)
+        scanned += len(batch)
+    await resolve_alerts({"expires_at": {"$lte": today}})
+    
+    alert_scan_stats.update({
+        "runs": alert_scan_stats["runs"] + 1,
+        "last_run_at": today.isoformat(),
+        "last_patients": scanned,
+        "last_alerts": stored,
+        "last_duration_ms": round((time.monotonic() - started) * 1000, 1)
+    })
+    return dict(alert_scan_stats)
+
+async def alert_scan_loop():
+    """Run scan_patient_alerts at startup, then every night at ALERT_SCAN_HOUR (UTC).
+    
+    The startup run makes alerts for existing data (and for anything that
+    happened while the server was down) visible without waiting for the night.
+    """
+    while True:
+        try:
+            stats = await scan_patient_alerts()
+            print(f"Alert scan: {stats['last_patients']} patients, {stats['last_alerts']} new alerts")
+        except Exception as e:
+            print(f"Alert scan failed: {e}")
+        now = datetime.now(timezone.utc)
+        next_run = now.replace(hour=ALERT_SCAN_HOUR, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+def serialize_alert(alert: dict) -> dict:
+    created_at = alert.get("created_at")
+    if isinstance(created_at, datetime):
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=timezone.utc)
+        alert["created_at"] = created_at.isoformat()
+    return alert
+
+async def require_professional(current_user: User):
+    profile = await db.user_profiles.find_one({"user_id": current_user.user_id})
+    if not profile or profile.get("role") != "professional":
+        raise HTTPException(status_code=403, detail="Solo profesionales pueden ver alertas")
+
+@app.get("/api/professional/alerts")
+async def get_professional_alerts(current_user: User = Depends(get_current_user), include_resolved: bool = False):
+    """Get the alerts of a professional's patients, most severe and newest first"""
+    await require_professional(current_user)
+    
+    query = {"professional_id": current_user.user_id}
+    if not include_resolved:
+        query["is_resolved"] = False
+    
+    alerts = await db.alerts.find(
+        query,
+        {"_id": 0, "severity_rank": 0, "updated_at": 0}
+    ).sort([("severity_rank", 1), ("created_at", -1)]).to_list(ALERT_LIST_LIMIT)
+    
+    return {"alerts": [serialize_alert(alert) for alert in alerts]}
+
+@app.get("/api/professional/alerts/summary")
+async def get_alerts_summary(current_user: User = Depends(get_current_user)):
+    """Get a summary count of open alerts by severity and type (one counter document)"""
+    await require_professional(current_user)
+    counters = await db.alert_counters.find_one({"professional_id": current_user.user_id}, {"_id": 0}) or {}
+    by_type = counters.get("by_type", {})
+    
+    return {
+        "total": counters.get("total", 0),
+        "critical": counters.get("critical", 0),
+        "high": counters.get("high", 0),
+        "medium": counters.get("medium", 0),
+        "unread": counters.get("unread", 0),
+        "by_type": {
+            "relapse": by_type.get("relapse", 0),
+            "inactivity": by_type.get("inactivity", 0),
+            "negative_emotion": by_type.get("negative_emotion", 0)
+        }
+    }
+
+@app.post("/api/professional/alerts/{alert_id}/read")
+async def mark_alert_read(alert_id: str, current_user: User = Depends(get_current_user)):
+    """Mark one of the professional's alerts as read"""
+    await require_professional(current_user)
+    previous = await db.alerts.find_one_and_update(
+        {"alert_id": alert_id, "professional_id": current_user.user_id},
+        {"$set": {"is_read": True}, "$min": {"read_at": datetime.now(timezone.utc)}},
+        projection={"_id": 0, "is_read": 1, "is_resolved": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    
+    if not previous:
+        raise HTTPException(status_code=404, detail="Alerta no encontrada")
+    
+    if not previous.get("is_read") and not previous.get("is_resolved"):
+        await apply_alert_counters({current_user.user_id: {"unread": -1}})
+    
+    return {"success": True}
+
+@app.post("/api/professional/alerts/{alert_id}/resolve")
+async def resolve_alert(alert_id: str, current_user: User = Depends(get_current_user)):
+    """Mark one of the professional's alerts as resolved (and read)"""
+    await require_professional(current_user)
+    now = datetime.now(timezone.utc)
+    previous = await db.alerts.find_one_and_update(
+        {"alert_id": alert_id, "professional_id": current_user.user_id},
+        {"$set": {"is_read": True, "is_resolved": True}, "$min": {"read_at": now, "resolved_at": now}},
+        projection={"_id": 0, "severity": 1, "alert_type": 1, "is_read": 1, "is_resolved": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    
+    if not previous:
+        raise HTTPException(status_code=404, detail="Alerta no encontrada")
+    
+    if not previous.get("is_resolved"):
+        await apply_alert_counters({
+            current_user.user_id: alert_counter_inc(previous, -1, unread=not previous.get("is_read"))
+        })
+    
+    return {"success": True}
+
+@app.post("/api/patient/report-relapse")
+async def report_relapse(data: ReportRelapseRequest, current_user: User = Depends(get_current_user)):
+    """Patient reports a relapse"""
+    relapse_id = f"relapse_{uuid.uuid4().hex[:12]}"
+    
+    relapse = {
+        "relapse_id": relapse_id,
+        "user_id": current_user.user_id,
+        "date": data.date,
+        "substance": data.substance,
         "trigger": data.trigger,
         "notes": data.notes,
         "reported_at": datetime.now(timezone.utc)
     }
     
     await db.relapses.insert_one(relapse)
+    await refresh_daily_rollup(current_user.user_id, relapse_date(relapse))
+    await refresh_patient_alerts(current_user.user_id)
     
     # Optionally reset clean_since date
     await db.user_profiles.update_one(
@@ -1410,16 +2569,24 @@ async def report_relapse(data: ReportRelapseRequest, current_user: User = Depend
             "updated_at": datetime.now(timezone.utc)
         }}
     )
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True, "relapse_id": relapse_id, "message": "Recaída registrada. Tu contador de días ha sido reiniciado."}
 
 @app.get("/api/patient/relapses")
-async def get_patient_relapses(current_user: User = Depends(get_current_user)):
-    """Get patient's relapse history"""
-    relapses = await db.relapses.find(
+async def get_patient_relapses(
+    response: Response,
+    current_user: User = Depends(get_current_user),
+    limit: int = 50,
+    cursor: Optional[str] = None
+):
+    """Get patient's relapse history, newest first (next page cursor in X-Next-Cursor)"""
+    relapses, next_cursor = await paginate(
+        db.relapses,
         {"user_id": current_user.user_id},
-        {"_id": 0}
-    ).sort("reported_at", -1).to_list(50)
+        "reported_at", limit, cursor
+    )
+    set_next_cursor(response, next_cursor)
     
     return relapses
 
@@ -1428,147 +2595,423 @@ async def get_patient_relapses(current_user: User = Depends(get_current_user)):
 ADMIN_EMAIL = "contacto@sinadicciones.org"
 
 async def is_admin(user: User) -> bool:
-    """Check if user is admin"""
+    """Check if user is admin (admin email, admin role or profile flagged is_admin)"""
     if user.email == ADMIN_EMAIL:
         return True
     profile = await db.user_profiles.find_one({"user_id": user.user_id})
-    return profile and profile.get("role") == "admin"
+    return bool(profile) and (profile.get("role") == "admin" or bool(profile.get("is_admin")))
+
+# ============== ADMIN ANALYTICS ==============
+
+# Platform stats are computed in the background into a single admin_stats
+# snapshot document; the endpoint only reads it (and recomputes inline when
+# the snapshot is missing or too old, e.g. right after a deploy).
+ADMIN_STATS_REFRESH_INTERVAL = int(os.getenv("ADMIN_STATS_REFRESH_INTERVAL", "300"))  # seconds
+ADMIN_STATS_MAX_AGE = int(os.getenv("ADMIN_STATS_MAX_AGE", "900"))  # seconds
+ADMIN_STATS_QUERY_TIMEOUT = float(os.getenv("ADMIN_STATS_QUERY_TIMEOUT", "60"))  # seconds
+ADMIN_STATS_ACTIVE_DAYS = 7
+ADMIN_STATS_SNAPSHOT_ID = "platform"
+
+admin_stats_refresh_stats = {
+    "runs": 0,
+    "skipped": 0,
+    "errors": 0,
+    "last_run_at": None,
+    "last_duration_ms": None,
+    "last_error": None
+}
 
-@app.get("/api/admin/stats")
-async def get_admin_stats(current_user: User = Depends(get_current_user)):
-    """Get global platform statistics - Admin only"""
-    if not await is_admin(current_user):
-        raise HTTPException(status_code=403, detail="Acceso solo para administradores")
-    
-    today = datetime.now(timezone.utc)
-    seven_days_ago = today - timedelta(days=7)
-    thirty_days_ago = today - timedelta(days=30)
-    
-    # Total users
-    total_users = await db.users.count_documents({})
-    
-    # Users by role
-    total_patients = await db.user_profiles.count_documents({"role": "patient"})
-    total_professionals = await db.user_profiles.count_documents({"role": "professional"})
-    total_admins = await db.user_profiles.count_documents({"role": "admin"})
-    
-    # Profiles completed
-    profiles_completed = await db.user_profiles.count_documents({"profile_completed": True})
-    
-    # Active users (with activity in last 7 days)
-    recent_emotional_logs = await db.emotional_logs.distinct("user_id")
-    recent_habit_logs = await db.habit_logs.distinct("user_id")
-    active_users = len(set(recent_emotional_logs) | set(recent_habit_logs))
-    
-    # Total habits created
-    total_habits = await db.habits.count_documents({"is_active": True})
-    
-    # Total emotional logs
-    total_emotional_logs = await db.emotional_logs.count_documents({})
-    
-    # Total relapses
-    total_relapses = await db.relapses.count_documents({})
+# Payload shapes of /api/admin/stats and /api/admin/users (?view=)
+ADMIN_VIEWS = ("platform", "summary")
+
+def require_admin_view(view: str) -> str:
+    if view not in ADMIN_VIEWS:
+        raise HTTPException(status_code=400, detail=f"Vista inválida. Opciones: {', '.join(ADMIN_VIEWS)}")
+    return view
+
+def facet_count(facets: dict, name: str) -> int:
+    """Value of a [{"$count": "count"}] facet (0 when nothing matched)"""
+    rows = facets.get(name) or []
+    return rows[0]["count"] if rows else 0
+
+async def active_user_ids(collection: str, since: datetime) -> list:
+    """Users with at least one log in collection since the given time (logged_at index)"""
+    rows = await db[collection].aggregate([
+        {"$match": {"logged_at": {"$gte": since}}},
+        {"$group": {"_id": "$user_id"}}
+    ]).to_list(None)
+    return [row["_id"] for row in rows]
+
+async def compute_admin_stats() -> dict:
+    """Platform statistics with one query per collection, run concurrently.
     
-    # Linked patients (with therapist)
-    linked_patients = await db.user_profiles.count_documents({
-        "role": "patient",
-        "linked_therapist_id": {"$ne": None}
-    })
+    Returns every ADMIN_VIEWS payload: "platform" (totals and engagement) and
+    "summary" (users by role and 7-day activity volume).
+    """
+    now = datetime.now(timezone.utc)
+    active_since = now - timedelta(days=ADMIN_STATS_ACTIVE_DAYS)
+    
+    queries = {
+        "total_users": db.users.count_documents({}),
+        "profiles": db.user_profiles.aggregate([{"$facet": {
+            "by_role": [{"$group": {"_id": "$role", "count": {"$sum": 1}}}],
+            "profiles_completed": [{"$match": {"profile_completed": True}}, {"$count": "count"}],
+            # Linked patients (with therapist)
+            "linked_patients": [
+                {"$match": {"role": "patient", "linked_therapist_id": {"$ne": None}}},
+                {"$count": "count"}
+            ]
+        }}]).to_list(1),
+        "emotional_logs": db.emotional_logs.aggregate([{"$facet": {
+            "total": [{"$count": "count"}],
+            "mood": [{"$group": {"_id": None, "avg_mood": {"$avg": "$mood_scale"}}}]
+        }}]).to_list(1),
+        "total_habits": db.habits.count_documents({"is_active": True}),
+        "total_relapses": db.relapses.count_documents({}),
+        # Active users: anyone who logged an emotion or a habit in the window
+        "active_emotional": active_user_ids("emotional_logs", active_since),
+        "active_habits": active_user_ids("habit_logs", active_since),
+        "recent_emotional_logs": db.emotional_logs.count_documents({"logged_at": {"$gte": active_since}}),
+        "recent_habit_logs": db.habit_logs.count_documents({"logged_at": {"$gte": active_since}}),
+        "push_tokens": db.push_tokens.count_documents({})
+    }
+    # A snapshot with silently zeroed counters is worse than the previous one
+    results = await fan_out(queries, required=tuple(queries), timeout=ADMIN_STATS_QUERY_TIMEOUT)
     
-    # Average mood (last 7 days)
-    pipeline = [
-        {"$group": {"_id": None, "avg_mood": {"$avg": "$mood_scale"}}}
-    ]
-    mood_result = await db.emotional_logs.aggregate(pipeline).to_list(1)
+    profiles = results["profiles"][0] if results["profiles"] else {}
+    by_role = {row["_id"]: row["count"] for row in profiles.get("by_role", [])}
+    emotional = results["emotional_logs"][0] if results["emotional_logs"] else {}
+    mood = emotional.get("mood") or []
     avg_mood = 0
-    if mood_result and mood_result[0].get("avg_mood") is not None:
-        avg_mood = round(mood_result[0]["avg_mood"], 1)
-    
-    # Registrations over time (last 30 days) - simplified
-    # We'll estimate based on user_id patterns
+    if mood and mood[0].get("avg_mood") is not None:
+        avg_mood = round(mood[0]["avg_mood"], 1)
     
-    return {
+    platform = {
         "users": {
-            "total": total_users,
-            "patients": total_patients,
-            "professionals": total_professionals,
-            "admins": total_admins,
-            "active": active_users,
-            "profiles_completed": profiles_completed
+            "total": results["total_users"],
+            "patients": by_role.get("patient", 0),
+            "professionals": by_role.get("professional", 0),
+            "admins": by_role.get("admin", 0),
+            "active": len(set(results["active_emotional"]) | set(results["active_habits"])),
+            "profiles_completed": facet_count(profiles, "profiles_completed")
         },
         "engagement": {
-            "total_habits": total_habits,
-            "total_emotional_logs": total_emotional_logs,
-            "total_relapses": total_relapses,
-            "linked_patients": linked_patients,
+            "total_habits": results["total_habits"],
+            "total_emotional_logs": facet_count(emotional, "total"),
+            "total_relapses": results["total_relapses"],
+            "linked_patients": facet_count(profiles, "linked_patients"),
             "avg_mood": avg_mood
         },
-        "timestamp": today.isoformat()
+        "timestamp": now.isoformat()
     }
+    summary = {
+        "success": True,
+        "stats": {
+            "total_users": results["total_users"],
+            "by_role": {
+                "patients": by_role.get("patient", 0),
+                "professionals": by_role.get("professional", 0),
+                "active_users": by_role.get("active_user", 0),
+                "family": by_role.get("family", 0)
+            },
+            "activity_last_7_days": {
+                "emotional_logs": results["recent_emotional_logs"],
+                "habit_logs": results["recent_habit_logs"]
+            },
+            "push_tokens_registered": results["push_tokens"]
+        },
+        "timestamp": now.isoformat()
+    }
+    return {"platform": platform, "summary": summary}
+
+async def refresh_admin_stats() -> dict:
+    """Recompute the platform stats and store them as the admin_stats snapshot"""
+    started = time.perf_counter()
+    views = await compute_admin_stats()
+    await db.admin_stats.replace_one(
+        {"_id": ADMIN_STATS_SNAPSHOT_ID},
+        {"views": views, "computed_at": datetime.now(timezone.utc)},
+        upsert=True
+    )
+    admin_stats_refresh_stats["runs"] += 1
+    admin_stats_refresh_stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+    admin_stats_refresh_stats["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return views
+
+def admin_stats_snapshot_age(snapshot: Optional[dict]) -> Optional[float]:
+    """Seconds since the snapshot was computed (None without a snapshot)"""
+    if not snapshot or not snapshot.get("computed_at"):
+        return None
+    computed_at = snapshot["computed_at"]
+    if computed_at.tzinfo is None:
+        computed_at = computed_at.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - computed_at).total_seconds()
+
+async def get_admin_stats_snapshot(max_age: int = ADMIN_STATS_MAX_AGE) -> dict:
+    """Stored stats views, recomputed when missing, outdated or older than max_age seconds"""
+    snapshot = await db.admin_stats.find_one({"_id": ADMIN_STATS_SNAPSHOT_ID})
+    age = admin_stats_snapshot_age(snapshot)
+    if age is not None and age < max_age and set(snapshot.get("views") or {}) >= set(ADMIN_VIEWS):
+        return snapshot["views"]
+    return await refresh_admin_stats()
+
+async def admin_stats_loop():
+    """Background task: keep the admin_stats snapshot fresh.
+    
+    Every worker runs the loop; a worker skips its turn when another one
+    refreshed the snapshot within the interval.
+    """
+    while True:
+        try:
+            snapshot = await db.admin_stats.find_one({"_id": ADMIN_STATS_SNAPSHOT_ID}, {"computed_at": 1})
+            age = admin_stats_snapshot_age(snapshot)
+            if age is not None and age < ADMIN_STATS_REFRESH_INTERVAL:
+                admin_stats_refresh_stats["skipped"] += 1
+            else:
+                await refresh_admin_stats()
+        except Exception as e:
+            admin_stats_refresh_stats["errors"] += 1
+            admin_stats_refresh_stats["last_error"] = str(e)
+            print(f"Admin stats refresh error: {e}")
+        await asyncio.sleep(ADMIN_STATS_REFRESH_INTERVAL)
+
+@app.get("/api/admin/stats")
+async def get_admin_stats(current_user: User = Depends(get_current_user), view: str = "platform"):
+    """Get global platform statistics - Admin only (from the admin_stats snapshot).
+    
+    view=platform: totals and engagement; view=summary: users by role and
+    activity in the last 7 days.
+    """
+    require_admin_view(view)
+    if not await is_admin(current_user):
+        raise HTTPException(status_code=403, detail="Acceso solo para administradores")
+    
+    views = await get_admin_stats_snapshot()
+    return views[view]
+
+# ---- Admin user directory ----
+
+# Per-user activity counters kept on the profile (activity_counts.<name>) so
+# the directory never counts logs per row. Maintained on write; profiles
+# without them are backfilled when first listed.
+ACTIVITY_COUNTERS = ("emotional_logs", "habits")
+
+# ?sort= values of the directory -> field of the joined document
+ADMIN_USER_SORTS = {
+    "joined": None,  # profile _id, i.e. profile creation order
+    "name": "user.name",  # case-insensitive
+    "email": "user.email",  # case-insensitive
+    "created_at": "user.created_at",
+    "role": "role",
+    "emotional_logs": "activity_counts.emotional_logs",
+    "habits": "activity_counts.habits"
+}
+
+# Sort value of rows where the field is null or missing: the sort key is
+# coalesced so that a cursor never holds null (nothing compares after null)
+ADMIN_USER_SORT_DEFAULTS = {
+    "name": "",
+    "email": "",
+    "created_at": datetime(1970, 1, 1, tzinfo=timezone.utc),
+    "role": "",
+    "emotional_logs": 0,
+    "habits": 0
+}
+
+async def inc_activity_counter(user_id: str, counter: str, amount: int = 1):
+    """Adjust one activity counter; profiles not backfilled yet are left alone"""
+    await db.user_profiles.update_one(
+        {"user_id": user_id, "activity_counts": {"$exists": True}},
+        {"$inc": {f"activity_counts.{counter}": amount}}
+    )
+
+async def refresh_activity_counters(user_ids: list) -> dict:
+    """Recount activity for users (one $group per collection) and store it: user_id -> counts"""
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return {}
+    loaders = RequestLoaders(db)
+    emotional_counts, habit_counts = await asyncio.gather(
+        loaders.count_by_user("emotional_logs", user_ids),
+        loaders.count_by_user("habits", user_ids, {"is_active": True})
+    )
+    counts = {
+        user_id: {"emotional_logs": emotional_counts[user_id], "habits": habit_counts[user_id]}
+        for user_id in user_ids
+    }
+    await db.user_profiles.bulk_write([
+        UpdateOne({"user_id": user_id}, {"$set": {"activity_counts": user_counts}})
+        for user_id, user_counts in counts.items()
+    ], ordered=False)
+    return counts
+
+async def rebuild_activity_counters(batch_size: int = 500) -> int:
+    """Recount the activity counters of every profile; returns profiles processed"""
+    processed = 0
+    batch = []
+    async for profile in db.user_profiles.find({}, {"_id": 0, "user_id": 1}):
+        if not profile.get("user_id"):
+            continue
+        batch.append(profile["user_id"])
+        if len(batch) >= batch_size:
+            await refresh_activity_counters(batch)
+            processed += len(batch)
+            batch = []
+    if batch:
+        await refresh_activity_counters(batch)
+        processed += len(batch)
+    return processed
 
 @app.get("/api/admin/users")
 async def get_admin_users(
     current_user: User = Depends(get_current_user),
     role: str = None,
+    search: Optional[str] = None,
+    sort: str = "joined",
+    order: str = "desc",
     limit: int = 50,
-    skip: int = 0
+    cursor: Optional[str] = None,
+    view: str = "platform"
 ):
-    """Get all users - Admin only"""
+    """Get all users - Admin only.
+    
+    One aggregation per page: profiles joined with users ($lookup), optional
+    name/email search, sorting by any ADMIN_USER_SORTS key and keyset
+    pagination, with the filtered total computed in the same $facet. Without
+    a search and sorting by a profile field, the page is cut first and only
+    its rows are joined, with the total from count_documents. Pages are
+    keyed on sort_key, the sort field with ADMIN_USER_SORT_DEFAULTS in place
+    of null or missing values.
+    view=platform returns full rows with activity stats, view=summary a
+    compact row per user.
+    """
+    require_admin_view(view)
     if not await is_admin(current_user):
         raise HTTPException(status_code=403, detail="Acceso solo para administradores")
+    if sort not in ADMIN_USER_SORTS:
+        raise HTTPException(status_code=400, detail=f"Orden inválido. Opciones: {', '.join(ADMIN_USER_SORTS)}")
+    
+    sort_field = ADMIN_USER_SORTS[sort]
+    descending = order != "asc"
+    direction = -1 if descending else 1
+    limit = max(1, min(limit, PAGE_SIZE_MAX))
     
     # Build filter
     profile_filter = {}
     if role:
         profile_filter["role"] = role
     
-    # Get profiles with filter
-    profiles = await db.user_profiles.find(
-        profile_filter,
-        {"_id": 0}
-    ).skip(skip).limit(limit).to_list(limit)
+    join_user = {"$lookup": {
+        "from": "users",
+        "localField": "user_id",
+        "foreignField": "user_id",
+        "as": "user"
+    }}
+    hide_user_fields = {"$project": {"user._id": 0, "user.password_hash": 0}}
+    
+    page = []
+    if sort_field:
+        sort_key = {"$ifNull": [f"${sort_field}", ADMIN_USER_SORT_DEFAULTS[sort]]}
+        if sort in ("name", "email"):
+            sort_key = {"$toLower": sort_key}
+        page.append({"$addFields": {"sort_key": sort_key}})
+    if cursor:
+        page.append({"$match": keyset_filter(cursor, "sort_key" if sort_field else None, descending)})
+    page += [
+        {"$sort": dict(([("sort_key", direction)] if sort_field else []) + [("_id", direction)])},
+        {"$limit": limit + 1}
+    ]
     
-    # Enrich with user data
-    users = []
-    for profile in profiles:
-        user = await db.users.find_one(
-            {"user_id": profile["user_id"]},
-            {"_id": 0}
+    if not search and not (sort_field or "").startswith("user."):
+        # Page on the profiles alone, then join users for the page rows only.
+        # Rows are kept through the join so the cursor is taken from the
+        # profile page; profiles without a user are dropped afterwards.
+        profiles, total = await asyncio.gather(
+            db.user_profiles.aggregate([
+                {"$match": profile_filter},
+                *page,
+                join_user,
+                {"$unwind": {"path": "$user", "preserveNullAndEmptyArrays": True}},
+                hide_user_fields
+            ]).to_list(None),
+            db.user_profiles.count_documents(profile_filter)
         )
-        if user:
-            # Count activity
-            emotional_count = await db.emotional_logs.count_documents({"user_id": profile["user_id"]})
-            habit_count = await db.habits.count_documents({"user_id": profile["user_id"], "is_active": True})
-            
-            users.append({
-                "user_id": profile["user_id"],
-                "name": user.get("name"),
-                "email": user.get("email"),
-                "picture": user.get("picture"),
-                "role": profile.get("role", "patient"),
-                "profile_completed": profile.get("profile_completed", False),
-                "clean_since": profile.get("clean_since"),
-                "addiction_type": profile.get("addiction_type"),
-                "professional_type": profile.get("professional_type"),
-                "linked_therapist_id": profile.get("linked_therapist_id"),
-                "created_at": user.get("created_at"),
-                "stats": {
-                    "emotional_logs": emotional_count,
-                    "habits": habit_count
+    else:
+        pipeline = [
+            {"$match": profile_filter},
+            join_user,
+            {"$unwind": "$user"}
+        ]
+        if search:
+            pattern = {"$regex": re.escape(search.strip()), "$options": "i"}
+            pipeline.append({"$match": {"$or": [{"user.name": pattern}, {"user.email": pattern}]}})
+        pipeline.append({"$facet": {"page": page + [hide_user_fields], "total": [{"$count": "count"}]}})
+        
+        result = (await db.user_profiles.aggregate(pipeline).to_list(1) or [{}])[0]
+        profiles = result.get("page", [])
+        total = result["total"][0]["count"] if result.get("total") else 0
+    
+    next_cursor = None
+    if len(profiles) > limit:
+        profiles = profiles[:limit]
+        last = profiles[-1]
+        next_cursor = encode_cursor(last.get("sort_key"), last["_id"])
+    profiles = [profile for profile in profiles if profile.get("user")]
+    
+    if view == "summary":
+        return {
+            "success": True,
+            "users": [
+                {
+                    "user_id": profile["user_id"],
+                    "name": profile["user"].get("name"),
+                    "email": profile["user"].get("email"),
+                    "role": profile.get("role"),
+                    "days_clean": profile.get("days_clean"),
+                    "created_at": profile["user"].get("created_at"),
+                    "onboarding_completed": profile.get("onboarding_completed")
                 }
-            })
+                for profile in profiles
+            ],
+            "total": total,
+            "next_cursor": next_cursor
+        }
     
-    total = await db.user_profiles.count_documents(profile_filter)
+    # Profiles listed before their counters existed get them now
+    missing = [profile["user_id"] for profile in profiles if "activity_counts" not in profile]
+    backfilled = await refresh_activity_counters(missing)
+    
+    users = []
+    for profile in profiles:
+        user = profile["user"]
+        counts = profile.get("activity_counts") or backfilled.get(profile["user_id"], {})
+        users.append({
+            "user_id": profile["user_id"],
+            "name": user.get("name"),
+            "email": user.get("email"),
+            "picture": user.get("picture"),
+            "role": profile.get("role", "patient"),
+            "profile_completed": profile.get("profile_completed", False),
+            "clean_since": profile.get("clean_since"),
+            "addiction_type": profile.get("addiction_type"),
+            "professional_type": profile.get("professional_type"),
+            "linked_therapist_id": profile.get("linked_therapist_id"),
+            "created_at": user.get("created_at"),
+            "stats": {counter: counts.get(counter, 0) for counter in ACTIVITY_COUNTERS}
+        })
     
     return {
         "users": users,
         "total": total,
         "limit": limit,
-        "skip": skip
+        "next_cursor": next_cursor
     }
 
 @app.get("/api/admin/activity")
-async def get_admin_activity(current_user: User = Depends(get_current_user)):
+async def get_admin_activity(
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_loaders)
+):
     """Get recent platform activity - Admin only"""
     if not await is_admin(current_user):
         raise HTTPException(status_code=403, detail="Acceso solo para administradores")
@@ -1581,8 +3024,18 @@ async def get_admin_activity(current_user: User = Depends(get_current_user)):
         {"_id": 0}
     ).sort("date", -1).limit(20).to_list(20)
     
+    # Recent relapses
+    recent_relapses = await db.relapses.find(
+        {},
+        {"_id": 0}
+    ).sort("reported_at", -1).limit(10).to_list(10)
+    
+    users = await loaders.users.load_many(
+        [log["user_id"] for log in recent_logs] + [relapse["user_id"] for relapse in recent_relapses]
+    )
+    
     for log in recent_logs:
-        user = await db.users.find_one({"user_id": log["user_id"]}, {"name": 1, "_id": 0})
+        user = users[log["user_id"]]
         activity.append({
             "type": "emotional_log",
             "user_id": log["user_id"],
@@ -1592,14 +3045,8 @@ async def get_admin_activity(current_user: User = Depends(get_current_user)):
             "icon": "heart"
         })
     
-    # Recent relapses
-    recent_relapses = await db.relapses.find(
-        {},
-        {"_id": 0}
-    ).sort("reported_at", -1).limit(10).to_list(10)
-    
     for relapse in recent_relapses:
-        user = await db.users.find_one({"user_id": relapse["user_id"]}, {"name": 1, "_id": 0})
+        user = users[relapse["user_id"]]
         activity.append({
             "type": "relapse",
             "user_id": relapse["user_id"],
@@ -1614,6 +3061,40 @@ async def get_admin_activity(current_user: User = Depends(get_current_user)):
     
     return activity[:30]
 
+@app.get("/api/admin/indexes")
+async def get_admin_indexes(recheck: bool = False, current_user: User = Depends(get_current_user)):
+    """Report of the last index reconciliation (created, drifted, unmanaged) - Admin only"""
+    if not await is_admin(current_user):
+        raise HTTPException(status_code=403, detail="Acceso solo para administradores")
+    
+    if recheck:
+        await ensure_indexes()
+    
+    return index_report
+
+@app.get("/api/admin/metrics")
+async def get_admin_metrics(current_user: User = Depends(get_current_user)):
+    """In-process performance counters (caches, background jobs) - Admin only"""
+    if not await is_admin(current_user):
+        raise HTTPException(status_code=403, detail="Acceso solo para administradores")
+    
+    return {
+        "session_cache": session_cache.stats(),
+        "sessions": {**session_maintenance_stats, "pending_renewals": len(pending_session_renewals)},
+        "alert_scan": alert_scan_stats,
+        "fanout": fanout_stats,
+        "dashboard_cache": dashboard_cache.stats(),
+        "admin_stats": admin_stats_refresh_stats,
+        "llm": llm_gateway.stats,
+        "llm_cache": llm_cache.info(),
+        "nelson_context": {**nelson_context_stats, "pending_refreshes": len(nelson_context_pending)},
+        "outbound_http": outbound_http.stats(),
+        "push": push_dispatcher.stats,
+        "push_outbox": {**push_outbox.stats, "queue": await push_outbox.queue_depth()},
+        "reminders": reminder_stats,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
 @app.post("/api/admin/set-role")
 async def admin_set_user_role(
     user_id: str,
@@ -1635,8 +3116,324 @@ async def admin_set_user_role(
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     
+    session_cache.invalidate_user(user_id)
+    invalidate_dashboard(user_id)
+    
     return {"success": True, "message": f"Rol actualizado a {new_role}"}
 
+# ============== HABIT STREAKS ==============
+
+# Counters materialized on every habit document and maintained by log_habit
+HABIT_COUNTER_FIELDS = ("current_streak", "longest_streak", "last_completed_date", "total_completions")
+
+def calculate_streaks(completed_dates, today: Optional[str] = None) -> dict:
+    """Streak counters from the YYYY-MM-DD dates on which a habit was completed.
+    
+    With today given, current_streak counts consecutive completed days ending
+    today (0 if today is not completed yet) and later dates are ignored.
+    Without it, current_streak is the run ending at last_completed_date,
+    which is what gets stored on the habit document.
+    """
+    dates = sorted(d for d in set(completed_dates) if d and (today is None or d <= today))
+    
+    longest = 0
+    run = 0
+    previous = None
+    for date_str in dates:
+        try:
+            day = datetime.strptime(date_str, "%Y-%m-%d").date()
+        except ValueError:
+            continue
+        run = run + 1 if previous is not None and (day - previous).days == 1 else 1
+        longest = max(longest, run)
+        previous = day
+    
+    last_completed_date = dates[-1] if dates else None
+    completed_today = last_completed_date is not None and last_completed_date == today
+    return {
+        "current_streak": run if completed_today or today is None else 0,
+        "longest_streak": longest,
+        "last_completed_date": last_completed_date,
+        "completed_today": completed_today,
+        "total_completions": len(dates)
+    }
+
+def streak_from_counters(habit: dict, today: str) -> dict:
+    """Streak view of a habit document's materialized counters as of today"""
+    last_completed_date = habit.get("last_completed_date")
+    completed_today = last_completed_date == today
+    return {
+        "current_streak": habit.get("current_streak", 0) if completed_today else 0,
+        "longest_streak": habit.get("longest_streak", 0),
+        "last_completed_date": last_completed_date,
+        "completed_today": completed_today,
+        "total_completions": habit.get("total_completions", 0)
+    }
+
+async def refresh_habit_counters(habit_ids: list) -> dict:
+    """Recompute the materialized counters of habits from habit_logs.
+    
+    One query for the completed logs of all habits, one bulk write to store
+    the counters. Returns habit_id -> counters.
+    """
+    if not habit_ids:
+        return {}
+    
+    logs = await db.habit_logs.find(
+        {"habit_id": {"$in": habit_ids}, "completed": True},
+        {"_id": 0, "habit_id": 1, "date": 1}
+    ).to_list(None)
+    
+    dates_by_habit = {habit_id: [] for habit_id in habit_ids}
+    for log in logs:
+        dates_by_habit[log["habit_id"]].append(log.get("date"))
+    
+    counters = {}
+    for habit_id, dates in dates_by_habit.items():
+        streaks = calculate_streaks(dates)
+        counters[habit_id] = {field: streaks[field] for field in HABIT_COUNTER_FIELDS}
+    
+    await db.habits.bulk_write(
+        [UpdateOne({"habit_id": habit_id}, {"$set": values}) for habit_id, values in counters.items()],
+        ordered=False
+    )
+    return counters
+
+async def update_habit_counters(habit_id: str, date: str, completed: bool, was_completed: bool):
+    """Keep a habit's counters in step with a write to one of its logs.
+    
+    Completing a day after last_completed_date (the normal "log today" case)
+    is applied incrementally; backfilled dates, un-completing a day and
+    habits without counters yet are recomputed from habit_logs.
+    """
+    if completed == was_completed:
+        return
+    
+    habit = await db.habits.find_one(
+        {"habit_id": habit_id},
+        {"_id": 0, **{field: 1 for field in HABIT_COUNTER_FIELDS}}
+    )
+    
+    if completed and habit and "total_completions" in habit:
+        last_completed_date = habit.get("last_completed_date")
+        if last_completed_date is None or date > last_completed_date:
+            try:
+                gap = (datetime.strptime(date, "%Y-%m-%d") - datetime.strptime(last_completed_date, "%Y-%m-%d")).days if last_completed_date else None
+            except ValueError:
+                gap = None
+            current_streak = habit.get("current_streak", 0) + 1 if gap == 1 else 1
+            
+            # Only applies if no other write moved the counters in the meantime
+            result = await db.habits.update_one(
+                {
+                    "habit_id": habit_id,
+                    "last_completed_date": last_completed_date,
+                    "total_completions": habit["total_completions"]
+                },
+                {
+                    "$set": {"current_streak": current_streak, "last_completed_date": date},
+                    "$max": {"longest_streak": current_streak},
+                    "$inc": {"total_completions": 1}
+                }
+            )
+            if result.modified_count:
+                return
+    
+    await refresh_habit_counters([habit_id])
+
+async def get_habit_streaks(habits: list, today: Optional[str] = None) -> dict:
+    """Streaks for many habits at once: habit_id -> streak info.
+    
+    Read from the counters on the habit documents; habits that predate the
+    counters are computed in one query and backfilled on the way.
+    """
+    today = today or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    
+    streaks = {}
+    missing = []
+    for habit in habits:
+        if "total_completions" in habit:
+            streaks[habit["habit_id"]] = streak_from_counters(habit, today)
+        else:
+            missing.append(habit["habit_id"])
+    
+    for habit_id, counters in (await refresh_habit_counters(missing)).items():
+        streaks[habit_id] = streak_from_counters(counters, today)
+    
+    return streaks
+
+async def rebuild_habit_counters(batch_size: int = 500) -> int:
+    """Recompute the counters of every habit from habit_logs (repair job)"""
+    rebuilt = 0
+    batch = []
+    async for habit in db.habits.find({}, {"_id": 0, "habit_id": 1}):
+        batch.append(habit["habit_id"])
+        if len(batch) >= batch_size:
+            rebuilt += len(await refresh_habit_counters(batch))
+            batch = []
+    rebuilt += len(await refresh_habit_counters(batch))
+    return rebuilt
+
+# ============== DAILY ROLLUPS ==============
+
+# One user_daily_rollups document per user per day, kept up to date by the
+# habit/emotion/relapse writes so the analytics endpoints read 7-30 small
+# documents instead of every raw log in the window.
+
+def relapse_date(relapse: dict) -> Optional[str]:
+    """Day a relapse belongs to (explicit date, or the day it was reported)"""
+    if relapse.get("date"):
+        return relapse["date"]
+    reported_at = relapse.get("reported_at")
+    return reported_at.strftime("%Y-%m-%d") if isinstance(reported_at, datetime) else None
+
+def empty_daily_rollup(habits_total: int) -> dict:
+    """Rollup fields of a day with nothing logged"""
+    return {
+        "habits_completed": 0,
+        "habits_logged": 0,
+        "habits_total": habits_total,
+        "habit_status": {},
+        "mood": None,
+        "tags": [],
+        "note": None,
+        "craving": None,
+        "relapse": False
+    }
+
+def build_daily_rollups(habit_logs: list, emotional_logs: list, relapses: list, habits_total: int) -> dict:
+    """Fold raw logs into rollup fields per date: date -> rollup fields"""
+    rollups = {}
+    
+    def day(date):
+        return rollups.setdefault(date, empty_daily_rollup(habits_total))
+    
+    for log in habit_logs:
+        if not log.get("date"):
+            continue
+        rollup = day(log["date"])
+        rollup["habits_logged"] += 1
+        rollup["habit_status"][log["habit_id"]] = bool(log.get("completed"))
+        if log.get("completed"):
+            rollup["habits_completed"] += 1
+    
+    for log in emotional_logs:
+        if not log.get("date"):
+            continue
+        rollup = day(log["date"])
+        mood = log.get("mood_scale")
+        rollup["mood"] = log.get("mood") if mood is None else mood
+        rollup["tags"] = log.get("tags") or log.get("emotions") or []
+        rollup["note"] = log.get("note")
+        rollup["craving"] = log.get("craving_intensity")
+    
+    for relapse in relapses:
+        date = relapse_date(relapse)
+        if date:
+            day(date)["relapse"] = True
+    
+    return rollups
+
+async def refresh_daily_rollup(user_id: str, date: str):
+    """Recompute one user's rollup for one day from the raw collections"""
+    try:
+        day_start = datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    except (ValueError, TypeError):
+        return
+    
+    habit_logs, emotional_log, relapse, habits_total = await asyncio.gather(
+        db.habit_logs.find(
+            {"user_id": user_id, "date": date},
+            {"_id": 0, "habit_id": 1, "date": 1, "completed": 1}
+        ).to_list(None),
+        db.emotional_logs.find_one({"user_id": user_id, "date": date}, {"_id": 0}),
+        db.relapses.find_one({
+            "user_id": user_id,
+            "$or": [
+                {"date": date},
+                {"reported_at": {"$gte": day_start, "$lt": day_start + timedelta(days=1)}}
+            ]
+        }, {"_id": 0}),
+        db.habits.count_documents({"user_id": user_id, "is_active": True})
+    )
+    
+    fields = build_daily_rollups(
+        habit_logs,
+        [emotional_log] if emotional_log else [],
+        [{"date": date}] if relapse else [],
+        habits_total
+    ).get(date, empty_daily_rollup(habits_total))
+    
+    await db.user_daily_rollups.update_one(
+        {"user_id": user_id, "date": date},
+        {"$set": {**fields, "updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+# Users whose rollups are known to cover their history (in this process)
+rollups_backfilled = set()
+
+async def ensure_daily_rollups(user_id: str):
+    """Backfill a user's rollups the first time they are read.
+    
+    Users that predate user_daily_rollups only have rollups for the days they
+    logged since; the profile's rollups_backfilled flag marks the ones whose
+    whole history has been rebuilt.
+    """
+    if user_id in rollups_backfilled:
+        return
+    profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0, "rollups_backfilled": 1})
+    if not (profile or {}).get("rollups_backfilled"):
+        await backfill_daily_rollups([user_id])
+    rollups_backfilled.add(user_id)
+
+async def get_daily_rollups(user_id: str, start_date: str, end_date: Optional[str] = None) -> list:
+    """Rollups of a user between two dates (inclusive), oldest first"""
+    await ensure_daily_rollups(user_id)
+    date_range = {"$gte": start_date}
+    if end_date:
+        date_range["$lte"] = end_date
+    return await db.user_daily_rollups.find(
+        {"user_id": user_id, "date": date_range},
+        {"_id": 0}
+    ).sort("date", 1).to_list(None)
+
+async def backfill_daily_rollups(user_ids: Optional[list] = None) -> int:
+    """Rebuild user_daily_rollups from habit_logs, emotional_logs and relapses.
+    
+    Processes one user at a time (all users with any log unless user_ids is
+    given), flags each profile as rollups_backfilled and returns the number
+    of rollup documents written.
+    """
+    if user_ids is None:
+        user_ids = set(await db.habit_logs.distinct("user_id"))
+        user_ids |= set(await db.emotional_logs.distinct("user_id"))
+        user_ids |= set(await db.relapses.distinct("user_id"))
+    
+    written = 0
+    now = datetime.now(timezone.utc)
+    for user_id in user_ids:
+        habit_logs, emotional_logs, relapses, habits_total = await asyncio.gather(
+            db.habit_logs.find({"user_id": user_id}, {"_id": 0, "habit_id": 1, "date": 1, "completed": 1}).to_list(None),
+            db.emotional_logs.find({"user_id": user_id}, {"_id": 0}).to_list(None),
+            db.relapses.find({"user_id": user_id}, {"_id": 0, "date": 1, "reported_at": 1}).to_list(None),
+            db.habits.count_documents({"user_id": user_id, "is_active": True})
+        )
+        rollups = build_daily_rollups(habit_logs, emotional_logs, relapses, habits_total)
+        if rollups:
+            await db.user_daily_rollups.bulk_write([
+                UpdateOne(
+                    {"user_id": user_id, "date": date},
+                    {"$set": {**fields, "updated_at": now}},
+                    upsert=True
+                )
+                for date, fields in rollups.items()
+            ], ordered=False)
+            written += len(rollups)
+        await db.user_profiles.update_one({"user_id": user_id}, {"$set": {"rollups_backfilled": True}})
+        rollups_backfilled.add(user_id)
+    return written
+
 # ============== HABIT ENDPOINTS ==============
 
 @app.get("/api/habits")
@@ -1646,35 +3443,14 @@ async def get_habits(current_user: User = Depends(get_current_user)):
         {"_id": 0}
     ).sort("created_at", -1).to_list(100)
     
-    # Calculate streaks for each habit
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    # Streaks come from the counters kept on each habit
+    streaks = await get_habit_streaks(habits)
     
     for habit in habits:
-        # Get logs for this habit
-        logs = await db.habit_logs.find(
-            {"habit_id": habit["habit_id"], "completed": True},
-            {"_id": 0}
-        ).sort("date", -1).to_list(365)
-        
-        # Calculate streak
-        streak = 0
-        check_date = datetime.now(timezone.utc)
-        
-        for log in logs:
-            if log["date"] == check_date.strftime("%Y-%m-%d"):
-                streak += 1
-                check_date = check_date - timedelta(days=1)
-            else:
-                break
-        
-        habit["streak"] = streak
-        
-        # Check if completed today
-        today_log = await db.habit_logs.find_one(
-            {"habit_id": habit["habit_id"], "date": today},
-            {"_id": 0}
-        )
-        habit["completed_today"] = today_log["completed"] if today_log else False
+        habit_streak = streaks[habit["habit_id"]]
+        habit["streak"] = habit_streak["current_streak"]
+        habit["longest_streak"] = habit_streak["longest_streak"]
+        habit["completed_today"] = habit_streak["completed_today"]
     
     return habits
 
@@ -1691,10 +3467,16 @@ async def create_habit(habit_data: dict, current_user: User = Depends(get_curren
         "icon": habit_data.get("icon"),
         "reminder_time": habit_data.get("reminder_time"),
         "created_at": datetime.now(timezone.utc),
-        "is_active": True
+        "is_active": True,
+        "current_streak": 0,
+        "longest_streak": 0,
+        "last_completed_date": None,
+        "total_completions": 0
     }
     
     await db.habits.insert_one(habit)
+    await inc_activity_counter(current_user.user_id, "habits")
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True, "habit_id": habit_id}
 
@@ -1707,6 +3489,9 @@ async def update_habit(habit_id: str, habit_data: dict, current_user: User = Dep
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Habit not found")
+    if "is_active" in habit_data:
+        await refresh_activity_counters([current_user.user_id])
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True}
 
@@ -1719,6 +3504,8 @@ async def delete_habit(habit_id: str, current_user: User = Depends(get_current_u
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Habit not found")
+    await inc_activity_counter(current_user.user_id, "habits", -1)
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True}
 
@@ -1732,16 +3519,22 @@ async def log_habit(habit_id: str, log_data: dict, current_user: User = Depends(
         {"_id": 0}
     )
     
+    completed = log_data.get("completed", True)
+    
     if existing_log:
         # Update existing log
         await db.habit_logs.update_one(
             {"habit_id": habit_id, "user_id": current_user.user_id, "date": date},
             {"$set": {
-                "completed": log_data.get("completed", True),
+                "completed": completed,
                 "note": log_data.get("note"),
                 "logged_at": datetime.now(timezone.utc)
             }}
         )
+        await update_habit_counters(habit_id, date, bool(completed), bool(existing_log.get("completed")))
+        await refresh_daily_rollup(current_user.user_id, date)
+        await resolve_inactivity_alerts(current_user.user_id, date)
+        invalidate_dashboard(current_user.user_id)
         return {"success": True, "log_id": existing_log["log_id"]}
     else:
         # Create new log
@@ -1751,20 +3544,33 @@ async def log_habit(habit_id: str, log_data: dict, current_user: User = Depends(
             "log_id": log_id,
             "habit_id": habit_id,
             "user_id": current_user.user_id,
-            "completed": log_data.get("completed", True),
+            "completed": completed,
             "note": log_data.get("note"),
             "date": date,
             "logged_at": datetime.now(timezone.utc)
         })
+        await update_habit_counters(habit_id, date, bool(completed), False)
+        await refresh_daily_rollup(current_user.user_id, date)
+        await resolve_inactivity_alerts(current_user.user_id, date)
+        invalidate_dashboard(current_user.user_id)
         
         return {"success": True, "log_id": log_id}
 
 @app.get("/api/habits/{habit_id}/logs")
-async def get_habit_logs(habit_id: str, current_user: User = Depends(get_current_user)):
-    logs = await db.habit_logs.find(
+async def get_habit_logs(
+    habit_id: str,
+    response: Response,
+    current_user: User = Depends(get_current_user),
+    limit: int = 365,
+    cursor: Optional[str] = None
+):
+    """Habit logs, newest first; the next page's cursor is in X-Next-Cursor"""
+    logs, next_cursor = await paginate(
+        db.habit_logs,
         {"habit_id": habit_id, "user_id": current_user.user_id},
-        {"_id": 0}
-    ).sort("date", -1).to_list(365)
+        "date", limit, cursor
+    )
+    set_next_cursor(response, next_cursor)
     
     return logs
 
@@ -1794,11 +3600,19 @@ async def get_habits_history(current_user: User = Depends(get_current_user)):
 # ============== EMOTIONAL LOG ENDPOINTS ==============
 
 @app.get("/api/emotional-logs")
-async def get_emotional_logs(current_user: User = Depends(get_current_user)):
-    logs = await db.emotional_logs.find(
+async def get_emotional_logs(
+    response: Response,
+    current_user: User = Depends(get_current_user),
+    limit: int = 365,
+    cursor: Optional[str] = None
+):
+    """Emotional logs, newest first; the next page's cursor is in X-Next-Cursor"""
+    logs, next_cursor = await paginate(
+        db.emotional_logs,
         {"user_id": current_user.user_id},
-        {"_id": 0}
-    ).sort("date", -1).to_list(365)
+        "date", limit, cursor
+    )
+    set_next_cursor(response, next_cursor)
     
     return logs
 
@@ -1823,6 +3637,11 @@ async def create_emotional_log(log_data: dict, current_user: User = Depends(get_
                 "logged_at": datetime.now(timezone.utc)
             }}
         )
+        await refresh_daily_rollup(current_user.user_id, date)
+        await resolve_inactivity_alerts(current_user.user_id, date)
+        if emotion_mood(log_data) <= ALERT_LOW_MOOD:
+            await refresh_patient_alerts(current_user.user_id)
+        invalidate_dashboard(current_user.user_id)
         return {"success": True, "log_id": existing_log["log_id"]}
     else:
         # Create new log
@@ -1837,6 +3656,12 @@ async def create_emotional_log(log_data: dict, current_user: User = Depends(get_
             "date": date,
             "logged_at": datetime.now(timezone.utc)
         })
+        await inc_activity_counter(current_user.user_id, "emotional_logs")
+        await refresh_daily_rollup(current_user.user_id, date)
+        await resolve_inactivity_alerts(current_user.user_id, date)
+        if emotion_mood(log_data) <= ALERT_LOW_MOOD:
+            await refresh_patient_alerts(current_user.user_id)
+        invalidate_dashboard(current_user.user_id)
         
         return {"success": True, "log_id": log_id}
 
@@ -1899,6 +3724,7 @@ async def get_profile(current_user: User = Depends(get_current_user)):
             "updated_at": datetime.now(timezone.utc)
         }
         await db.user_profiles.insert_one(profile_data)
+        invalidate_dashboard(current_user.user_id)
         
         # Return the profile without _id
         profile = await db.user_profiles.find_one(
@@ -1921,6 +3747,7 @@ async def update_profile(profile_data: dict, current_user: User = Depends(get_cu
         # Profile doesn't exist, create it
         profile_data["user_id"] = current_user.user_id
         await db.user_profiles.insert_one(profile_data)
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True}
 
@@ -1948,9 +3775,106 @@ async def update_profile_photo(data: ProfilePhotoRequest, current_user: User = D
             "created_at": datetime.now(timezone.utc),
             "updated_at": datetime.now(timezone.utc)
         })
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True, "message": "Foto de perfil actualizada"}
 
+# ============== DASHBOARD CACHE ==============
+
+# The integrated dashboard is cached per user for the current (UTC) day and
+# dropped by every endpoint that writes one of the collections it reads. The
+# cache is per process: a write handled by another worker is only seen here
+# once the entry's TTL runs out.
+DASHBOARD_CACHE_TTL = int(os.getenv("DASHBOARD_CACHE_TTL", "30"))  # seconds
+DASHBOARD_CACHE_SIZE = int(os.getenv("DASHBOARD_CACHE_SIZE", "10000"))
+
+class DashboardCache:
+    """Bounded LRU cache of user_id -> (date, payload, ETag) with a per-entry TTL"""
+    
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (date, payload, etag, monotonic deadline)
+        self._invalidated_at = OrderedDict()  # user_id -> monotonic time of the last write
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def get(self, user_id: str, date: str) -> Optional[tuple]:
+        """(payload, etag) cached for user_id on date, or None"""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] != date or entry[3] <= time.monotonic():
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1], entry[2]
+    
+    def set(self, user_id: str, date: str, payload: dict, computed_since: float) -> str:
+        """Cache payload and return its ETag.
+        
+        computed_since is the monotonic time the payload started being built;
+        if the user wrote something since then the payload may be stale, so
+        it is returned to the caller but not cached.
+        """
+        etag = dashboard_etag(payload)
+        if self.ttl <= 0 or self._invalidated_at.get(user_id, 0) >= computed_since:
+            return etag
+        self._entries[user_id] = (date, payload, etag, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return etag
+    
+    def invalidate_user(self, user_id: str):
+        self._invalidated_at[user_id] = time.monotonic()
+        self._invalidated_at.move_to_end(user_id)
+        while len(self._invalidated_at) > self.max_size:
+            self._invalidated_at.popitem(last=False)
+        if self._entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+    
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0
+        }
+
+dashboard_cache = DashboardCache(DASHBOARD_CACHE_SIZE, DASHBOARD_CACHE_TTL)
+
+def dashboard_etag(payload: dict) -> str:
+    """Strong ETag over the JSON form of a dashboard payload"""
+    body = json.dumps(payload, sort_keys=True, default=str, ensure_ascii=False)
+    return '"' + hashlib.sha1(body.encode("utf-8")).hexdigest() + '"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Whether an If-None-Match header matches etag (weak comparison)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return etag in [tag[2:] if tag.startswith("W/") else tag for tag in candidates]
+
+def invalidate_dashboard(*user_ids: str):
+    """Drop the cached integrated dashboard of users whose data just changed.
+    
+    The same writes feed Nelson's context, so its snapshots are refreshed too.
+    """
+    for user_id in user_ids:
+        if user_id:
+            dashboard_cache.invalidate_user(user_id)
+    schedule_nelson_context_refresh(*user_ids)
+
 # ============== DASHBOARD STATS ==============
 
 @app.get("/api/dashboard/stats")
@@ -1975,25 +3899,8 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
         {"_id": 0}
     ).to_list(100)
     
-    longest_streak = 0
-    for habit in habits:
-        logs = await db.habit_logs.find(
-            {"habit_id": habit["habit_id"], "completed": True},
-            {"_id": 0}
-        ).sort("date", -1).to_list(365)
-        
-        streak = 0
-        check_date = datetime.now(timezone.utc)
-        
-        for log in logs:
-            if log["date"] == check_date.strftime("%Y-%m-%d"):
-                streak += 1
-                check_date = check_date - timedelta(days=1)
-            else:
-                break
-        
-        if streak > longest_streak:
-            longest_streak = streak
+    streaks = await get_habit_streaks(habits, today)
+    longest_streak = max((streak["current_streak"] for streak in streaks.values()), default=0)
     
     # Get recent mood
     recent_mood = await db.emotional_logs.find(
@@ -2010,16 +3917,79 @@ async def get_dashboard_stats(current_user: User = Depends(get_current_user)):
     }
 
 @app.get("/api/dashboard/integrated")
-async def get_integrated_dashboard(current_user: User = Depends(get_current_user)):
-    """Get comprehensive integrated dashboard data"""
+async def get_integrated_dashboard(request: Request, response: Response, current_user: User = Depends(get_current_user)):
+    """Get comprehensive integrated dashboard data.
+    
+    Served from dashboard_cache while the user's data is unchanged; clients
+    sending the last ETag in If-None-Match get an empty 304 instead. A
+    payload built while some query timed out or failed is returned as is,
+    without caching it or giving it an ETag.
+    """
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    cached = dashboard_cache.get(current_user.user_id, today)
+    if cached is not None:
+        payload, etag = cached
+    else:
+        computed_since = time.monotonic()
+        payload, complete = await build_integrated_dashboard(current_user)
+        if not complete:
+            response.headers["Cache-Control"] = "no-store"
+            return payload
+        etag = dashboard_cache.set(current_user.user_id, today, payload, computed_since)
+    
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return payload
+
+async def build_integrated_dashboard(current_user: User) -> tuple:
+    """Compute the integrated dashboard (sobriety, habits, mood, purpose, alerts).
+    
+    Returns (payload, complete); complete is False when some section was
+    built from a fallback because its query timed out or failed.
+    """
     now = datetime.now(timezone.utc)
     today = now.strftime("%Y-%m-%d")
+    week_ago = (now - timedelta(days=7)).strftime("%Y-%m-%d")
+    
+    # Every section reads independent data: fetch it all concurrently
+    data = await fan_out({
+        "profile": db.user_profiles.find_one(
+            {"user_id": current_user.user_id},
+            {"_id": 0}
+        ),
+        "habits": db.habits.find(
+            {"user_id": current_user.user_id, "is_active": True},
+            {"_id": 0}
+        ).to_list(100),
+        "today_logs": db.habit_logs.find(
+            {"user_id": current_user.user_id, "date": today, "completed": True},
+            {"_id": 0}
+        ).to_list(100),
+        "emotional_logs": db.emotional_logs.find(
+            {"user_id": current_user.user_id, "date": {"$gte": week_ago}},
+            {"_id": 0}
+        ).sort("date", 1).to_list(7),
+        "last_emotional": db.emotional_logs.find(
+            {"user_id": current_user.user_id},
+            {"_id": 0}
+        ).sort("date", -1).limit(1).to_list(1),
+        "purpose_test": db.purpose_tests.find(
+            {"user_id": current_user.user_id},
+            {"_id": 0}
+        ).sort("completed_at", -1).limit(1).to_list(1),
+        "goals": db.purpose_goals.find(
+            {"user_id": current_user.user_id},
+            {"_id": 0}
+        ).to_list(100)
+    }, defaults={
+        "habits": [], "today_logs": [], "emotional_logs": [],
+        "last_emotional": [], "purpose_test": [], "goals": []
+    })
     
     # ============== SOBRIEDAD ==============
-    profile = await db.user_profiles.find_one(
-        {"user_id": current_user.user_id},
-        {"_id": 0}
-    )
+    profile = data["profile"]
     
     days_clean = 0
     clean_since = None
@@ -2052,48 +4022,20 @@ async def get_integrated_dashboard(current_user: User = Depends(get_current_user
             break
     
     # ============== HÁBITOS ==============
-    habits = await db.habits.find(
-        {"user_id": current_user.user_id, "is_active": True},
-        {"_id": 0}
-    ).to_list(100)
+    habits = data["habits"]
     
     total_habits = len(habits)
     
     # Logs de hoy
-    today_logs = await db.habit_logs.find(
-        {"user_id": current_user.user_id, "date": today, "completed": True},
-        {"_id": 0}
-    ).to_list(100)
+    today_logs = data["today_logs"]
     
     habits_completed_today = len(today_logs)
     habits_completion_rate = round((habits_completed_today / total_habits * 100) if total_habits > 0 else 0, 1)
     
     # Racha más larga y días sin registrar
-    longest_streak = 0
-    last_habit_date = None
-    
-    for habit in habits:
-        logs = await db.habit_logs.find(
-            {"habit_id": habit["habit_id"], "completed": True},
-            {"_id": 0}
-        ).sort("date", -1).to_list(365)
-        
-        if logs:
-            log_date = logs[0]["date"]
-            if not last_habit_date or log_date > last_habit_date:
-                last_habit_date = log_date
-        
-        streak = 0
-        check_date = now
-        for log in logs:
-            if log["date"] == check_date.strftime("%Y-%m-%d"):
-                streak += 1
-                check_date = check_date - timedelta(days=1)
-            else:
-                break
-        
-        if streak > longest_streak:
-            longest_streak = streak
+    streaks = await get_habit_streaks(habits, today)
+    longest_streak = max((streak["current_streak"] for streak in streaks.values()), default=0)
+    last_habit_date = max((streak["last_completed_date"] for streak in streaks.values() if streak["last_completed_date"]), default=None)
     
     # Calcular días sin registrar hábitos
     days_without_habits = 0
@@ -2106,11 +4048,7 @@ async def get_integrated_dashboard(current_user: User = Depends(get_current_user
     
     # ============== EMOCIONAL ==============
     # Últimos 7 días de ánimo
-    week_ago = (now - timedelta(days=7)).strftime("%Y-%m-%d")
-    emotional_logs = await db.emotional_logs.find(
-        {"user_id": current_user.user_id, "date": {"$gte": week_ago}},
-        {"_id": 0}
-    ).sort("date", 1).to_list(7)
+    emotional_logs = data["emotional_logs"]
     
     mood_data = []
     mood_sum = 0
@@ -2124,10 +4062,7 @@ async def get_integrated_dashboard(current_user: User = Depends(get_current_user
     avg_mood = round(mood_sum / len(emotional_logs), 1) if emotional_logs else 0
     
     # Último registro emocional
-    last_emotional = await db.emotional_logs.find(
-        {"user_id": current_user.user_id},
-        {"_id": 0}
-    ).sort("date", -1).limit(1).to_list(1)
+    last_emotional = data["last_emotional"]
     
     last_emotional_date = last_emotional[0]["date"] if last_emotional else None
     days_without_emotional = 0
@@ -2153,18 +4088,12 @@ async def get_integrated_dashboard(current_user: User = Depends(get_current_user
             mood_trend = "down"
     
     # ============== PROPÓSITO ==============
-    purpose_test = await db.purpose_tests.find(
-        {"user_id": current_user.user_id},
-        {"_id": 0}
-    ).sort("completed_at", -1).limit(1).to_list(1)
+    purpose_test = data["purpose_test"]
     
     purpose_profile = purpose_test[0].get("profile", {}) if purpose_test else None
     
     # Check-ins de propósito (goals)
-    goals = await db.purpose_goals.find(
-        {"user_id": current_user.user_id},
-        {"_id": 0}
-    ).to_list(100)
+    goals = data["goals"]
     
     total_goals = len(goals)
     completed_goals = len([g for g in goals if g.get("status") == "completed"])
@@ -2272,7 +4201,7 @@ async def get_integrated_dashboard(current_user: User = Depends(get_current_user
     # Score general
     overall_score = round((habits_score + emotional_score + purpose_score) / 3, 1)
     
-    return {
+    payload = {
         "sobriety": {
             "days_clean": days_clean,
             "clean_since": clean_since,
@@ -2309,6 +4238,7 @@ async def get_integrated_dashboard(current_user: User = Depends(get_current_user
         "insights": insights,
         "daily_quote": daily_quote
     }
+    return payload, not data.fallbacks
 
 # ============== PURPOSE (SOBRIEDAD CON SENTIDO) ENDPOINTS ==============
 
@@ -2354,6 +4284,7 @@ async def save_purpose_test(test_data: dict, current_user: User = Depends(get_cu
     }
     
     await db.purpose_tests.insert_one(test_record)
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True, "test_id": test_id}
 
@@ -2370,6 +4301,7 @@ async def get_purpose_test(current_user: User = Depends(get_current_user)):
 async def delete_purpose_test(current_user: User = Depends(get_current_user)):
     """Delete all purpose tests for the user to allow retaking the test"""
     result = await db.purpose_tests.delete_many({"user_id": current_user.user_id})
+    invalidate_dashboard(current_user.user_id)
     return {"success": True, "deleted_count": result.deleted_count}
 
 @app.get("/api/purpose/goals")
@@ -2414,6 +4346,7 @@ async def create_purpose_goal(goal_data: dict, current_user: User = Depends(get_
     }
     
     await db.purpose_goals.insert_one(goal)
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True, "goal_id": goal_id}
 
@@ -2494,6 +4427,7 @@ async def toggle_goal_day(goal_id: str, body: dict, current_user: User = Depends
             }
         }
     )
+    invalidate_dashboard(current_user.user_id)
     
     return {
         "success": True,
@@ -2582,6 +4516,7 @@ async def update_purpose_goal(goal_id: str, goal_data: dict, current_user: User
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Goal not found")
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True}
 
@@ -2594,6 +4529,7 @@ async def delete_purpose_goal(goal_id: str, current_user: User = Depends(get_cur
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Goal not found")
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True}
 
@@ -2830,10 +4766,7 @@ async def get_purpose_stats(current_user: User = Depends(get_current_user)):
 @app.get("/api/purpose/ai-analysis")
 async def get_purpose_ai_analysis(current_user: User = Depends(get_current_user)):
     """Generate AI analysis of user's purpose test results and provide personalized recommendations"""
-    from emergentintegrations.llm.chat import LlmChat, UserMessage
-    
-    EMERGENT_LLM_KEY = os.getenv("EMERGENT_LLM_KEY")
-    if not EMERGENT_LLM_KEY:
+    if not llm_gateway.available:
         raise HTTPException(status_code=503, detail="AI service not available")
     
     try:
@@ -2910,15 +4843,12 @@ IMPORTANTE:
 - Usa un tono cálido y esperanzador
 - Responde SOLO con el JSON, sin texto adicional"""
 
-        # Use emergentintegrations library for OpenAI
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"purpose-analysis-{current_user.user_id}",
-            system_message="Eres un experto en psicología positiva y propósito de vida, especializado en ayudar a personas en recuperación de adicciones a encontrar significado y dirección. Responde SIEMPRE en formato JSON válido."
-        ).with_model("openai", "gpt-4o")
-        
-        user_message = UserMessage(text=analysis_prompt)
-        ai_response = await chat.send_message(user_message)
+        ai_response = await llm_gateway.ask(
+            "Eres un experto en psicología positiva y propósito de vida, especializado en ayudar a personas en recuperación de adicciones a encontrar significado y dirección. Responde SIEMPRE en formato JSON válido.",
+            analysis_prompt,
+            user_id=current_user.user_id,
+            purpose="purpose_analysis"
+        )
         
         # Clean response if needed (remove markdown code blocks)
         if ai_response.startswith("```json"):
@@ -2943,6 +4873,7 @@ IMPORTANTE:
             },
             upsert=True
         )
+        schedule_nelson_context_refresh(current_user.user_id)
         
         return {
             "success": True,
@@ -2953,6 +4884,8 @@ IMPORTANTE:
     except json.JSONDecodeError as e:
         print(f"Error parsing AI response: {e}")
         raise HTTPException(status_code=500, detail="Error processing AI analysis")
+    except LLMUnavailableError as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         print(f"Error generating purpose analysis: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -3187,59 +5120,58 @@ async def get_centers():
     
     try:
         # Use a proper browser-like request
-        async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-            response = await client.get(
-                "https://sinadicciones.org/explore-no-map/?type=place&sort=latest",
-                headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-                    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
-                    "Accept-Language": "es-CL,es;q=0.9,en;q=0.8",
-                    "Cache-Control": "no-cache"
-                }
-            )
-            
-            if response.status_code != 200:
-                print(f"Failed to fetch centers: HTTP {response.status_code}")
-                # Return fallback data
-                return {
-                    "centers": FALLBACK_CENTERS, 
-                    "cached": False, 
-                    "fallback": True,
-                    "last_updated": now.isoformat(),
-                    "count": len(FALLBACK_CENTERS)
-                }
-            
-            html = response.text
-            centers = parse_centers_from_html(html)
-            
-            # If parsing failed or got no results, use fallback
-            if not centers:
-                print("No centers parsed from HTML, using fallback data")
-                centers = FALLBACK_CENTERS
-                
-                # Update cache with fallback
-                centers_cache["data"] = centers
-                centers_cache["last_updated"] = now
-                
-                return {
-                    "centers": centers, 
-                    "cached": False,
-                    "fallback": True,
-                    "last_updated": now.isoformat(),
-                    "count": len(centers)
-                }
+        response = await outbound_http.get(
+            "https://sinadicciones.org/explore-no-map/?type=place&sort=latest",
+            headers={
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
+                "Accept-Language": "es-CL,es;q=0.9,en;q=0.8",
+                "Cache-Control": "no-cache"
+            }
+        )
+        
+        if response.status_code != 200:
+            print(f"Failed to fetch centers: HTTP {response.status_code}")
+            # Return fallback data
+            return {
+                "centers": FALLBACK_CENTERS, 
+                "cached": False, 
+                "fallback": True,
+                "last_updated": now.isoformat(),
+                "count": len(FALLBACK_CENTERS)
+            }
+        
+        html = response.text
+        centers = parse_centers_from_html(html)
+        
+        # If parsing failed or got no results, use fallback
+        if not centers:
+            print("No centers parsed from HTML, using fallback data")
+            centers = FALLBACK_CENTERS
             
-            # Update cache with parsed data
+            # Update cache with fallback
             centers_cache["data"] = centers
             centers_cache["last_updated"] = now
             
             return {
                 "centers": centers, 
-                "cached": False, 
+                "cached": False,
+                "fallback": True,
                 "last_updated": now.isoformat(),
                 "count": len(centers)
             }
-            
+        
+        # Update cache with parsed data
+        centers_cache["data"] = centers
+        centers_cache["last_updated"] = now
+        
+        return {
+            "centers": centers, 
+            "cached": False, 
+            "last_updated": now.isoformat(),
+            "count": len(centers)
+        }
+        
     except Exception as e:
         print(f"Error fetching centers: {e}")
         # Return fallback data on any error
@@ -3445,6 +5377,7 @@ async def complete_challenge_and_graduate(current_user: User = Depends(get_curre
             }
         }
     )
+    invalidate_dashboard(user_id)
     
     return {"message": "¡Felicidades! Has completado el reto. Ahora eres un usuario en recuperación.", "new_role": "patient"}
 
@@ -4003,6 +5936,7 @@ async def complete_family_onboarding(data: FamilyOnboardingRequest, current_user
                     "status": "pending",
                     "created_at": datetime.now(timezone.utc)
                 })
+    invalidate_dashboard(user_id)
     
     return {"success": True, "message": "Perfil de familiar completado"}
 
@@ -4134,7 +6068,10 @@ async def get_family_relative_stats(current_user: User = Depends(get_current_use
     }
 
 @app.get("/api/patient/link-requests")
-async def get_patient_link_requests(current_user: User = Depends(get_current_user)):
+async def get_patient_link_requests(
+    current_user: User = Depends(get_current_user),
+    loaders: RequestLoaders = Depends(get_loaders)
+):
     """Get pending link requests for patient (from family members)"""
     
     profile = await db.user_profiles.find_one({"user_id": current_user.user_id})
@@ -4146,10 +6083,16 @@ async def get_patient_link_requests(current_user: User = Depends(get_current_use
         "status": "pending"
     }).to_list(100)
     
+    family_ids = [req["family_user_id"] for req in requests]
+    family_users, family_profiles = await asyncio.gather(
+        loaders.users.load_many(family_ids),
+        loaders.profiles.load_many(family_ids)
+    )
+    
     results = []
     for req in requests:
-        family_user = await db.users.find_one({"user_id": req["family_user_id"]})
-        family_profile = await db.user_profiles.find_one({"user_id": req["family_user_id"]})
+        family_user = family_users[req["family_user_id"]]
+        family_profile = family_profiles[req["family_user_id"]]
         if family_user:
             results.append({
                 "request_id": req["request_id"],
@@ -4195,6 +6138,7 @@ async def respond_to_link_request(data: ApproveRejectRequest, current_user: User
             {"request_id": data.request_id},
             {"$set": {"status": "approved", "responded_at": datetime.now(timezone.utc)}}
         )
+        invalidate_dashboard(request["family_user_id"], current_user.user_id)
         
         return {"success": True, "message": "Familiar vinculado correctamente"}
     else:
@@ -4294,6 +6238,8 @@ async def complete_patient_onboarding(data: PatientOnboardingRequest, current_us
                 "is_active": True
             }
             await db.habits.insert_one(habit)
+    await refresh_activity_counters([user_id])
+    invalidate_dashboard(user_id)
     
     return {"success": True, "message": "Onboarding completado"}
 
@@ -4369,6 +6315,8 @@ async def complete_active_user_onboarding(data: ActiveUserOnboardingRequest, cur
             "created_at": datetime.now(timezone.utc)
         }
         await db.habits.insert_one(habit)
+    await refresh_activity_counters([user_id])
+    invalidate_dashboard(user_id)
     
     return {
         "message": "¡Perfil completado! Tu reto de 21 días ha comenzado.",
@@ -4378,55 +6326,570 @@ async def complete_active_user_onboarding(data: ActiveUserOnboardingRequest, cur
     }
 
 
-# ============== AI WELLNESS ANALYSIS ==============
-from openai import AsyncOpenAI
+# ============== LLM GATEWAY ==============
+# Every AI call goes through llm_gateway: one backend (and connection pool)
+# per process, a global and a per-user concurrency limit, a timeout and
+# jittered retries per call, and token/latency accounting by purpose.
+
+import openai
+import random
+
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4o")
+LLM_BACKEND = os.getenv("LLM_BACKEND")  # emergent | openai | fake; detected from the keys when unset
+LLM_BASE_URL = os.getenv("LLM_BASE_URL")  # OpenAI-compatible endpoint, defaults to api.openai.com
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_MAX_PER_USER = int(os.getenv("LLM_MAX_PER_USER", "2"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "20"))  # seconds waiting for a user or global slot
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))  # seconds per attempt
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))  # seconds, doubled per attempt
 
 # For production: Use EMERGENT_LLM_KEY (priority) or fallback to OPENAI_API_KEY
 EMERGENT_KEY = os.getenv("EMERGENT_LLM_KEY")
 OPENAI_API_KEY = EMERGENT_KEY or os.getenv("OPENAI_API_KEY")
-print(f"AI Key configured: {'EMERGENT' if EMERGENT_KEY else 'OPENAI' if OPENAI_API_KEY else 'No'}")
-
-# Initialize OpenAI client
-openai_client = None
-if OPENAI_API_KEY:
-    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-    print("OpenAI client initialized successfully")
-else:
-    print("WARNING: No OpenAI API key found. AI features will be disabled.")
-
-async def get_openai_client():
-    """Get or create OpenAI client"""
-    global openai_client, OPENAI_API_KEY
-    if openai_client is None:
-        # Try to get the key again (in case it was set after startup)
-        # Priority: EMERGENT_LLM_KEY > OPENAI_API_KEY
-        OPENAI_API_KEY = os.getenv("EMERGENT_LLM_KEY") or os.getenv("OPENAI_API_KEY")
-        if OPENAI_API_KEY:
-            openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-            print("OpenAI client initialized on demand")
-    return openai_client
-
-async def generate_ai_response(system_message: str, user_prompt: str) -> str:
-    """Generate AI response using emergentintegrations"""
-    try:
+EMERGENT_INTEGRATIONS_AVAILABLE = importlib.util.find_spec("emergentintegrations") is not None
+
+class LLMUnavailableError(Exception):
+    """No backend is configured, or a slot stayed busy for LLM_QUEUE_TIMEOUT"""
+
+class LLMError(Exception):
+    """The backend failed after all retries"""
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) for backends that don't report usage"""
+    return max(1, len(text) // 4) if text else 0
+
+def split_messages(messages: list) -> tuple:
+    """(system message, remaining turns as one text) for single-prompt backends"""
+    system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+    turns = [m for m in messages if m["role"] != "system"]
+    if len(turns) == 1:
+        return system, turns[0]["content"]
+    labels = {"user": "Usuario", "assistant": "Asistente"}
+    return system, "\n".join(f"{labels.get(m['role'], m['role'])}: {m['content']}" for m in turns)
+
+def llm_error_retryable(error: Exception) -> bool:
+    """Whether a call that raised `error` may succeed if retried.
+    
+    Connection problems, timeouts, rate limits and 5xx answers are transient;
+    authentication, exhausted quota or budget and bad requests are not.
+    Covers openai errors and the openai-compatible ones litellm raises (and
+    so LlmChat), plus anything carrying an HTTP status_code.
+    """
+    message = str(error).lower()
+    if getattr(error, "code", None) == "insufficient_quota" or "insufficient_quota" in message or "budget" in message:
+        return False
+    if isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError, ConnectionError, TimeoutError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and (status_code in (408, 429) or status_code >= 500)
+
+class EmergentLLMBackend:
+    """emergentintegrations LlmChat (key: EMERGENT_LLM_KEY).
+    
+    LlmChat takes no per-call sampling options, so temperature and
+    max_tokens are not applied on this backend; prompts that need a short
+    answer must ask for it.
+    """
+    
+    name = "emergent"
+    
+    def __init__(self, api_key: str):
         from emergentintegrations.llm.chat import LlmChat, UserMessage
-        import uuid
-        
-        api_key = os.getenv("EMERGENT_LLM_KEY")
-        if not api_key:
-            print("ERROR: EMERGENT_LLM_KEY not configured")
-            return '{"error": "AI no configurada. Por favor configure EMERGENT_LLM_KEY."}'
-        
-        session_id = f"analysis_{uuid.uuid4().hex[:8]}"
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=session_id,
-            system_message=system_message
-        ).with_model("openai", "gpt-4o")
-        
-        user_msg = UserMessage(text=user_prompt)
-        response = await chat.send_message(user_msg)
-        return response
+        self.api_key = api_key
+        self._chat_class = LlmChat
+        self._message_class = UserMessage
+    
+    def is_retryable(self, error: Exception) -> bool:
+        return llm_error_retryable(error)
+    
+    async def complete(self, messages: list, model: str, temperature: Optional[float], max_tokens: Optional[int]) -> dict:
+        system, prompt = split_messages(messages)
+        chat = self._chat_class(
+            api_key=self.api_key,
+            session_id=f"llm_{uuid.uuid4().hex[:8]}",
+            system_message=system
+        ).with_model("openai", model)
+        text = await chat.send_message(self._message_class(text=prompt))
+        return {"text": text, "prompt_tokens": estimate_tokens(system + prompt), "completion_tokens": estimate_tokens(text)}
+    
+    async def stream(self, messages: list, model: str, temperature: Optional[float], max_tokens: Optional[int], usage: dict):
+        # LlmChat can't stream: the whole answer arrives as one chunk
+        result = await self.complete(messages, model, temperature, max_tokens)
+        usage.update(prompt_tokens=result["prompt_tokens"], completion_tokens=result["completion_tokens"])
+        yield result["text"]
+
+class OpenAILLMBackend:
+    """OpenAI-compatible chat completions over the shared outbound HTTP pool"""
+    
+    name = "openai"
+    
+    def __init__(self, api_key: str, base_url: Optional[str] = LLM_BASE_URL):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.host = urlsplit(base_url or "https://api.openai.com").hostname
+        self._client = None
+        self._http_client = None
+    
+    @property
+    def client(self) -> "openai.AsyncOpenAI":
+        http_client = outbound_http.client_for(self.host)
+        if self._client is None or self._http_client is not http_client:
+            # Retries are the gateway's job
+            self._client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, http_client=http_client, max_retries=0)
+            self._http_client = http_client
+        return self._client
+    
+    def is_retryable(self, error: Exception) -> bool:
+        return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+    
+    async def complete(self, messages: list, model: str, temperature: Optional[float], max_tokens: Optional[int]) -> dict:
+        options = {}
+        if temperature is not None:
+            options["temperature"] = temperature
+        if max_tokens is not None:
+            options["max_tokens"] = max_tokens
+        response = await self.client.chat.completions.create(model=model, messages=messages, **options)
+        usage = response.usage
+        text = response.choices[0].message.content or ""
+        return {
+            "text": text,
+            "prompt_tokens": usage.prompt_tokens if usage else estimate_tokens(json.dumps(messages)),
+            "completion_tokens": usage.completion_tokens if usage else estimate_tokens(text)
+        }
+    
+    async def stream(self, messages: list, model: str, temperature: Optional[float], max_tokens: Optional[int], usage: dict):
+        options = {}
+        if temperature is not None:
+            options["temperature"] = temperature
+        if max_tokens is not None:
+            options["max_tokens"] = max_tokens
+        chunks = await self.client.chat.completions.create(
+            model=model, messages=messages, stream=True, stream_options={"include_usage": True}, **options
+        )
+        async for chunk in chunks:
+            if chunk.usage:
+                usage.update(prompt_tokens=chunk.usage.prompt_tokens, completion_tokens=chunk.usage.completion_tokens)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+class FakeLLMBackend:
+    """Local backend for tests and offline development.
+    
+    Answers with `responses` in turn (strings, or callables receiving the
+    messages), echoing the last message when none are given. The first
+    `failures` calls raise, and every call waits `delay` seconds.
+    """
+    
+    name = "fake"
+    
+    def __init__(self, responses=None, delay: float = 0, failures: int = 0):
+        self.responses = list(responses or [])
+        self.delay = delay
+        self.failures = failures
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+    
+    def is_retryable(self, error: Exception) -> bool:
+        return True
+    
+    async def complete(self, messages: list, model: str, temperature: Optional[float], max_tokens: Optional[int]) -> dict:
+        self.calls.append({"messages": messages, "model": model})
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("fake backend failure")
+            response = self.responses.pop(0) if self.responses else f"eco: {messages[-1]['content']}"
+            text = response(messages) if callable(response) else response
+        finally:
+            self.in_flight -= 1
+        return {"text": text, "prompt_tokens": estimate_tokens(json.dumps(messages)), "completion_tokens": estimate_tokens(text)}
+    
+    async def stream(self, messages: list, model: str, temperature: Optional[float], max_tokens: Optional[int], usage: dict):
+        # Word by word, waiting `delay` before the first one (time to first token)
+        result = await self.complete(messages, model, temperature, max_tokens)
+        usage.update(prompt_tokens=result["prompt_tokens"], completion_tokens=result["completion_tokens"])
+        for word in re.findall(r"\S+\s*", result["text"]):
+            yield word
+            await asyncio.sleep(0)
+
+def default_llm_backend():
+    backend = LLM_BACKEND or ("emergent" if EMERGENT_KEY and EMERGENT_INTEGRATIONS_AVAILABLE else "openai" if OPENAI_API_KEY else None)
+    if backend == "fake":
+        return FakeLLMBackend()
+    if backend == "emergent" and EMERGENT_KEY and EMERGENT_INTEGRATIONS_AVAILABLE:
+        return EmergentLLMBackend(EMERGENT_KEY)
+    if backend == "openai" and OPENAI_API_KEY:
+        return OpenAILLMBackend(OPENAI_API_KEY)
+    return None
+
+class LLMGateway:
+    """Single entry point for LLM calls.
+    
+    A call first takes one of the user's LLM_MAX_PER_USER slots, then one of
+    the LLM_MAX_CONCURRENCY global slots (waiting at most queue_timeout for
+    each), so a burst from one user queues behind itself instead of starving
+    everyone.
+    Each attempt is bounded by `timeout`; timeouts and retryable backend
+    errors are retried with full-jitter exponential backoff.
+    """
+    
+    def __init__(
+        self,
+        backend=None,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_per_user: int = LLM_MAX_PER_USER,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+        timeout: float = LLM_TIMEOUT,
+        max_retries: int = LLM_MAX_RETRIES,
+        retry_base_delay: float = LLM_RETRY_BASE_DELAY,
+        model: str = LLM_MODEL
+    ):
+        self.backend = backend
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.model = model
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._user_slots = {}  # user_id -> [semaphore, holders + waiters]
+        self.stats = {
+            "requests": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "retries": 0,
+            "rejected": 0,
+            "in_flight": 0,
+            "by_purpose": {}
+        }
+    
+    @property
+    def available(self) -> bool:
+        return self.backend is not None
+    
+    @asynccontextmanager
+    async def _user_slot(self, user_id: Optional[str]):
+        if user_id is None:
+            yield
+            return
+        entry = self._user_slots.setdefault(user_id, [asyncio.Semaphore(self.max_per_user), 0])
+        entry[1] += 1
+        try:
+            try:
+                await asyncio.wait_for(entry[0].acquire(), timeout=self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["rejected"] += 1
+                raise LLMUnavailableError("Too many AI requests in progress for this user")
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._user_slots.pop(user_id, None)
+    
+    @asynccontextmanager
+    async def _global_slot(self):
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            raise LLMUnavailableError("AI service busy")
+        try:
+            yield
+        finally:
+            self._slots.release()
+    
+    def _account(self, purpose: str, latency_ms: float, result: Optional[dict] = None, error: bool = False):
+        entry = self.stats["by_purpose"].setdefault(purpose, {
+            "requests": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "total_ms": 0.0, "max_ms": 0.0
+        })
+        entry["requests"] += 1
+        entry["total_ms"] = round(entry["total_ms"] + latency_ms, 1)
+        entry["max_ms"] = round(max(entry["max_ms"], latency_ms), 1)
+        if error:
+            entry["errors"] += 1
+        if result:
+            entry["prompt_tokens"] += result["prompt_tokens"]
+            entry["completion_tokens"] += result["completion_tokens"]
+    
+    async def complete(
+        self,
+        messages: list,
+        user_id: Optional[str] = None,
+        purpose: str = "default",
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None
+    ) -> str:
+        """Chat completion for `messages` ([{"role", "content"}]); returns the text"""
+        if self.backend is None:
+            raise LLMUnavailableError("AI service not configured")
+        backend = self.backend
+        self.stats["requests"] += 1
+        
+        async with self._user_slot(user_id), self._global_slot():
+            self.stats["in_flight"] += 1
+            started = time.monotonic()
+            try:
+                for attempt in range(self.max_retries + 1):
+                    if attempt:
+                        self.stats["retries"] += 1
+                        await asyncio.sleep(random.uniform(0, self.retry_base_delay * (2 ** (attempt - 1))))
+                    try:
+                        result = await asyncio.wait_for(
+                            backend.complete(messages, model or self.model, temperature, max_tokens),
+                            timeout=self.timeout
+                        )
+                    except asyncio.TimeoutError:
+                        self.stats["timeouts"] += 1
+                        error = LLMError(f"timed out after {self.timeout}s")
+                    except Exception as e:
+                        error = LLMError(f"{type(e).__name__}: {e}")
+                        if not backend.is_retryable(e):
+                            break
+                    else:
+                        self._account(purpose, (time.monotonic() - started) * 1000, result)
+                        return result["text"]
+                
+                self.stats["errors"] += 1
+                self._account(purpose, (time.monotonic() - started) * 1000, error=True)
+                raise error
+            finally:
+                self.stats["in_flight"] -= 1
+    
+    async def stream(
+        self,
+        messages: list,
+        user_id: Optional[str] = None,
+        purpose: str = "default",
+        model: Optional[str] = None,
+        temperature: Optional[float] = None,
+        max_tokens: Optional[int] = None
+    ):
+        """Chat completion as an async iterator of text chunks.
+        
+        The slots are held until the stream ends. `timeout` bounds the wait
+        for each chunk; failures are retried only before the first chunk,
+        since the caller can't take back text it has already forwarded.
+        """
+        if self.backend is None:
+            raise LLMUnavailableError("AI service not configured")
+        backend = self.backend
+        self.stats["requests"] += 1
+        
+        async with self._user_slot(user_id), self._global_slot():
+            self.stats["in_flight"] += 1
+            started = time.monotonic()
+            emitted = []
+            try:
+                for attempt in range(self.max_retries + 1):
+                    if attempt:
+                        self.stats["retries"] += 1
+                        await asyncio.sleep(random.uniform(0, self.retry_base_delay * (2 ** (attempt - 1))))
+                    usage = {}
+                    chunks = backend.stream(messages, model or self.model, temperature, max_tokens, usage)
+                    try:
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(chunks.__anext__(), timeout=self.timeout)
+                            except StopAsyncIteration:
+                                break
+                            emitted.append(chunk)
+                            yield chunk
+                    except asyncio.TimeoutError:
+                        self.stats["timeouts"] += 1
+                        error = LLMError(f"timed out after {self.timeout}s")
+                    except Exception as e:
+                        error = LLMError(f"{type(e).__name__}: {e}")
+                        if not backend.is_retryable(e):
+                            break
+                    else:
+                        text = "".join(emitted)
+                        self._account(purpose, (time.monotonic() - started) * 1000, {
+                            "prompt_tokens": usage.get("prompt_tokens") or estimate_tokens(json.dumps(messages)),
+                            "completion_tokens": usage.get("completion_tokens") or estimate_tokens(text)
+                        })
+                        return
+                    finally:
+                        await chunks.aclose()
+                    if emitted:
+                        break
+                
+                self.stats["errors"] += 1
+                self._account(purpose, (time.monotonic() - started) * 1000, error=True)
+                raise error
+            finally:
+                self.stats["in_flight"] -= 1
+    
+    async def ask(self, system_message: str, prompt: str, **kwargs) -> str:
+        return await self.complete(
+            [{"role": "system", "content": system_message}, {"role": "user", "content": prompt}],
+            **kwargs
+        )
+
+llm_gateway = LLMGateway(default_llm_backend())
+print(f"AI backend: {llm_gateway.backend.name if llm_gateway.backend else 'none (AI features disabled)'}")
+
+# ---- LLM response cache ----
+# Analyses are keyed by the content they are generated from: while a user's
+# data summary (and so the prompt) doesn't change, the stored answer is
+# served without calling the model.
+
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "21600"))  # seconds; 0 disables the cache
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "1000"))  # in-process entries
+
+def llm_cache_key(system_message: str, prompt: str, model: str) -> str:
+    return hashlib.sha256(json.dumps([model, system_message, prompt], ensure_ascii=False).encode()).hexdigest()
+
+def strip_code_fences(text: str) -> str:
+    """Model output without a surrounding ```json ... ``` block"""
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.split("```")[1]
+        if text.startswith("json"):
+            text = text[4:]
+    return text.strip()
+
+def is_json_response(text: str) -> bool:
+    try:
+        json.loads(strip_code_fences(text))
+        return True
+    except ValueError:
+        return False
+
+class LLMResponseCache:
+    """Content-addressed LLM answers: in-process LRU in front of the llm_cache collection.
+    
+    Identical prompts requested concurrently share one model call.
+    """
+    
+    def __init__(self, max_size: int = LLM_CACHE_SIZE, ttl: int = LLM_CACHE_TTL, database=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._database = database
+        self._entries = OrderedDict()  # key -> (text, monotonic deadline)
+        self._pending = {}  # key -> future of the call in flight
+        self.stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "coalesced": 0, "stored": 0, "rejected": 0}
+    
+    @property
+    def database(self):
+        return self._database if self._database is not None else db
+    
+    def _remember(self, key: str, text: str, ttl: float):
+        self._entries[key] = (text, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+    
+    async def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return entry[0]
+            del self._entries[key]
+        
+        now = datetime.now(timezone.utc)
+        document = await self.database.llm_cache.find_one(
+            {"key": key, "expires_at": {"$gt": now}}, {"_id": 0, "text": 1, "expires_at": 1}
+        )
+        if document is None:
+            return None
+        expires_at = document["expires_at"]
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        self._remember(key, document["text"], (expires_at - now).total_seconds())
+        self.stats["db_hits"] += 1
+        return document["text"]
+    
+    async def set(self, key: str, text: str, model: str, purpose: str):
+        self._remember(key, text, self.ttl)
+        await self._store(key, text, model, purpose)
+    
+    async def _store(self, key: str, text: str, model: str, purpose: str):
+        now = datetime.now(timezone.utc)
+        await self.database.llm_cache.update_one(
+            {"key": key},
+            {"$set": {
+                "text": text,
+                "model": model,
+                "purpose": purpose,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=self.ttl)
+            }},
+            upsert=True
+        )
+        self.stats["stored"] += 1
+    
+    async def get_or_call(self, key: str, call, model: str, purpose: str, cacheable=lambda text: True) -> str:
+        """Cached answer for key, or the result of `call()` (stored if `cacheable`)"""
+        if self.ttl <= 0:
+            return await call()
+        cached = await self.get(key)
+        if cached is not None:
+            return cached
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(pending)
+        
+        self.stats["misses"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            text = await call()
+            keep = cacheable(text)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved: waiters re-raise it, nobody else has to
+            raise
+        else:
+            if keep:
+                # In memory before the pending future goes away, so a request
+                # arriving during the upsert below finds the answer
+                self._remember(key, text, self.ttl)
+            future.set_result(text)
+        finally:
+            self._pending.pop(key, None)
+        
+        if keep:
+            await self._store(key, text, model, purpose)
+        else:
+            self.stats["rejected"] += 1
+        return text
+    
+    def info(self) -> dict:
+        return {**self.stats, "size": len(self._entries), "max_size": self.max_size, "ttl": self.ttl}
+
+llm_cache = LLMResponseCache()
+
+# ============== AI WELLNESS ANALYSIS ==============
+
+async def generate_ai_response(system_message: str, user_prompt: str, user_id: Optional[str] = None, purpose: str = "analysis") -> str:
+    """Generate AI response through the LLM gateway.
+    
+    Answers are cached by (system message, prompt, model); only valid JSON
+    answers are kept, so a malformed one is retried on the next request.
+    """
+    try:
+        return await llm_cache.get_or_call(
+            llm_cache_key(system_message, user_prompt, llm_gateway.model),
+            lambda: llm_gateway.ask(system_message, user_prompt, user_id=user_id, purpose=purpose),
+            llm_gateway.model,
+            purpose,
+            cacheable=is_json_response
+        )
+    except LLMUnavailableError as e:
+        print(f"ERROR: {e}")
+        return '{"error": "AI no configurada. Por favor configure EMERGENT_LLM_KEY."}'
     except Exception as e:
         print(f"Error calling AI: {e}")
         return f'{{"error": "Error generando análisis: {str(e)}"}}'
@@ -4438,14 +6901,14 @@ class AnalysisPeriod(str, Enum):
 @app.get("/api/ai/status")
 async def get_ai_status():
     """Check if AI is properly configured"""
-    client = await get_openai_client()
     emergent_key = os.getenv("EMERGENT_LLM_KEY")
     openai_key = os.getenv("OPENAI_API_KEY")
     # Priority: EMERGENT > OPENAI
     api_key = emergent_key or openai_key
     key_source = "EMERGENT" if emergent_key else "OPENAI" if openai_key else None
     return {
-        "ai_configured": client is not None,
+        "ai_configured": llm_gateway.available,
+        "backend": llm_gateway.backend.name if llm_gateway.backend else None,
         "api_key_present": api_key is not None,
         "api_key_source": key_source,
         "api_key_prefix": api_key[:15] + "..." if api_key else None
@@ -4474,19 +6937,10 @@ async def get_wellness_analysis(
         
         # Fetch habits data
         habits = await db.habits.find({"user_id": user_id, "is_active": True}).to_list(100)
-        habit_ids = [h["habit_id"] for h in habits]
-        habit_names = {h["habit_id"]: h["name"] for h in habits}
         
-        habit_logs = await db.habit_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": start_str, "$lte": end_str}
-        }).to_list(1000)
-        
-        # Fetch emotional logs
-        emotional_logs = await db.emotional_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": start_str, "$lte": end_str}
-        }).to_list(100)
+        # Daily rollups of habits and mood
+        rollups = await get_daily_rollups(user_id, start_str, end_str)
+        mood_days = [r for r in rollups if r.get("mood") is not None]
         
         # Fetch goals
         goals = await db.purpose_goals.find({"user_id": user_id}).to_list(50)
@@ -4495,12 +6949,12 @@ async def get_wellness_analysis(
         profile = await db.user_profiles.find_one({"user_id": user_id})
         
         # Calculate statistics
-        total_habit_entries = len(habit_logs)
-        completed_habits = sum(1 for log in habit_logs if log.get("completed"))
+        total_habit_entries = sum(r.get("habits_logged", 0) for r in rollups)
+        completed_habits = sum(r.get("habits_completed", 0) for r in rollups)
         habit_completion_rate = (completed_habits / total_habit_entries * 100) if total_habit_entries > 0 else 0
         
         # Mood statistics
-        moods = [log.get("mood_scale", 5) for log in emotional_logs if log.get("mood_scale")]
+        moods = [r["mood"] for r in mood_days]
         avg_mood = sum(moods) / len(moods) if moods else 0
         mood_trend = "estable"
         if len(moods) >= 3:
@@ -4513,13 +6967,11 @@ async def get_wellness_analysis(
         
         # Habit completion by day of week
         day_completions = {i: {"total": 0, "completed": 0} for i in range(7)}
-        for log in habit_logs:
+        for rollup in rollups:
             try:
-                log_date = datetime.strptime(log["date"], "%Y-%m-%d")
-                day = log_date.weekday()
-                day_completions[day]["total"] += 1
-                if log.get("completed"):
-                    day_completions[day]["completed"] += 1
+                day = datetime.strptime(rollup["date"], "%Y-%m-%d").weekday()
+                day_completions[day]["total"] += rollup.get("habits_logged", 0)
+                day_completions[day]["completed"] += rollup.get("habits_completed", 0)
             except:
                 pass
         
@@ -4527,20 +6979,10 @@ async def get_wellness_analysis(
         worst_day = min(day_completions.items(), key=lambda x: x[1]["completed"] / x[1]["total"] if x[1]["total"] > 0 else 1)
         day_names = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
         
-        # Most/least completed habits
-        habit_stats = {}
-        for log in habit_logs:
-            hid = log.get("habit_id")
-            if hid not in habit_stats:
-                habit_stats[hid] = {"total": 0, "completed": 0}
-            habit_stats[hid]["total"] += 1
-            if log.get("completed"):
-                habit_stats[hid]["completed"] += 1
-        
         # Emotional tags frequency
         tag_freq = {}
-        for log in emotional_logs:
-            for tag in log.get("tags", []):
+        for rollup in mood_days:
+            for tag in rollup.get("tags", []):
                 tag_freq[tag] = tag_freq.get(tag, 0) + 1
         top_emotions = sorted(tag_freq.items(), key=lambda x: x[1], reverse=True)[:5]
         
@@ -4559,7 +7001,7 @@ HÁBITOS:
 - Día más difícil: {day_names[worst_day[0]]} ({worst_day[1]['completed']}/{worst_day[1]['total']} completados)
 
 ESTADO EMOCIONAL:
-- Registros emocionales: {len(emotional_logs)}
+- Registros emocionales: {len(mood_days)}
 - Ánimo promedio: {avg_mood:.1f}/10
 - Tendencia: {mood_trend}
 - Emociones más frecuentes: {', '.join([f"{t[0]} ({t[1]}x)" for t in top_emotions]) if top_emotions else 'Sin datos'}
@@ -4601,17 +7043,11 @@ Genera un análisis JSON con esta estructura exacta (responde SOLO el JSON, sin
     "enfoque_semana": "Un área específica para enfocarse la próxima semana"
 }}"""
 
-        ai_response_text = await generate_ai_response(system_message, prompt)
+        ai_response_text = await generate_ai_response(system_message, prompt, user_id, "wellness_analysis")
         
         # Parse AI response
         try:
-            # Clean response if it has markdown
-            clean_response = ai_response_text.strip()
-            if clean_response.startswith("```"):
-                clean_response = clean_response.split("```")[1]
-                if clean_response.startswith("json"):
-                    clean_response = clean_response[4:]
-            analysis = json.loads(clean_response)
+            analysis = json.loads(strip_code_fences(ai_response_text))
         except:
             # Fallback analysis if AI response parsing fails
             analysis = {
@@ -4619,7 +7055,7 @@ Genera un análisis JSON con esta estructura exacta (responde SOLO el JSON, sin
                 "logros": [
                     f"Mantuviste {completed_habits} hábitos completados",
                     f"Tu mejor día fue {day_names[best_day[0]]}",
-                    f"Registraste {len(emotional_logs)} entradas emocionales"
+                    f"Registraste {len(mood_days)} entradas emocionales"
                 ],
                 "patrones": [
                     {"patron": f"Tu ánimo está {mood_trend}", "tipo": "positivo" if mood_trend == "mejorando" else "neutro"},
@@ -4647,7 +7083,7 @@ Genera un análisis JSON con esta estructura exacta (responde SOLO el JSON, sin
                 "total_entries": total_habit_entries,
                 "avg_mood": round(avg_mood, 1),
                 "mood_trend": mood_trend,
-                "emotional_entries": len(emotional_logs),
+                "emotional_entries": len(mood_days),
                 "active_goals": len([g for g in goals if g.get("status") == "active"]),
                 "best_day": day_names[best_day[0]],
                 "worst_day": day_names[worst_day[0]],
@@ -4701,16 +7137,10 @@ async def get_wellness_stats(
         start_str = start_date.strftime("%Y-%m-%d")
         end_str = now.strftime("%Y-%m-%d")
         
-        # Fetch all data
+        # Fetch habits and the daily rollups of the period
         habits = await db.habits.find({"user_id": user_id, "is_active": True}).to_list(100)
-        habit_logs = await db.habit_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": start_str, "$lte": end_str}
-        }).to_list(1000)
-        emotional_logs = await db.emotional_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": start_str, "$lte": end_str}
-        }).to_list(100)
+        rollups = await get_daily_rollups(user_id, start_str, end_str)
+        mood_days = [r for r in rollups if r.get("mood") is not None]
         
         # Daily breakdown
         daily_data = {}
@@ -4723,23 +7153,20 @@ async def get_wellness_stats(
                 "tags": []
             }
         
-        for log in habit_logs:
-            date = log.get("date")
-            if date in daily_data and log.get("completed"):
-                daily_data[date]["habits_completed"] += 1
-        
-        for log in emotional_logs:
-            date = log.get("date")
+        for rollup in rollups:
+            date = rollup["date"]
             if date in daily_data:
-                daily_data[date]["mood"] = log.get("mood_scale")
-                daily_data[date]["tags"] = log.get("tags", [])
+                daily_data[date]["habits_completed"] = rollup.get("habits_completed", 0)
+                if rollup.get("mood") is not None:
+                    daily_data[date]["mood"] = rollup["mood"]
+                    daily_data[date]["tags"] = rollup.get("tags", [])
         
         # Habit-specific stats
         habit_stats = []
         for habit in habits:
-            logs = [l for l in habit_logs if l.get("habit_id") == habit["habit_id"]]
-            completed = sum(1 for l in logs if l.get("completed"))
-            total = len(logs)
+            statuses = [r["habit_status"][habit["habit_id"]] for r in rollups if habit["habit_id"] in r.get("habit_status", {})]
+            completed = sum(1 for done in statuses if done)
+            total = len(statuses)
             habit_stats.append({
                 "habit_id": habit["habit_id"],
                 "name": habit["name"],
@@ -4759,10 +7186,10 @@ async def get_wellness_stats(
             "daily_data": daily_data,
             "habit_stats": habit_stats,
             "summary": {
-                "total_entries": len(habit_logs),
-                "completed_entries": sum(1 for l in habit_logs if l.get("completed")),
-                "avg_mood": round(sum(l.get("mood_scale", 0) for l in emotional_logs if l.get("mood_scale")) / len(emotional_logs), 1) if emotional_logs else 0,
-                "emotional_entries": len(emotional_logs)
+                "total_entries": sum(r.get("habits_logged", 0) for r in rollups),
+                "completed_entries": sum(r.get("habits_completed", 0) for r in rollups),
+                "avg_mood": round(sum(r["mood"] for r in mood_days) / len(mood_days), 1) if mood_days else 0,
+                "emotional_entries": len(mood_days)
             }
         }
     except Exception as e:
@@ -4794,28 +7221,27 @@ async def get_habits_analysis(
         start_str = start_date.strftime("%Y-%m-%d")
         end_str = now.strftime("%Y-%m-%d")
         
-        # Fetch habits and logs
+        # Fetch habits and the daily rollups of the period
         habits = await db.habits.find({"user_id": user_id, "is_active": True}).to_list(100)
-        habit_logs = await db.habit_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": start_str, "$lte": end_str}
-        }).to_list(2000)
+        rollups = await get_daily_rollups(user_id, start_str, end_str)
         
         # Calculate per-habit stats
         habit_stats = []
         for habit in habits:
-            logs = [l for l in habit_logs if l.get("habit_id") == habit["habit_id"]]
-            completed = sum(1 for l in logs if l.get("completed"))
-            total = len(logs) if logs else days_count
+            statuses = [
+                (datetime.strptime(r["date"], "%Y-%m-%d").weekday(), r["habit_status"][habit["habit_id"]])
+                for r in rollups if habit["habit_id"] in r.get("habit_status", {})
+            ]
+            completed = sum(1 for _, done in statuses if done)
+            total = len(statuses) if statuses else days_count
             
             # Daily breakdown for this habit
             daily_completion = {}
             for i in range(7):
-                day_logs = [l for l in logs if datetime.strptime(l["date"], "%Y-%m-%d").weekday() == i]
-                day_completed = sum(1 for l in day_logs if l.get("completed"))
+                day_statuses = [done for weekday, done in statuses if weekday == i]
                 daily_completion[i] = {
-                    "completed": day_completed,
-                    "total": len(day_logs) if day_logs else 0
+                    "completed": sum(1 for done in day_statuses if done),
+                    "total": len(day_statuses)
                 }
             
             habit_stats.append({
@@ -4835,13 +7261,11 @@ async def get_habits_analysis(
         # Day of week analysis
         day_names = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
         day_completions = {i: {"total": 0, "completed": 0} for i in range(7)}
-        for log in habit_logs:
+        for rollup in rollups:
             try:
-                log_date = datetime.strptime(log["date"], "%Y-%m-%d")
-                day = log_date.weekday()
-                day_completions[day]["total"] += 1
-                if log.get("completed"):
-                    day_completions[day]["completed"] += 1
+                day = datetime.strptime(rollup["date"], "%Y-%m-%d").weekday()
+                day_completions[day]["total"] += rollup.get("habits_logged", 0)
+                day_completions[day]["completed"] += rollup.get("habits_completed", 0)
             except:
                 pass
         
@@ -4849,8 +7273,8 @@ async def get_habits_analysis(
         worst_day = min(day_completions.items(), key=lambda x: x[1]["completed"] / x[1]["total"] if x[1]["total"] > 0 else 1)
         
         # Overall stats
-        total_entries = len(habit_logs)
-        completed_entries = sum(1 for l in habit_logs if l.get("completed"))
+        total_entries = sum(r.get("habits_logged", 0) for r in rollups)
+        completed_entries = sum(r.get("habits_completed", 0) for r in rollups)
         completion_rate = (completed_entries / total_entries * 100) if total_entries > 0 else 0
         
         # Streaks calculation
@@ -4858,11 +7282,11 @@ async def get_habits_analysis(
         max_streak = 0
         streak = 0
         dates_with_all_completed = set()
+        completed_by_date = {r["date"]: r.get("habits_completed", 0) for r in rollups}
         
         for i in range(days_count):
             check_date = (start_date + timedelta(days=i)).strftime("%Y-%m-%d")
-            day_logs = [l for l in habit_logs if l.get("date") == check_date]
-            day_completed = sum(1 for l in day_logs if l.get("completed"))
+            day_completed = completed_by_date.get(check_date, 0)
             day_total = len(habits)
             
             if day_total > 0 and day_completed >= day_total * 0.8:  # 80% threshold
@@ -4924,16 +7348,11 @@ Genera un análisis JSON con esta estructura exacta (responde SOLO el JSON, sin
     "meta_proxima_semana": "Una meta específica y alcanzable para la próxima semana"
 }}"""
 
-        ai_response_text = await generate_ai_response(system_message_habits, prompt)
+        ai_response_text = await generate_ai_response(system_message_habits, prompt, user_id, "habits_analysis")
         
         # Parse AI response
         try:
-            clean_response = ai_response_text.strip()
-            if clean_response.startswith("```"):
-                clean_response = clean_response.split("```")[1]
-                if clean_response.startswith("json"):
-                    clean_response = clean_response[4:]
-            analysis = json.loads(clean_response)
+            analysis = json.loads(strip_code_fences(ai_response_text))
         except:
             analysis = {
                 "resumen": f"Durante {period_name}, has completado {completion_rate:.0f}% de tus hábitos. Tu mejor rendimiento fue los {day_names[best_day[0]]}.",
@@ -5012,16 +7431,14 @@ async def get_emotional_analysis(
         start_str = start_date.strftime("%Y-%m-%d")
         end_str = now.strftime("%Y-%m-%d")
         
-        # Fetch emotional logs
-        emotional_logs = await db.emotional_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": start_str, "$lte": end_str}
-        }).to_list(500)
+        # Fetch the days with an emotional log from the daily rollups
+        rollups = await get_daily_rollups(user_id, start_str, end_str)
+        mood_days = [r for r in rollups if r.get("mood") is not None]
         
         # Fetch profile for context
         profile = await db.user_profiles.find_one({"user_id": user_id})
         
-        if not emotional_logs:
+        if not mood_days:
             return {
                 "period": period,
                 "period_name": period_name,
@@ -5033,7 +7450,7 @@ async def get_emotional_analysis(
             }
         
         # Calculate mood statistics
-        moods = [log.get("mood_scale", 5) for log in emotional_logs if log.get("mood_scale")]
+        moods = [r["mood"] for r in mood_days]
         avg_mood = sum(moods) / len(moods) if moods else 0
         min_mood = min(moods) if moods else 0
         max_mood = max(moods) if moods else 0
@@ -5051,12 +7468,10 @@ async def get_emotional_analysis(
         # Day of week analysis
         day_names = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
         day_moods = {i: [] for i in range(7)}
-        for log in emotional_logs:
+        for rollup in mood_days:
             try:
-                log_date = datetime.strptime(log["date"], "%Y-%m-%d")
-                day = log_date.weekday()
-                if log.get("mood_scale"):
-                    day_moods[day].append(log["mood_scale"])
+                day = datetime.strptime(rollup["date"], "%Y-%m-%d").weekday()
+                day_moods[day].append(rollup["mood"])
             except:
                 pass
         
@@ -5066,8 +7481,8 @@ async def get_emotional_analysis(
         
         # Tag frequency
         tag_freq = {}
-        for log in emotional_logs:
-            for tag in log.get("tags", []):
+        for rollup in mood_days:
+            for tag in rollup.get("tags", []):
                 tag_freq[tag] = tag_freq.get(tag, 0) + 1
         top_tags = sorted(tag_freq.items(), key=lambda x: x[1], reverse=True)[:10]
         
@@ -5089,21 +7504,19 @@ async def get_emotional_analysis(
         
         # Daily mood data
         daily_moods = {}
-        for log in emotional_logs:
-            date = log.get("date")
-            if date and log.get("mood_scale"):
-                daily_moods[date] = {
-                    "mood": log["mood_scale"],
-                    "tags": log.get("tags", []),
-                    "note": log.get("note", "")
-                }
+        for rollup in mood_days:
+            daily_moods[rollup["date"]] = {
+                "mood": rollup["mood"],
+                "tags": rollup.get("tags", []),
+                "note": rollup.get("note") or ""
+            }
         
         # Prepare AI prompt
         data_summary = f"""
 ANÁLISIS EMOCIONAL ({period_name}):
 
 ESTADÍSTICAS GENERALES:
-- Total de registros: {len(emotional_logs)}
+- Total de registros: {len(mood_days)}
 - Ánimo promedio: {avg_mood:.1f}/10
 - Ánimo más bajo: {min_mood}/10
 - Ánimo más alto: {max_mood}/10
@@ -5160,16 +7573,11 @@ Genera un análisis JSON con esta estructura exacta (responde SOLO el JSON, sin
     "enfoque_proxima_semana": "Un área emocional específica para trabajar"
 }}"""
 
-        ai_response_text = await generate_ai_response(system_message_emotional, prompt)
+        ai_response_text = await generate_ai_response(system_message_emotional, prompt, user_id, "emotional_analysis")
         
         # Parse AI response
         try:
-            clean_response = ai_response_text.strip()
-            if clean_response.startswith("```"):
-                clean_response = clean_response.split("```")[1]
-                if clean_response.startswith("json"):
-                    clean_response = clean_response[4:]
-            analysis = json.loads(clean_response)
+            analysis = json.loads(strip_code_fences(ai_response_text))
         except:
             analysis = {
                 "resumen": f"Durante {period_name}, tu ánimo promedio fue {avg_mood:.1f}/10 con una tendencia {mood_trend}.",
@@ -5195,7 +7603,7 @@ Genera un análisis JSON con esta estructura exacta (responde SOLO el JSON, sin
             "period": period,
             "period_name": period_name,
             "stats": {
-                "entries": len(emotional_logs),
+                "entries": len(mood_days),
                 "avg_mood": round(avg_mood, 1),
                 "min_mood": min_mood,
                 "max_mood": max_mood,
@@ -5232,69 +7640,536 @@ class NotificationData(BaseModel):
     body: str
     data: Optional[dict] = None
 
-# Función para enviar notificación push via Expo
-async def send_push_notification(push_token: str, title: str, body: str, data: dict = None):
-    """Envía una notificación push usando Expo Push API"""
-    if not push_token or not push_token.startswith('ExponentPushToken'):
-        print(f"Token inválido: {push_token}")
-        return False
+# ---- Push dispatcher ----
+
+EXPO_PUSH_URL = os.getenv("EXPO_PUSH_URL", "https://exp.host/--/api/v2/push/send")
+EXPO_RECEIPTS_URL = os.getenv("EXPO_RECEIPTS_URL", "https://exp.host/--/api/v2/push/getReceipts")
+EXPO_ACCESS_TOKEN = os.getenv("EXPO_ACCESS_TOKEN")  # only needed with enhanced push security
+EXPO_BATCH_SIZE = 100  # Expo accepts at most 100 messages per request
+EXPO_RECEIPT_BATCH_SIZE = 1000  # ...and 1000 receipt ids per getReceipts call
+PUSH_MAX_RETRIES = int(os.getenv("PUSH_MAX_RETRIES", "3"))
+PUSH_RETRY_BASE_DELAY = float(os.getenv("PUSH_RETRY_BASE_DELAY", "0.5"))  # seconds, doubled per attempt
+PUSH_CONCURRENCY = int(os.getenv("PUSH_CONCURRENCY", "4"))  # batches in flight
+# Expo recommends reading receipts ~15 minutes after sending; they expire after 24h
+PUSH_RECEIPT_DELAY = int(os.getenv("PUSH_RECEIPT_DELAY", "900"))  # seconds
+PUSH_RECEIPT_INTERVAL = int(os.getenv("PUSH_RECEIPT_INTERVAL", "600"))  # seconds
+PUSH_RECEIPT_MAX_AGE = timedelta(hours=24)
+
+def is_expo_push_token(token: Optional[str]) -> bool:
+    return bool(token) and token.startswith(("ExponentPushToken[", "ExpoPushToken["))
+
+class PushDeliveryError(Exception):
+    """A batch could not be delivered to Expo after all retries"""
+
+class PushDispatcher:
+    """Sends Expo push messages over the shared outbound HTTP pools.
+    
+    Messages are posted in Expo's batch format (up to EXPO_BATCH_SIZE per
+    request); rate limiting, 5xx answers and network errors are retried with
+    exponential backoff. Tokens Expo reports as DeviceNotRegistered, in the
+    push tickets or later in the push receipts, are deleted from push_tokens.
+    """
+    
+    def __init__(
+        self,
+        send_url: str = EXPO_PUSH_URL,
+        receipts_url: str = EXPO_RECEIPTS_URL,
+        http: Optional[OutboundHTTP] = None,
+        database=None,
+        batch_size: int = EXPO_BATCH_SIZE,
+        max_retries: int = PUSH_MAX_RETRIES,
+        retry_base_delay: float = PUSH_RETRY_BASE_DELAY,
+        access_token: Optional[str] = EXPO_ACCESS_TOKEN
+    ):
+        self.send_url = send_url
+        self.receipts_url = receipts_url
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.access_token = access_token
+        self._http = http
+        self._database = database
+        self.stats = {
+            "messages": 0,
+            "batches": 0,
+            "retries": 0,
+            "failed_batches": 0,
+            "invalid_tokens": 0,
+            "tokens_pruned": 0,
+            "receipts_checked": 0,
+            "receipt_errors": 0,
+            "last_error": None
+        }
+    
+    @property
+    def database(self):
+        return self._database if self._database is not None else db
     
+    @property
+    def http(self) -> OutboundHTTP:
+        return self._http or outbound_http
+    
+    def _headers(self) -> dict:
+        headers = {
+            "Accept": "application/json",
+            "Accept-Encoding": "gzip, deflate",
+            "Content-Type": "application/json",
+        }
+        if self.access_token:
+            headers["Authorization"] = f"Bearer {self.access_token}"
+        return headers
+    
+    async def _post(self, url: str, payload) -> dict:
+        """POST with retries on 429/5xx/network errors; raises PushDeliveryError"""
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats["retries"] += 1
+                delay = self.retry_base_delay * (2 ** (attempt - 1))
+                await asyncio.sleep(delay + random.uniform(0, delay / 2))
+            try:
+                response = await self.http.post(url, json=payload, headers=self._headers())
+            except httpx.TransportError as e:
+                last_error = f"{type(e).__name__}: {e}"
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                last_error = f"HTTP {response.status_code}"
+                continue
+            if response.status_code != 200:
+                raise PushDeliveryError(f"HTTP {response.status_code}: {response.text[:200]}")
+            return response.json()
+        raise PushDeliveryError(last_error or "unknown error")
+    
+    async def deliver(self, messages: list) -> list:
+        """Post messages to Expo in batches; returns one push ticket per message"""
+        tickets = [None] * len(messages)
+        valid = []
+        for index, message in enumerate(messages):
+            if is_expo_push_token(message.get("to")):
+                valid.append(index)
+            else:
+                self.stats["invalid_tokens"] += 1
+                tickets[index] = {"status": "error", "message": "Invalid Expo push token", "details": {"error": "InvalidPushToken"}}
+        
+        semaphore = asyncio.Semaphore(PUSH_CONCURRENCY)
+        
+        async def deliver_batch(indexes):
+            async with semaphore:
+                try:
+                    result = await self._post(self.send_url, [messages[i] for i in indexes])
+                    batch_tickets = result.get("data") or []
+                except PushDeliveryError as e:
+                    self.stats["failed_batches"] += 1
+                    self.stats["last_error"] = str(e)
+                    print(f"Push batch of {len(indexes)} failed: {e}")
+                    batch_tickets = []
+                self.stats["batches"] += 1
+                for position, index in enumerate(indexes):
+                    if position < len(batch_tickets):
+                        tickets[index] = batch_tickets[position]
+                    else:
+                        tickets[index] = {
+                            "status": "error",
+                            "message": self.stats["last_error"] or "No ticket",
+                            "details": {"error": "DeliveryFailed"}
+                        }
+        
+        batches = [valid[i:i + self.batch_size] for i in range(0, len(valid), self.batch_size)]
+        await asyncio.gather(*(deliver_batch(batch) for batch in batches))
+        self.stats["messages"] += len(valid)
+        return tickets
+    
+    async def send(self, messages: list) -> list:
+        """Deliver messages, prune dead tokens and keep ticket ids for the receipt check"""
+        if not messages:
+            return []
+        tickets = await self.deliver(messages)
+        
+        dead_tokens = set()
+        receipts = []
+        now = datetime.now(timezone.utc)
+        for message, ticket in zip(messages, tickets):
+            if ticket.get("status") == "ok" and ticket.get("id"):
+                receipts.append({"receipt_id": ticket["id"], "push_token": message["to"], "created_at": now})
+            elif (ticket.get("details") or {}).get("error") == "DeviceNotRegistered":
+                dead_tokens.add(message["to"])
+        
+        if receipts:
+            await self.database.push_receipts.insert_many(receipts)
+        await self.prune_tokens(dead_tokens)
+        return tickets
+    
+    async def prune_tokens(self, tokens) -> int:
+        if not tokens:
+            return 0
+        result = await self.database.push_tokens.delete_many({"push_token": {"$in": list(tokens)}})
+        self.stats["tokens_pruned"] += result.deleted_count
+        return result.deleted_count
+    
+    async def check_receipts(self, min_age: int = PUSH_RECEIPT_DELAY) -> int:
+        """Read due push receipts from Expo and prune tokens that are no longer registered"""
+        now = datetime.now(timezone.utc)
+        checked = 0
+        while True:
+            pending = await self.database.push_receipts.find(
+                {"created_at": {"$lte": now - timedelta(seconds=min_age)}},
+                {"_id": 0, "receipt_id": 1, "push_token": 1, "created_at": 1}
+            ).sort("created_at", 1).limit(EXPO_RECEIPT_BATCH_SIZE).to_list(EXPO_RECEIPT_BATCH_SIZE)
+            if not pending:
+                return checked
+            
+            try:
+                result = await self._post(self.receipts_url, {"ids": [r["receipt_id"] for r in pending]})
+            except PushDeliveryError as e:
+                self.stats["last_error"] = str(e)
+                print(f"Push receipt check failed: {e}")
+                return checked
+            receipts = result.get("data") or {}
+            
+            done, dead_tokens = [], set()
+            for pending_receipt in pending:
+                receipt = receipts.get(pending_receipt["receipt_id"])
+                created_at = pending_receipt["created_at"]
+                if created_at.tzinfo is None:
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                if receipt is None and now - created_at < PUSH_RECEIPT_MAX_AGE:
+                    continue  # not ready yet
+                done.append(pending_receipt["receipt_id"])
+                if receipt and receipt.get("status") == "error":
+                    self.stats["receipt_errors"] += 1
+                    if (receipt.get("details") or {}).get("error") == "DeviceNotRegistered":
+                        dead_tokens.add(pending_receipt["push_token"])
+            
+            await self.prune_tokens(dead_tokens)
+            if done:
+                await self.database.push_receipts.delete_many({"receipt_id": {"$in": done}})
+            self.stats["receipts_checked"] += len(done)
+            checked += len(done)
+            if len(done) < len(pending):
+                return checked  # the rest are not ready yet
+
+push_dispatcher = PushDispatcher()
+
+async def push_receipt_loop():
+    """Background task: process due Expo push receipts"""
+    while True:
+        try:
+            await push_dispatcher.check_receipts()
+        except Exception as e:
+            push_dispatcher.stats["last_error"] = str(e)
+            print(f"Push receipt loop error: {e}")
+        await asyncio.sleep(PUSH_RECEIPT_INTERVAL)
+
+def push_message(push_token: str, title: str, body: str, data: dict = None, badge: Optional[int] = 1) -> dict:
+    """One Expo push message"""
     message = {
         "to": push_token,
         "sound": "default",
         "title": title,
         "body": body,
         "data": data or {},
-        "badge": 1,
     }
+    if badge is not None:
+        message["badge"] = badge
+    return message
+
+# Función para enviar notificación push via Expo
+async def send_push_notification(push_token: str, title: str, body: str, data: dict = None):
+    """Envía una notificación push usando Expo Push API"""
+    if not is_expo_push_token(push_token):
+        print(f"Token inválido: {push_token}")
+        return False
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://exp.host/--/api/v2/push/send",
-                json=message,
-                headers={
-                    "Accept": "application/json",
-                    "Accept-Encoding": "gzip, deflate",
-                    "Content-Type": "application/json",
+        tickets = await push_dispatcher.send([push_message(push_token, title, body, data)])
+        return tickets[0].get("status") == "ok"
+    except Exception as e:
+        print(f"Error enviando push notification: {e}")
+        return False
+
+# ---- Push outbox ----
+# notify_user only writes the notification and a push job; a pool of workers
+# delivers the jobs so request latency never includes the Expo round-trip.
+
+PUSH_OUTBOX_WORKERS = int(os.getenv("PUSH_OUTBOX_WORKERS", "4"))
+PUSH_OUTBOX_RATE = float(os.getenv("PUSH_OUTBOX_RATE", "300"))  # messages/second (Expo allows 600/s per project)
+PUSH_OUTBOX_MAX_ATTEMPTS = int(os.getenv("PUSH_OUTBOX_MAX_ATTEMPTS", "5"))
+PUSH_OUTBOX_RETRY_DELAY = int(os.getenv("PUSH_OUTBOX_RETRY_DELAY", "30"))  # seconds, doubled per attempt
+PUSH_OUTBOX_LEASE = int(os.getenv("PUSH_OUTBOX_LEASE", "120"))  # seconds a claimed job is hidden from other workers
+PUSH_OUTBOX_POLL_INTERVAL = float(os.getenv("PUSH_OUTBOX_POLL_INTERVAL", "5"))  # seconds
+PUSH_OUTBOX_DEAD_LETTER_TTL = timedelta(days=30)
+PUSH_RETRYABLE_ERRORS = {"DeliveryFailed", "MessageRateExceeded"}
+
+class RateLimiter:
+    """Token bucket shared by the outbox workers"""
+    
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class PushOutbox:
+    """Durable queue of push jobs in the push_outbox collection.
+    
+    Jobs are claimed in batches with a lease, so several workers (or several
+    server processes) can drain the queue without sending a job twice; a
+    worker that dies mid-batch simply lets the lease expire. Retryable
+    failures are rescheduled with exponential backoff; permanent failures and
+    jobs out of attempts are kept as dead letters for PUSH_OUTBOX_DEAD_LETTER_TTL.
+    """
+    
+    def __init__(
+        self,
+        dispatcher: Optional[PushDispatcher] = None,
+        database=None,
+        workers: int = PUSH_OUTBOX_WORKERS,
+        batch_size: int = EXPO_BATCH_SIZE,
+        rate: float = PUSH_OUTBOX_RATE,
+        max_attempts: int = PUSH_OUTBOX_MAX_ATTEMPTS,
+        retry_delay: float = PUSH_OUTBOX_RETRY_DELAY,
+        lease: int = PUSH_OUTBOX_LEASE
+    ):
+        self._dispatcher = dispatcher
+        self._database = database
+        self.workers = workers
+        self.batch_size = batch_size
+        self.rate_limiter = RateLimiter(rate, max(rate, batch_size))
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self._tasks = []
+        self._wakeup = None
+        self.stats = {
+            "enqueued": 0,
+            "delivered": 0,
+            "retried": 0,
+            "dead_lettered": 0,
+            "batches": 0,
+            "last_error": None
+        }
+    
+    @property
+    def dispatcher(self) -> PushDispatcher:
+        return self._dispatcher or push_dispatcher
+    
+    @property
+    def database(self):
+        return self._database if self._database is not None else db
+    
+    @staticmethod
+    def _claimable(now: datetime) -> dict:
+        return {"$or": [
+            {"status": "pending", "available_at": {"$lte": now}},
+            {"status": "processing", "locked_until": {"$lt": now}},
+        ]}
+    
+    async def enqueue(self, jobs: list) -> int:
+        """jobs: dicts with user_id, notification_id and the Expo message"""
+        if not jobs:
+            return 0
+        now = datetime.now(timezone.utc)
+        await self.database.push_outbox.insert_many([
+            {
+                "job_id": f"push_{uuid.uuid4().hex[:16]}",
+                "user_id": job["user_id"],
+                "notification_id": job.get("notification_id"),
+                "message": job["message"],
+                "status": "pending",
+                "attempts": 0,
+                "available_at": now,
+                "created_at": now
+            }
+            for job in jobs
+        ])
+        self.stats["enqueued"] += len(jobs)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return len(jobs)
+    
+    async def claim(self) -> list:
+        """Lease up to batch_size due jobs to this worker"""
+        now = datetime.now(timezone.utc)
+        candidates = await self.database.push_outbox.find(
+            self._claimable(now), {"_id": 0, "job_id": 1}
+        ).sort("available_at", 1).limit(self.batch_size).to_list(self.batch_size)
+        if not candidates:
+            return []
+        
+        claim_id = uuid.uuid4().hex
+        await self.database.push_outbox.update_many(
+            {"job_id": {"$in": [c["job_id"] for c in candidates]}, **self._claimable(now)},
+            {"$set": {
+                "status": "processing",
+                "claim_id": claim_id,
+                "locked_until": now + timedelta(seconds=self.lease)
+            }}
+        )
+        # Another worker may have won some of them between the find and the update
+        return await self.database.push_outbox.find(
+            {"claim_id": claim_id, "status": "processing"}, {"_id": 0}
+        ).to_list(self.batch_size)
+    
+    async def process(self, jobs: list):
+        """Send one claimed batch and record the outcome of every job"""
+        await self.rate_limiter.acquire(len(jobs))
+        tickets = await self.dispatcher.send([job["message"] for job in jobs])
+        self.stats["batches"] += 1
+        
+        now = datetime.now(timezone.utc)
+        delivered, operations = [], []
+        for job, ticket in zip(jobs, tickets):
+            error = (ticket.get("details") or {}).get("error")
+            # DeviceNotRegistered is final: the dispatcher already pruned the token
+            if ticket.get("status") == "ok" or error == "DeviceNotRegistered":
+                delivered.append(job["job_id"])
+                continue
+            
+            attempts = job.get("attempts", 0) + 1
+            last_error = error or ticket.get("message") or "unknown"
+            if error in PUSH_RETRYABLE_ERRORS and attempts < self.max_attempts:
+                self.stats["retried"] += 1
+                update = {
+                    "status": "pending",
+                    "attempts": attempts,
+                    "last_error": last_error,
+                    "available_at": now + timedelta(seconds=self.retry_delay * (2 ** (attempts - 1)))
+                }
+            else:
+                self.stats["dead_lettered"] += 1
+                update = {
+                    "status": "dead",
+                    "attempts": attempts,
+                    "last_error": last_error,
+                    "dead_at": now,
+                    "expires_at": now + PUSH_OUTBOX_DEAD_LETTER_TTL
                 }
+            operations.append(UpdateOne({"job_id": job["job_id"]}, {"$set": update, "$unset": {"claim_id": "", "locked_until": ""}}))
+        
+        if delivered:
+            await self.database.push_outbox.delete_many({"job_id": {"$in": delivered}})
+            self.stats["delivered"] += len(delivered)
+        if operations:
+            await self.database.push_outbox.bulk_write(operations, ordered=False)
+    
+    async def drain(self) -> int:
+        """Process due jobs until none are left; returns how many were handled"""
+        handled = 0
+        while True:
+            jobs = await self.claim()
+            if not jobs:
+                return handled
+            await self.process(jobs)
+            handled += len(jobs)
+    
+    async def worker(self):
+        while True:
+            try:
+                await self.drain()
+            except Exception as e:
+                self.stats["last_error"] = str(e)
+                print(f"Push outbox worker error: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=PUSH_OUTBOX_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+    
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._wakeup = None
+    
+    async def queue_depth(self) -> dict:
+        counts = await self.database.push_outbox.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ]).to_list(None)
+        return {c["_id"]: c["count"] for c in counts}
+
+push_outbox = PushOutbox()
+
+async def notify_users(notifications: list) -> list:
+    """Save many notifications and queue their push messages.
+    
+    notifications: dicts with user_id, title, body, type and optional data.
+    Returns the notification ids in the same order.
+    """
+    if not notifications:
+        return []
+    now = datetime.now(timezone.utc)
+    documents = [
+        {
+            "notification_id": f"notif_{uuid.uuid4().hex[:12]}",
+            "user_id": item["user_id"],
+            "title": item["title"],
+            "body": item["body"],
+            "type": item["type"],
+            "data": item.get("data") or {},
+            "read": False,
+            "created_at": now
+        }
+        for item in notifications
+    ]
+    await db.notifications.insert_many(documents)
+    
+    user_ids = list({document["user_id"] for document in documents})
+    tokens = await db.push_tokens.find(
+        {"user_id": {"$in": user_ids}},
+        {"_id": 0, "user_id": 1, "push_token": 1}
+    ).to_list(None)
+    token_by_user = {t["user_id"]: t.get("push_token") for t in tokens}
+    
+    jobs = [
+        {
+            "user_id": document["user_id"],
+            "notification_id": document["notification_id"],
+            "message": push_message(
+                token_by_user[document["user_id"]],
+                document["title"],
+                document["body"],
+                {**document["data"], "notification_id": document["notification_id"]}
             )
-            result = response.json()
-            print(f"Push notification result: {result}")
-            return response.status_code == 200
+        }
+        for document in documents
+        if token_by_user.get(document["user_id"])
+    ]
+    try:
+        await push_outbox.enqueue(jobs)
     except Exception as e:
-        print(f"Error enviando push notification: {e}")
-        return False
+        print(f"Error encolando push notifications: {e}")
+    
+    return [document["notification_id"] for document in documents]
 
 # Función helper para enviar notificación a un usuario
 async def notify_user(user_id: str, title: str, body: str, notification_type: str, data: dict = None):
-    """Envía notificación push y guarda en base de datos"""
-    # Buscar token del usuario
-    token_doc = await db.push_tokens.find_one({"user_id": user_id})
-    
-    # Guardar notificación en la base de datos
-    notification = {
-        "notification_id": f"notif_{uuid.uuid4().hex[:12]}",
+    """Guarda la notificación y encola el push (lo entrega push_outbox)"""
+    notification_ids = await notify_users([{
         "user_id": user_id,
         "title": title,
         "body": body,
         "type": notification_type,
-        "data": data or {},
-        "read": False,
-        "created_at": datetime.now(timezone.utc)
-    }
-    await db.notifications.insert_one(notification)
-    
-    # Enviar push si tiene token
-    if token_doc and token_doc.get("push_token"):
-        await send_push_notification(
-            token_doc["push_token"],
-            title,
-            body,
-            {**data, "notification_id": notification["notification_id"]} if data else {"notification_id": notification["notification_id"]}
-        )
-    
-    return notification["notification_id"]
+        "data": data
+    }])
+    return notification_ids[0]
 
 @app.post("/api/notifications/register-token")
 async def register_push_token(data: RegisterPushTokenRequest, current_user: User = Depends(get_current_user)):
@@ -5358,18 +8233,23 @@ async def get_unread_notifications(current_user: User = Depends(get_current_user
     return {"notifications": notifications, "count": len(notifications)}
 
 @app.get("/api/notifications/all")
-async def get_all_notifications(current_user: User = Depends(get_current_user), limit: int = 50):
-    """Obtener todas las notificaciones del usuario"""
-    notifications = await db.notifications.find(
+async def get_all_notifications(
+    current_user: User = Depends(get_current_user),
+    limit: int = 50,
+    cursor: Optional[str] = None
+):
+    """Obtener todas las notificaciones del usuario (paginadas, más recientes primero)"""
+    notifications, next_cursor = await paginate(
+        db.notifications,
         {"user_id": current_user.user_id},
-        {"_id": 0}
-    ).sort("created_at", -1).to_list(limit)
+        "created_at", limit, cursor
+    )
     
     unread_count = await db.notifications.count_documents(
         {"user_id": current_user.user_id, "read": False}
     )
     
-    return {"notifications": notifications, "unread_count": unread_count}
+    return {"notifications": notifications, "unread_count": unread_count, "next_cursor": next_cursor}
 
 @app.post("/api/notifications/{notification_id}/read")
 async def mark_notification_read(notification_id: str, current_user: User = Depends(get_current_user)):
@@ -5413,100 +8293,227 @@ async def send_test_notification(current_user: User = Depends(get_current_user))
     }
 
 
-@app.post("/api/notifications/send-reminders")
-@app.get("/api/notifications/send-reminders")
-async def send_scheduled_reminders(hour: int = 9):
-    """
-    Endpoint para enviar recordatorios programados.
-    Llamar desde un cron job externo o scheduler.
-    Ejemplo: curl -X POST "URL/api/notifications/send-reminders?hour=9"
-    """
-    import random
-    
-    sent_count = 0
-    errors = []
-    
-    # Mensajes motivacionales
-    motivational_messages = [
-        ("💪 ¡Tú puedes!", "Cada día que eliges tu recuperación es una victoria. Sigue adelante."),
-        ("🌟 Recuerda tu propósito", "Hoy es un buen día para recordar por qué empezaste este camino."),
-        ("🙏 Un día a la vez", "No te preocupes por el mañana. Enfócate en hoy."),
-        ("❤️ Eres valioso/a", "Tu vida importa. Tu recuperación importa. Tú importas."),
-        ("🌈 La esperanza es real", "Miles de personas han logrado la recuperación. Tú también puedes."),
-        ("🔥 Mantén el fuego", "Tu fortaleza interior es más grande que cualquier obstáculo."),
-        ("🌱 Creciendo cada día", "Cada pequeño paso cuenta. Estás avanzando."),
-    ]
-    
-    # Buscar usuarios con notificaciones habilitadas para esta hora
-    users_settings = await db.notification_settings.find({
-        "preferred_time": f"{hour:02d}:00"
-    }).to_list(1000)
-    
-    # Si no hay configuraciones específicas, buscar tokens de usuarios activos
-    if not users_settings:
-        tokens = await db.push_tokens.find({}).to_list(1000)
-        user_ids = [t["user_id"] for t in tokens]
-    else:
-        user_ids = [s["user_id"] for s in users_settings]
+# ---- Scheduled reminders ----
+# Users are streamed by cursor and handled in chunks (one $in prefetch per
+# collection and one notification batch per chunk), so memory stays bounded
+# by REMINDER_CHUNK_SIZE whatever the number of users. Each user is claimed
+# in reminder_runs once per day, which makes reruns, overlapping shards and
+# several server processes safe.
+
+import hmac
+import zlib
+from pymongo.errors import BulkWriteError
+
+REMINDER_CHUNK_SIZE = int(os.getenv("REMINDER_CHUNK_SIZE", "500"))
+REMINDER_SCHEDULER_ENABLED = os.getenv("REMINDER_SCHEDULER_ENABLED") == "1"
+REMINDER_SHARD = int(os.getenv("REMINDER_SHARD", "0"))  # this process' shard when the scheduler runs in-process
+REMINDER_SHARDS = int(os.getenv("REMINDER_SHARDS", "1"))
+REMINDER_CLAIM_TTL = timedelta(days=3)
+REMINDER_DEFAULT_HOUR = int(os.getenv("REMINDER_DEFAULT_HOUR", "9"))  # UTC hour of users without a preferred_time
+SCHEDULER_TOKEN = os.getenv("SCHEDULER_TOKEN")  # shared secret of the external scheduler
+
+reminder_stats = {"runs": 0, "last_run_at": None, "last_hour": None, "last_users": 0, "last_sent": 0, "last_skipped": 0, "last_duration_ms": 0.0}
+
+REMINDER_MOTIVATIONAL_MESSAGES = [
+    ("💪 ¡Tú puedes!", "Cada día que eliges tu recuperación es una victoria. Sigue adelante."),
+    ("🌟 Recuerda tu propósito", "Hoy es un buen día para recordar por qué empezaste este camino."),
+    ("🙏 Un día a la vez", "No te preocupes por el mañana. Enfócate en hoy."),
+    ("❤️ Eres valioso/a", "Tu vida importa. Tu recuperación importa. Tú importas."),
+    ("🌈 La esperanza es real", "Miles de personas han logrado la recuperación. Tú también puedes."),
+    ("🔥 Mantén el fuego", "Tu fortaleza interior es más grande que cualquier obstáculo."),
+    ("🌱 Creciendo cada día", "Cada pequeño paso cuenta. Estás avanzando."),
+]
+
+def reminder_shard(user_id: str, shards: int) -> int:
+    """Stable shard of a user (crc32, unlike hash(), is the same in every process)"""
+    return zlib.crc32(user_id.encode()) % shards
+
+async def claim_reminder_users(user_ids: list, date: str, hour: int) -> list:
+    """Record today's reminder for each user; returns the users not already claimed"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.reminder_runs.insert_many([
+            {"user_id": user_id, "date": date, "hour": hour, "created_at": now, "expires_at": now + REMINDER_CLAIM_TTL}
+            for user_id in user_ids
+        ], ordered=False)
+        return list(user_ids)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        duplicates = {error["index"] for error in errors}
+        return [user_id for index, user_id in enumerate(user_ids) if index not in duplicates]
+
+async def send_reminder_chunk(user_ids: list, date: str, hour: int) -> dict:
+    """Claim, prefetch and queue the reminders of one chunk of users"""
+    claimed = await claim_reminder_users(user_ids, date, hour)
+    if not claimed:
+        return {"sent": 0, "skipped": len(user_ids)}
     
-    for user_id in user_ids:
-        try:
-            # Obtener configuración del usuario
-            settings = await db.notification_settings.find_one({"user_id": user_id})
-            if not settings:
-                settings = {
-                    "motivational": True,
-                    "habit_reminders": True,
-                    "emotion_reminders": True
-                }
+    try:
+        results = await fan_out({
+            "settings": db.notification_settings.find(
+                {"user_id": {"$in": claimed}},
+                {"_id": 0, "user_id": 1, "motivational": 1, "habit_reminders": 1, "emotion_reminders": 1}
+            ).to_list(None),
+            "habits": db.habits.aggregate([
+                {"$match": {"user_id": {"$in": claimed}, "is_active": True}},
+                {"$group": {"_id": "$user_id", "habits": {"$push": {"habit_id": "$habit_id", "name": "$name"}}}},
+                {"$project": {"habits": {"$slice": ["$habits", 3]}}}
+            ]).to_list(None),
+            "logged_today": db.emotional_logs.distinct("user_id", {"user_id": {"$in": claimed}, "date": date}),
+        }, required=("settings", "habits", "logged_today"))
+        
+        settings_by_user = {settings["user_id"]: settings for settings in results["settings"]}
+        habits_by_user = {group["_id"]: group["habits"] for group in results["habits"]}
+        logged_today = set(results["logged_today"])
+        
+        notifications = []
+        for user_id in claimed:
+            settings = settings_by_user.get(user_id, {})
             
-            # Enviar mensaje motivacional
+            # Mensaje motivacional
             if settings.get("motivational", True):
-                title, body = random.choice(motivational_messages)
-                await notify_user(user_id, title, body, "motivational")
-                sent_count += 1
+                title, body = random.choice(REMINDER_MOTIVATIONAL_MESSAGES)
+                notifications.append({"user_id": user_id, "title": title, "body": body, "type": "motivational"})
             
             # Recordatorio de hábitos
-            if settings.get("habit_reminders", True):
-                habits = await db.habits.find({"user_id": user_id, "is_active": True}).to_list(10)
-                if habits:
-                    habit_names = [h["name"] for h in habits[:3]]
-                    await notify_user(
-                        user_id,
-                        "📋 Tus hábitos de hoy",
-                        f"Recuerda completar: {', '.join(habit_names)}",
-                        "habit_reminder",
-                        {"habits": [h["habit_id"] for h in habits[:3]]}
-                    )
-                    sent_count += 1
+            habits = habits_by_user.get(user_id)
+            if settings.get("habit_reminders", True) and habits:
+                notifications.append({
+                    "user_id": user_id,
+                    "title": "📋 Tus hábitos de hoy",
+                    "body": f"Recuerda completar: {', '.join(h['name'] for h in habits)}",
+                    "type": "habit_reminder",
+                    "data": {"habits": [h["habit_id"] for h in habits]}
+                })
             
-            # Recordatorio de emociones
-            if settings.get("emotion_reminders", True):
-                # Verificar si ya registró hoy
-                today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-                today_log = await db.emotional_logs.find_one({
+            # Recordatorio de emociones, solo si no registró hoy
+            if settings.get("emotion_reminders", True) and user_id not in logged_today:
+                notifications.append({
                     "user_id": user_id,
-                    "date": today
+                    "title": "💭 ¿Cómo te sientes hoy?",
+                    "body": "Tómate un momento para registrar tus emociones.",
+                    "type": "emotion_reminder"
                 })
-                if not today_log:
-                    await notify_user(
-                        user_id,
-                        "💭 ¿Cómo te sientes hoy?",
-                        "Tómate un momento para registrar tus emociones.",
-                        "emotion_reminder"
-                    )
-                    sent_count += 1
-                    
-        except Exception as e:
-            errors.append({"user_id": user_id, "error": str(e)})
+        
+        await notify_users(notifications)
+    except Exception:
+        # Give the users back so a rerun can remind them today
+        await db.reminder_runs.delete_many({"user_id": {"$in": claimed}, "date": date})
+        raise
+    
+    return {"sent": len(notifications), "skipped": len(user_ids) - len(claimed)}
+
+async def run_reminders(hour: int, shard: int = 0, shards: int = 1, chunk_size: int = REMINDER_CHUNK_SIZE) -> dict:
+    """Send today's reminders to the users of one shard who want them at `hour`.
+    
+    Users whose notification_settings.preferred_time falls in that hour are
+    reminded. At REMINDER_DEFAULT_HOUR, so are the users with a push token
+    who never chose a time; a user with a preferred_time is only ever
+    reminded at their own hour, so the per-day claim can't be taken early.
+    """
+    if not 0 <= shard < shards:
+        raise ValueError(f"Shard {shard} fuera de rango (shards={shards})")
+    started = time.monotonic()
+    date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    
+    # (cursor, whether users who picked a preferred_time must be left out)
+    sources = [(db.notification_settings.find(
+        {"preferred_time": {"$regex": f"^{hour:02d}:"}},
+        {"_id": 0, "user_id": 1}
+    ), False)]
+    if hour == REMINDER_DEFAULT_HOUR:
+        sources.append((db.push_tokens.find({}, {"_id": 0, "user_id": 1}), True))
+    
+    users, sent, skipped = 0, 0, 0
+    errors = []
     
+    async def flush(chunk, default_audience):
+        nonlocal users, sent, skipped
+        try:
+            if default_audience:
+                chose_time = set(await db.notification_settings.distinct(
+                    "user_id",
+                    {"user_id": {"$in": chunk}, "preferred_time": {"$nin": [None, ""]}}
+                ))
+                chunk = [user_id for user_id in chunk if user_id not in chose_time]
+                if not chunk:
+                    return
+            users += len(chunk)
+            result = await send_reminder_chunk(chunk, date, hour)
+            sent += result["sent"]
+            skipped += result["skipped"]
+        except Exception as e:
+            errors.append({"users": len(chunk), "error": str(e)})
+    
+    for source, default_audience in sources:
+        chunk = []
+        async for document in source.batch_size(chunk_size):
+            user_id = document.get("user_id")
+            if not user_id or reminder_shard(user_id, shards) != shard:
+                continue
+            chunk.append(user_id)
+            if len(chunk) >= chunk_size:
+                await flush(chunk, default_audience)
+                chunk = []
+        if chunk:
+            await flush(chunk, default_audience)
+    
+    reminder_stats.update({
+        "runs": reminder_stats["runs"] + 1,
+        "last_run_at": datetime.now(timezone.utc).isoformat(),
+        "last_hour": hour,
+        "last_users": users,
+        "last_sent": sent,
+        "last_skipped": skipped,
+        "last_duration_ms": round((time.monotonic() - started) * 1000, 1)
+    })
     return {
-        "success": True,
-        "sent_count": sent_count,
-        "users_processed": len(user_ids),
-        "errors": errors if errors else None
+        "shard": shard,
+        "shards": shards,
+        "users_processed": users,
+        "sent_count": sent,
+        "skipped": skipped,
+        "errors": errors or None
     }
 
+async def reminder_loop():
+    """Run this process' reminder shard at the top of every hour (UTC)"""
+    while True:
+        now = datetime.now(timezone.utc)
+        next_run = now.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+        try:
+            result = await run_reminders(next_run.hour, REMINDER_SHARD, REMINDER_SHARDS)
+            print(f"Reminders {next_run.hour:02d}:00 shard {REMINDER_SHARD}/{REMINDER_SHARDS}: "
+                  f"{result['users_processed']} users, {result['sent_count']} notifications")
+        except Exception as e:
+            print(f"Reminder run failed: {e}")
+
+def require_scheduler(request: Request):
+    """Internal endpoints are only for the scheduler holding SCHEDULER_TOKEN"""
+    token = request.headers.get("X-Scheduler-Token", "")
+    if not SCHEDULER_TOKEN or not hmac.compare_digest(token, SCHEDULER_TOKEN):
+        raise HTTPException(status_code=403, detail="Acceso solo para el planificador interno")
+
+@app.post("/api/notifications/send-reminders")
+async def send_scheduled_reminders(request: Request, hour: int = 9, shard: int = 0, shards: int = 1):
+    """
+    Endpoint para enviar recordatorios programados.
+    Llamar desde el planificador interno con la cabecera X-Scheduler-Token.
+    Para repartir la carga, lanzar una llamada por shard (shard=0..shards-1).
+    Ejemplo: curl -X POST -H "X-Scheduler-Token: $SCHEDULER_TOKEN" "URL/api/notifications/send-reminders?hour=9"
+    """
+    require_scheduler(request)
+    if not 0 <= hour <= 23:
+        raise HTTPException(status_code=400, detail="Hora inválida")
+    if shards < 1 or not 0 <= shard < shards:
+        raise HTTPException(status_code=400, detail="Shard inválido")
+    
+    result = await run_reminders(hour, shard, shards)
+    return {"success": True, **result}
+
 
 @app.post("/api/professional/notify-patient")
 async def professional_notify_patient(
@@ -5791,14 +8798,24 @@ async def send_message_with_notification(data: SendMessageRequest, current_user:
     return {"success": True, "message_id": message_id}
 
 @app.get("/api/messages/conversation/{other_user_id}")
-async def get_conversation(other_user_id: str, current_user: User = Depends(get_current_user)):
-    """Obtener conversación entre dos usuarios"""
-    messages = await db.messages.find({
+async def get_conversation(
+    other_user_id: str,
+    current_user: User = Depends(get_current_user),
+    limit: int = 100,
+    cursor: Optional[str] = None
+):
+    """Obtener conversación entre dos usuarios.
+    
+    Returns the latest messages in chronological order; next_cursor pages
+    back to older messages.
+    """
+    messages, next_cursor = await paginate(db.messages, {
         "$or": [
             {"from_user_id": current_user.user_id, "to_user_id": other_user_id},
             {"from_user_id": other_user_id, "to_user_id": current_user.user_id}
         ]
-    }, {"_id": 0}).sort("created_at", 1).to_list(100)
+    }, "created_at", limit, cursor)
+    messages.reverse()
     
     # Marcar como leídos los mensajes recibidos
     await db.messages.update_many(
@@ -5806,7 +8823,7 @@ async def get_conversation(other_user_id: str, current_user: User = Depends(get_
         {"$set": {"read": True, "read_at": datetime.now(timezone.utc)}}
     )
     
-    return {"messages": messages}
+    return {"messages": messages, "next_cursor": next_cursor}
 
 @app.get("/api/messages/unread-count")
 async def get_unread_messages_count(current_user: User = Depends(get_current_user)):
@@ -5834,6 +8851,8 @@ async def report_relapse_with_notification(current_user: User = Depends(get_curr
         "notes": notes
     }
     await db.relapses.insert_one(relapse)
+    await refresh_daily_rollup(current_user.user_id, relapse_date(relapse))
+    await refresh_patient_alerts(current_user.user_id)
     
     # Resetear contador de días
     await db.user_profiles.update_one(
@@ -5856,6 +8875,7 @@ async def report_relapse_with_notification(current_user: User = Depends(get_curr
                 "severity": "high"
             }
         )
+    invalidate_dashboard(current_user.user_id)
     
     return {"success": True, "message": "Recaída registrada. Tu terapeuta ha sido notificado."}
 
@@ -6010,6 +9030,90 @@ CRISIS_KEYWORDS = [
 class NelsonMessage(BaseModel):
     message: str
 
+def detect_nelson_mode(message: str) -> tuple:
+    """(crisis_detected, mode) from keywords; cheap enough to run before any model call"""
+    message_lower = message.lower()
+    crisis_detected = any(keyword in message_lower for keyword in CRISIS_KEYWORDS)
+    mode = "crisis" if crisis_detected else "normal"
+    if any(word in message_lower for word in ["ansiedad", "ansioso", "nervioso", "pánico"]):
+        mode = "anxiety"
+    elif any(word in message_lower for word in ["ganas", "consumir", "recaer", "craving"]):
+        mode = "craving"
+    elif any(word in message_lower for word in ["triste", "deprimido", "solo", "vacío"]):
+        mode = "sadness"
+    return crisis_detected, mode
+
+async def build_nelson_prompt(user_id: str, user_message: str, crisis_detected: bool) -> tuple:
+    """(system prompt, user message with recent history) for one chat turn"""
+    # Get user context (now returns tuple of context and role_context)
+    user_context, role_context = await get_nelson_user_context(user_id)
+    
+    # Get conversation history
+    conversation = await db.nelson_conversations.find_one({"user_id": user_id})
+    messages_history = conversation.get("messages", [])[-10:] if conversation else []
+    
+    system_prompt = NELSON_SYSTEM_PROMPT.format(user_context=user_context, role_context=role_context)
+    
+    # Build the user message with context
+    context_message = ""
+    if messages_history:
+        context_message = "Conversación reciente:\n"
+        for msg in messages_history[-3:]:
+            role_label = "Usuario" if msg["role"] == "user" else "Nelson"
+            context_message += f"{role_label}: {msg['content']}\n"
+        context_message += "\n"
+    
+    full_message = f"{context_message}{user_message}"
+    
+    if crisis_detected:
+        full_message += "\n\n[ALERTA: El usuario podría estar en crisis. Responde con máxima empatía]"
+    
+    return system_prompt, full_message
+
+async def save_nelson_turn(current_user: User, user_message: str, nelson_response: str, mode: str, crisis_detected: bool):
+    """Persist a chat turn; in a crisis also log it and alert the linked therapist"""
+    # Save to conversation history
+    new_messages = [
+        {"role": "user", "content": user_message, "timestamp": datetime.utcnow().isoformat(), "mode": mode},
+        {"role": "assistant", "content": nelson_response, "timestamp": datetime.utcnow().isoformat(), "mode": mode}
+    ]
+    
+    await db.nelson_conversations.update_one(
+        {"user_id": current_user.user_id},
+        {
+            "$push": {"messages": {"$each": new_messages}},
+            "$set": {"updated_at": datetime.utcnow()}
+        },
+        upsert=True
+    )
+    
+    # If crisis detected, also log it for safety
+    if crisis_detected:
+        await db.crisis_logs.insert_one({
+            "user_id": current_user.user_id,
+            "message": user_message,
+            "timestamp": datetime.utcnow(),
+            "response_given": nelson_response
+        })
+        
+        # Notify linked therapist if exists
+        profile = await db.profiles.find_one({"user_id": current_user.user_id})
+        if profile and profile.get("linked_therapist_id"):
+            await notify_user(
+                user_id=profile["linked_therapist_id"],
+                title="⚠️ Alerta de Crisis",
+                body=f"{current_user.name} puede estar en crisis. Revisa la conversación.",
+                notification_type="crisis_alert",
+                data={
+                    "patient_id": current_user.user_id,
+                    "patient_name": current_user.name,
+                    "action": "view_patient",
+                    "severity": "critical"
+                }
+            )
+
+NELSON_ERROR_RESPONSE = "Lo siento, tuve un problema. ¿Puedes intentar de nuevo? Si necesitas ayuda urgente, usa el botón rojo de Crisis."
+
 @app.post("/api/nelson/chat")
 async def nelson_chat(
     request: NelsonMessage,
@@ -6018,123 +9122,14 @@ async def nelson_chat(
     """Chat with Nelson - AI therapist assistant"""
     try:
         user_message = request.message.strip()
+        crisis_detected, mode = detect_nelson_mode(user_message)
         
-        # Check for crisis keywords
-        message_lower = user_message.lower()
-        crisis_detected = any(keyword in message_lower for keyword in CRISIS_KEYWORDS)
-        
-        # Get user context (now returns tuple of context and role_context)
-        user_context, role_context = await get_nelson_user_context(current_user.user_id)
-        
-        # Get conversation history
-        conversation = await db.nelson_conversations.find_one({"user_id": current_user.user_id})
-        messages_history = conversation.get("messages", [])[-10:] if conversation else []
-        
-        # Build messages for OpenAI
-        system_prompt = NELSON_SYSTEM_PROMPT.format(user_context=user_context, role_context=role_context)
-        
-        openai_messages = [{"role": "system", "content": system_prompt}]
-        
-        for msg in messages_history:
-            openai_messages.append({
-                "role": msg["role"],
-                "content": msg["content"]
-            })
-        
-        openai_messages.append({"role": "user", "content": user_message})
-        
-        # Add crisis context if detected
-        if crisis_detected:
-            openai_messages.append({
-                "role": "system",
-                "content": """ALERTA: El usuario ha mencionado palabras relacionadas con crisis.
-                Responde con máxima empatía. Valida su dolor. Recuérdale que no está solo.
-                Incluye en tu respuesta:
-                1. Que entiendes su dolor
-                2. Que hay ayuda disponible
-                3. Línea de crisis: 600 360 7777 (Chile) o el número local
-                4. Que puede ir a urgencias
-                5. Pregunta si puede llamar a alguien de confianza ahora mismo"""
-            })
-        
-        # Call OpenAI using emergentintegrations
-        from emergentintegrations.llm.chat import LlmChat, UserMessage
-        import uuid
-        
-        # Build the conversation for emergentintegrations
-        session_id = f"nelson_{current_user.user_id}_{uuid.uuid4().hex[:8]}"
-        chat = LlmChat(
-            api_key=os.getenv("EMERGENT_LLM_KEY"),
-            session_id=session_id,
-            system_message=system_prompt
-        ).with_model("openai", "gpt-4o")
-        
-        # Build the user message with context
-        context_message = ""
-        if messages_history:
-            context_message = "Conversación reciente:\n"
-            for msg in messages_history[-3:]:
-                role_label = "Usuario" if msg["role"] == "user" else "Nelson"
-                context_message += f"{role_label}: {msg['content']}\n"
-            context_message += "\n"
-        
-        full_message = f"{context_message}{user_message}"
-        
-        if crisis_detected:
-            full_message += "\n\n[ALERTA: El usuario podría estar en crisis. Responde con máxima empatía]"
-        
-        # Create UserMessage object
-        user_msg = UserMessage(text=full_message)
-        nelson_response = await chat.send_message(user_msg)
-        
-        # Determine mode
-        mode = "crisis" if crisis_detected else "normal"
-        if any(word in message_lower for word in ["ansiedad", "ansioso", "nervioso", "pánico"]):
-            mode = "anxiety"
-        elif any(word in message_lower for word in ["ganas", "consumir", "recaer", "craving"]):
-            mode = "craving"
-        elif any(word in message_lower for word in ["triste", "deprimido", "solo", "vacío"]):
-            mode = "sadness"
-        
-        # Save to conversation history
-        new_messages = [
-            {"role": "user", "content": user_message, "timestamp": datetime.utcnow().isoformat(), "mode": mode},
-            {"role": "assistant", "content": nelson_response, "timestamp": datetime.utcnow().isoformat(), "mode": mode}
-        ]
-        
-        await db.nelson_conversations.update_one(
-            {"user_id": current_user.user_id},
-            {
-                "$push": {"messages": {"$each": new_messages}},
-                "$set": {"updated_at": datetime.utcnow()}
-            },
-            upsert=True
+        system_prompt, full_message = await build_nelson_prompt(current_user.user_id, user_message, crisis_detected)
+        nelson_response = await llm_gateway.ask(
+            system_prompt, full_message, user_id=current_user.user_id, purpose="nelson_chat"
         )
         
-        # If crisis detected, also log it for safety
-        if crisis_detected:
-            await db.crisis_logs.insert_one({
-                "user_id": current_user.user_id,
-                "message": user_message,
-                "timestamp": datetime.utcnow(),
-                "response_given": nelson_response
-            })
-            
-            # Notify linked therapist if exists
-            profile = await db.profiles.find_one({"user_id": current_user.user_id})
-            if profile and profile.get("linked_therapist_id"):
-                await notify_user(
-                    user_id=profile["linked_therapist_id"],
-                    title="⚠️ Alerta de Crisis",
-                    body=f"{current_user.name} puede estar en crisis. Revisa la conversación.",
-                    notification_type="crisis_alert",
-                    data={
-                        "patient_id": current_user.user_id,
-                        "patient_name": current_user.name,
-                        "action": "view_patient",
-                        "severity": "critical"
-                    }
-                )
+        await save_nelson_turn(current_user, user_message, nelson_response, mode, crisis_detected)
         
         return {
             "response": nelson_response,
@@ -6148,234 +9143,380 @@ async def nelson_chat(
         print(f"Error in Nelson chat: {e}")
         print(f"Error details: {error_details}")
         return {
-            "response": "Lo siento, tuve un problema. ¿Puedes intentar de nuevo? Si necesitas ayuda urgente, usa el botón rojo de Crisis.",
+            "response": NELSON_ERROR_RESPONSE,
             "mode": "error",
             "crisis_detected": False,
             "debug_error": str(e)
         }
 
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Saves run as tasks so a client disconnecting mid-save doesn't cancel them
+nelson_pending_saves = set()
+
+def schedule_nelson_save(*args) -> asyncio.Task:
+    task = asyncio.create_task(save_nelson_turn(*args))
+    nelson_pending_saves.add(task)
+    task.add_done_callback(nelson_pending_saves.discard)
+    return task
+
+@app.post("/api/nelson/chat/stream")
+async def nelson_chat_stream(
+    request: NelsonMessage,
+    current_user: User = Depends(get_current_user)
+):
+    """Chat with Nelson, streamed as Server-Sent Events.
+    
+    Events: "meta" (mode and crisis flag, sent before any model call),
+    "token" ({"text": chunk}) as the answer arrives, then "done" (the full
+    response, once it is saved to nelson_conversations) or "error".
+    """
+    user_message = request.message.strip()
+    crisis_detected, mode = detect_nelson_mode(user_message)
+    
+    async def events():
+        yield sse_event("meta", {"mode": mode, "crisis_detected": crisis_detected})
+        
+        chunks = []
+        saved = False
+        try:
+            system_prompt, full_message = await build_nelson_prompt(current_user.user_id, user_message, crisis_detected)
+            async for chunk in llm_gateway.stream(
+                [{"role": "system", "content": system_prompt}, {"role": "user", "content": full_message}],
+                user_id=current_user.user_id,
+                purpose="nelson_chat"
+            ):
+                chunks.append(chunk)
+                yield sse_event("token", {"text": chunk})
+            
+            nelson_response = "".join(chunks)
+            saved = True
+            await asyncio.shield(schedule_nelson_save(current_user, user_message, nelson_response, mode, crisis_detected))
+            yield sse_event("done", {"response": nelson_response, "mode": mode, "crisis_detected": crisis_detected})
+        except Exception as e:
+            print(f"Error in Nelson chat stream: {e}")
+            yield sse_event("error", {"response": NELSON_ERROR_RESPONSE, "mode": "error", "crisis_detected": crisis_detected})
+        finally:
+            # Client disconnected mid-answer: keep what it was shown (and any crisis log)
+            if not saved and (chunks or crisis_detected):
+                schedule_nelson_save(current_user, user_message, "".join(chunks) or NELSON_ERROR_RESPONSE, mode, crisis_detected)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# ---- Nelson context snapshots ----
+# The context string is stored per user in nelson_contexts, so a chat turn
+# costs one read. Writes to the user's data bump the snapshot's version
+# (see invalidate_dashboard) and schedule a debounced rebuild; a snapshot
+# whose built_version lags its version, that was built on another day or is
+# older than NELSON_CONTEXT_TTL is rebuilt on read.
+
+from pymongo.errors import DuplicateKeyError
+
+NELSON_CONTEXT_TTL = int(os.getenv("NELSON_CONTEXT_TTL", "3600"))  # seconds; catches writes that don't bump the version
+NELSON_CONTEXT_REFRESH_DELAY = float(os.getenv("NELSON_CONTEXT_REFRESH_DELAY", "5"))  # seconds to coalesce bursts of writes
+
+nelson_context_stats = {"hits": 0, "rebuilds": 0, "background_refreshes": 0, "stale_writes": 0, "errors": 0}
+nelson_context_pending = set()  # user_ids with a rebuild scheduled in this process
+nelson_context_tasks = set()
+
+def nelson_context_fresh(snapshot: dict, now: datetime) -> bool:
+    built_at = snapshot.get("built_at")
+    if built_at is None:
+        return False
+    if built_at.tzinfo is None:
+        built_at = built_at.replace(tzinfo=timezone.utc)
+    return (
+        snapshot.get("built_version") == snapshot.get("version", 0)
+        and snapshot.get("date") == now.strftime("%Y-%m-%d")
+        and (now - built_at).total_seconds() < NELSON_CONTEXT_TTL
+    )
+
+async def refresh_nelson_context(user_id: str, version: int) -> tuple[str, str]:
+    """Rebuild the snapshot for `version`; it isn't stored if a write bumped the version meanwhile"""
+    context, role_context = await build_nelson_user_context(user_id)
+    now = datetime.now(timezone.utc)
+    try:
+        await db.nelson_contexts.update_one(
+            {"user_id": user_id, "version": version},
+            {"$set": {
+                "context": context,
+                "role_context": role_context,
+                "built_version": version,
+                "date": now.strftime("%Y-%m-%d"),
+                "built_at": now
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The snapshot exists with a newer version: the next read rebuilds it
+        nelson_context_stats["stale_writes"] += 1
+    nelson_context_stats["rebuilds"] += 1
+    return context, role_context
+
 async def get_nelson_user_context(user_id: str) -> tuple[str, str]:
-    """Get comprehensive user context for Nelson to personalize responses and analyze patterns"""
+    """Nelson context for user_id: the stored snapshot, rebuilt if stale"""
     try:
-        # Get profile
-        profile = await db.user_profiles.find_one({"user_id": user_id}, {"_id": 0})
-        user_role = profile.get("role", "patient") if profile else "patient"
-        
-        # Get role-specific context
-        role_context = ROLE_CONTEXTS.get(user_role, ROLE_CONTEXTS["patient"])
-        
-        # Get user info
-        user = await db.users.find_one({"user_id": user_id}, {"_id": 0, "name": 1, "email": 1})
-        
-        # Get ALL habits
-        habits = await db.habits.find({"user_id": user_id, "is_active": True}).to_list(20)
-        habit_names = [h.get("name", "Sin nombre") for h in habits]
-        
-        # Get habit logs for the last 30 days
-        thirty_days_ago = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
-        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-        
-        habit_logs = await db.habit_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": thirty_days_ago}
-        }).to_list(1000)
-        
-        # Calculate habit statistics
-        total_possible = len(habits) * 30
-        total_completed = sum(1 for log in habit_logs if log.get("completed"))
-        habit_completion_rate = (total_completed / total_possible * 100) if total_possible > 0 else 0
-        
-        # Get today's completions
-        today_logs = [log for log in habit_logs if log.get("date") == today]
-        completed_today = sum(1 for log in today_logs if log.get("completed"))
-        
-        # Analyze habit patterns by day of week
-        habit_by_day = {}
-        for log in habit_logs:
-            if log.get("completed"):
-                try:
-                    log_date = datetime.strptime(log["date"], "%Y-%m-%d")
-                    day_name = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"][log_date.weekday()]
-                    habit_by_day[day_name] = habit_by_day.get(day_name, 0) + 1
-                except:
-                    pass
-        
-        best_habit_day = max(habit_by_day, key=habit_by_day.get) if habit_by_day else "No hay datos"
-        worst_habit_day = min(habit_by_day, key=habit_by_day.get) if habit_by_day else "No hay datos"
-        
-        # Get ALL emotional logs for the last 30 days
-        emotional_logs = await db.emotional_logs.find({
-            "user_id": user_id,
-            "date": {"$gte": thirty_days_ago}
-        }).sort("date", -1).to_list(100)
-        
-        # Calculate emotional statistics
-        moods = [e.get("mood") or e.get("mood_scale", 5) for e in emotional_logs]
-        avg_mood = sum(moods) / len(moods) if moods else 0
-        max_mood = max(moods) if moods else 0
-        min_mood = min(moods) if moods else 0
-        
-        # Analyze mood trends
-        mood_trend = "estable"
-        if len(moods) >= 7:
-            recent_avg = sum(moods[:7]) / 7
-            older_avg = sum(moods[7:14]) / 7 if len(moods) >= 14 else recent_avg
-            if recent_avg > older_avg + 0.5:
-                mood_trend = "mejorando"
-            elif recent_avg < older_avg - 0.5:
-                mood_trend = "empeorando"
-        
-        # Get most common emotions/tags
-        all_tags = []
-        for log in emotional_logs:
-            tags = log.get("tags") or log.get("emotions", [])
-            all_tags.extend(tags)
-        
-        tag_counts = {}
-        for tag in all_tags:
-            tag_counts[tag] = tag_counts.get(tag, 0) + 1
-        
-        top_emotions = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)[:5]
-        
-        # Analyze mood by day of week
-        mood_by_day = {}
-        mood_count_by_day = {}
-        for log in emotional_logs:
-            try:
-                log_date = datetime.strptime(log["date"], "%Y-%m-%d")
-                day_name = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"][log_date.weekday()]
-                mood_value = log.get("mood") or log.get("mood_scale", 5)
-                mood_by_day[day_name] = mood_by_day.get(day_name, 0) + mood_value
-                mood_count_by_day[day_name] = mood_count_by_day.get(day_name, 0) + 1
-            except:
-                pass
-        
-        avg_mood_by_day = {day: mood_by_day[day] / mood_count_by_day[day] for day in mood_by_day}
-        best_mood_day = max(avg_mood_by_day, key=avg_mood_by_day.get) if avg_mood_by_day else "No hay datos"
-        worst_mood_day = min(avg_mood_by_day, key=avg_mood_by_day.get) if avg_mood_by_day else "No hay datos"
-        
-        # Get recent notes from emotional logs
-        recent_notes = [log.get("note", "") for log in emotional_logs[:5] if log.get("note")]
-        
-        # Build comprehensive context
-        context_parts = []
-        
-        # Basic info
-        context_parts.append("=== INFORMACIÓN BÁSICA ===")
-        if user and user.get("name"):
-            context_parts.append(f"Nombre: {user['name']}")
-        context_parts.append(f"Rol en la plataforma: {user_role}")
-        
-        # Profile info
-        if profile:
-            context_parts.append("\n=== PERFIL DE RECUPERACIÓN ===")
-            if profile.get("addiction_type"):
-                context_parts.append(f"Tipo de adicción: {profile['addiction_type']}")
-            if profile.get("secondary_addictions"):
-                context_parts.append(f"Adicciones secundarias: {', '.join(profile['secondary_addictions'])}")
-            if profile.get("clean_date"):
-                try:
-                    clean_date = datetime.fromisoformat(profile["clean_date"].replace("Z", "+00:00"))
-                    days_clean = (datetime.now(timezone.utc) - clean_date).days
-                    if days_clean >= 0:
-                        context_parts.append(f"Días en recuperación: {days_clean} días")
-                except:
-                    pass
-            if profile.get("triggers"):
-                context_parts.append(f"Gatillos identificados: {', '.join(profile['triggers'])}")
-            if profile.get("protective_factors"):
-                context_parts.append(f"Factores protectores: {', '.join(profile['protective_factors'])}")
-            if profile.get("my_why"):
-                context_parts.append(f"Su 'Para Qué' (motivación): {profile['my_why']}")
-            if profile.get("life_story"):
-                context_parts.append(f"Historia de vida: {profile['life_story'][:300]}...")
-        
-        # Habits analysis
-        context_parts.append("\n=== ANÁLISIS DE HÁBITOS (últimos 30 días) ===")
-        context_parts.append(f"Hábitos activos: {', '.join(habit_names) if habit_names else 'Ninguno'}")
-        context_parts.append(f"Hábitos completados hoy: {completed_today} de {len(habits)}")
-        context_parts.append(f"Tasa de cumplimiento (30 días): {habit_completion_rate:.1f}%")
-        context_parts.append(f"Mejor día para hábitos: {best_habit_day}")
-        context_parts.append(f"Día más difícil para hábitos: {worst_habit_day}")
-        
-        # Emotional analysis
-        context_parts.append("\n=== ANÁLISIS EMOCIONAL (últimos 30 días) ===")
-        context_parts.append(f"Registros emocionales: {len(emotional_logs)}")
-        context_parts.append(f"Estado de ánimo promedio: {avg_mood:.1f}/10")
-        context_parts.append(f"Mejor momento: {max_mood}/10")
-        context_parts.append(f"Peor momento: {min_mood}/10")
-        context_parts.append(f"Tendencia actual: {mood_trend}")
-        context_parts.append(f"Mejor día anímicamente: {best_mood_day}")
-        context_parts.append(f"Día más difícil anímicamente: {worst_mood_day}")
-        if top_emotions:
-            emotions_str = ", ".join([f"{e[0]} ({e[1]} veces)" for e in top_emotions])
-            context_parts.append(f"Emociones más frecuentes: {emotions_str}")
-        
-        # Recent notes
-        if recent_notes:
-            context_parts.append("\n=== NOTAS RECIENTES DEL USUARIO ===")
-            for i, note in enumerate(recent_notes, 1):
-                context_parts.append(f"{i}. \"{note}\"")
-        
-        # Get purpose analysis if available
-        purpose_analysis = await db.purpose_analyses.find_one(
+        snapshot = await db.nelson_contexts.find_one({"user_id": user_id}, {"_id": 0})
+        if snapshot and nelson_context_fresh(snapshot, datetime.now(timezone.utc)):
+            nelson_context_stats["hits"] += 1
+            return snapshot["context"], snapshot["role_context"]
+        return await refresh_nelson_context(user_id, snapshot.get("version", 0) if snapshot else 0)
+    except Exception as e:
+        nelson_context_stats["errors"] += 1
+        print(f"Error getting Nelson context: {e}")
+        return "No se pudo obtener contexto del usuario.", ROLE_CONTEXTS["patient"]
+
+async def refresh_changed_nelson_context(user_id: str):
+    """Mark the user's snapshot stale now and rebuild it after the debounce delay"""
+    try:
+        snapshot = await db.nelson_contexts.find_one_and_update(
+            {"user_id": user_id}, {"$inc": {"version": 1}}, projection={"_id": 0, "version": 1}
+        )
+        # Only users who talk to Nelson have a snapshot to keep warm
+        if snapshot is None or user_id in nelson_context_pending:
+            return
+        nelson_context_pending.add(user_id)
+        try:
+            await asyncio.sleep(NELSON_CONTEXT_REFRESH_DELAY)
+            snapshot = await db.nelson_contexts.find_one({"user_id": user_id}, {"_id": 0, "version": 1})
+            if snapshot:
+                await refresh_nelson_context(user_id, snapshot.get("version", 0))
+                nelson_context_stats["background_refreshes"] += 1
+        finally:
+            nelson_context_pending.discard(user_id)
+    except Exception as e:
+        nelson_context_stats["errors"] += 1
+        print(f"Error refreshing Nelson context: {e}")
+
+def schedule_nelson_context_refresh(*user_ids: str):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return  # no loop (scripts): snapshots expire by TTL
+    for user_id in user_ids:
+        if user_id:
+            task = loop.create_task(refresh_changed_nelson_context(user_id))
+            nelson_context_tasks.add(task)
+            task.add_done_callback(nelson_context_tasks.discard)
+
+async def build_nelson_user_context(user_id: str) -> tuple[str, str]:
+    """Get comprehensive user context for Nelson to personalize responses and analyze patterns"""
+    thirty_days_ago = (datetime.now(timezone.utc) - timedelta(days=30)).strftime("%Y-%m-%d")
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    
+    # Profile, user info, ALL habits, daily rollups for the last 30 days
+    # and purpose results are independent: fetch them concurrently
+    data = await fan_out({
+        "profile": db.user_profiles.find_one({"user_id": user_id}, {"_id": 0}),
+        "user": db.users.find_one({"user_id": user_id}, {"_id": 0, "name": 1, "email": 1}),
+        "habits": db.habits.find({"user_id": user_id, "is_active": True}).to_list(20),
+        "rollups": get_daily_rollups(user_id, thirty_days_ago),
+        "purpose_analysis": db.purpose_analyses.find_one(
             {"user_id": user_id},
             {"_id": 0}
-        )
-        
-        if purpose_analysis and purpose_analysis.get("analysis"):
-            analysis = purpose_analysis["analysis"]
-            context_parts.append("\n=== ANÁLISIS DE PROPÓSITO DE VIDA ===")
-            if analysis.get("purpose_statement"):
-                context_parts.append(f"Declaración de propósito: {analysis['purpose_statement']}")
-            if analysis.get("core_identity"):
-                context_parts.append(f"Identidad esencial: {analysis['core_identity'][:200]}...")
-            if analysis.get("affirmation"):
-                context_parts.append(f"Afirmación personal: {analysis['affirmation']}")
-            if analysis.get("key_insights"):
-                context_parts.append("Insights clave: " + "; ".join(analysis["key_insights"][:3]))
-            if analysis.get("how_recovery_connects"):
-                context_parts.append(f"Conexión con recuperación: {analysis['how_recovery_connects']}")
-        
-        # Also get purpose test results for values/strengths
-        purpose_test = await db.purpose_tests.find_one(
+        ),
+        "purpose_test": db.purpose_tests.find_one(
             {"user_id": user_id},
             {"_id": 0, "profile": 1}
         )
-        
-        if purpose_test and purpose_test.get("profile"):
-            profile_data = purpose_test["profile"]
-            if not purpose_analysis:  # Only add if we don't have full analysis
-                context_parts.append("\n=== PERFIL DE PROPÓSITO ===")
-            if profile_data.get("purpose_type"):
-                context_parts.append(f"Tipo de propósito: {profile_data['purpose_type']}")
-            if profile_data.get("top_values"):
-                context_parts.append(f"Valores principales: {', '.join(profile_data['top_values'])}")
-            if profile_data.get("top_strengths"):
-                context_parts.append(f"Fortalezas: {', '.join(profile_data['top_strengths'])}")
-        
-        # Patterns and insights
-        context_parts.append("\n=== PATRONES DETECTADOS ===")
-        if habit_completion_rate < 30:
-            context_parts.append("- Baja adherencia a hábitos, puede necesitar ajustar metas o motivación")
-        elif habit_completion_rate > 70:
-            context_parts.append("- Excelente adherencia a hábitos, celebrar este logro")
-        
-        if mood_trend == "empeorando":
-            context_parts.append("- El ánimo ha bajado esta semana, preguntar qué está pasando")
-        elif mood_trend == "mejorando":
-            context_parts.append("- El ánimo está mejorando, reconocer el progreso")
-        
-        if best_habit_day == worst_mood_day:
-            context_parts.append(f"- Curiosamente, {best_habit_day} es su mejor día para hábitos pero peor anímicamente")
-        
-        full_context = "\n".join(context_parts)
-        
-        return full_context, role_context
-        
-    except Exception as e:
-        print(f"Error getting Nelson context: {e}")
-        return "No se pudo obtener contexto del usuario.", ROLE_CONTEXTS["patient"]
+    }, defaults={"habits": [], "rollups": []})
+    
+    profile = data["profile"]
+    user_role = profile.get("role", "patient") if profile else "patient"
+    
+    # Get role-specific context
+    role_context = ROLE_CONTEXTS.get(user_role, ROLE_CONTEXTS["patient"])
+    
+    user = data["user"]
+    habits = data["habits"]
+    habit_names = [h.get("name", "Sin nombre") for h in habits]
+    rollups = data["rollups"]
+    
+    # Calculate habit statistics
+    total_possible = len(habits) * 30
+    total_completed = sum(r.get("habits_completed", 0) for r in rollups)
+    habit_completion_rate = (total_completed / total_possible * 100) if total_possible > 0 else 0
+    
+    # Get today's completions
+    completed_today = sum(r.get("habits_completed", 0) for r in rollups if r["date"] == today)
+    
+    # Analyze habit patterns by day of week
+    habit_by_day = {}
+    for rollup in rollups:
+        if rollup.get("habits_completed"):
+            try:
+                log_date = datetime.strptime(rollup["date"], "%Y-%m-%d")
+                day_name = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"][log_date.weekday()]
+                habit_by_day[day_name] = habit_by_day.get(day_name, 0) + rollup["habits_completed"]
+            except:
+                pass
+    
+    best_habit_day = max(habit_by_day, key=habit_by_day.get) if habit_by_day else "No hay datos"
+    worst_habit_day = min(habit_by_day, key=habit_by_day.get) if habit_by_day else "No hay datos"
+    
+    # Days with an emotional log, most recent first
+    emotional_logs = [r for r in reversed(rollups) if r.get("mood") is not None][:100]
+    
+    # Calculate emotional statistics
+    moods = [e["mood"] for e in emotional_logs]
+    avg_mood = sum(moods) / len(moods) if moods else 0
+    max_mood = max(moods) if moods else 0
+    min_mood = min(moods) if moods else 0
+    
+    # Analyze mood trends
+    mood_trend = "estable"
+    if len(moods) >= 7:
+        recent_avg = sum(moods[:7]) / 7
+        older_avg = sum(moods[7:14]) / 7 if len(moods) >= 14 else recent_avg
+        if recent_avg > older_avg + 0.5:
+            mood_trend = "mejorando"
+        elif recent_avg < older_avg - 0.5:
+            mood_trend = "empeorando"
+    
+    # Get most common emotions/tags
+    all_tags = []
+    for log in emotional_logs:
+        all_tags.extend(log.get("tags", []))
+    
+    tag_counts = {}
+    for tag in all_tags:
+        tag_counts[tag] = tag_counts.get(tag, 0) + 1
+    
+    top_emotions = sorted(tag_counts.items(), key=lambda x: x[1], reverse=True)[:5]
+    
+    # Analyze mood by day of week
+    mood_by_day = {}
+    mood_count_by_day = {}
+    for log in emotional_logs:
+        try:
+            log_date = datetime.strptime(log["date"], "%Y-%m-%d")
+            day_name = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"][log_date.weekday()]
+            mood_by_day[day_name] = mood_by_day.get(day_name, 0) + log["mood"]
+            mood_count_by_day[day_name] = mood_count_by_day.get(day_name, 0) + 1
+        except:
+            pass
+    
+    avg_mood_by_day = {day: mood_by_day[day] / mood_count_by_day[day] for day in mood_by_day}
+    best_mood_day = max(avg_mood_by_day, key=avg_mood_by_day.get) if avg_mood_by_day else "No hay datos"
+    worst_mood_day = min(avg_mood_by_day, key=avg_mood_by_day.get) if avg_mood_by_day else "No hay datos"
+    
+    # Get recent notes from emotional logs
+    recent_notes = [log.get("note", "") for log in emotional_logs[:5] if log.get("note")]
+    
+    # Build comprehensive context
+    context_parts = []
+    
+    # Basic info
+    context_parts.append("=== INFORMACIÓN BÁSICA ===")
+    if user and user.get("name"):
+        context_parts.append(f"Nombre: {user['name']}")
+    context_parts.append(f"Rol en la plataforma: {user_role}")
+    
+    # Profile info
+    if profile:
+        context_parts.append("\n=== PERFIL DE RECUPERACIÓN ===")
+        if profile.get("addiction_type"):
+            context_parts.append(f"Tipo de adicción: {profile['addiction_type']}")
+        if profile.get("secondary_addictions"):
+            context_parts.append(f"Adicciones secundarias: {', '.join(profile['secondary_addictions'])}")
+        if profile.get("clean_date"):
+            try:
+                clean_date = datetime.fromisoformat(profile["clean_date"].replace("Z", "+00:00"))
+                days_clean = (datetime.now(timezone.utc) - clean_date).days
+                if days_clean >= 0:
+                    context_parts.append(f"Días en recuperación: {days_clean} días")
+            except:
+                pass
+        if profile.get("triggers"):
+            context_parts.append(f"Gatillos identificados: {', '.join(profile['triggers'])}")
+        if profile.get("protective_factors"):
+            context_parts.append(f"Factores protectores: {', '.join(profile['protective_factors'])}")
+        if profile.get("my_why"):
+            context_parts.append(f"Su 'Para Qué' (motivación): {profile['my_why']}")
+        if profile.get("life_story"):
+            context_parts.append(f"Historia de vida: {profile['life_story'][:300]}...")
+    
+    # Habits analysis
+    context_parts.append("\n=== ANÁLISIS DE HÁBITOS (últimos 30 días) ===")
+    context_parts.append(f"Hábitos activos: {', '.join(habit_names) if habit_names else 'Ninguno'}")
+    context_parts.append(f"Hábitos completados hoy: {completed_today} de {len(habits)}")
+    context_parts.append(f"Tasa de cumplimiento (30 días): {habit_completion_rate:.1f}%")
+    context_parts.append(f"Mejor día para hábitos: {best_habit_day}")
+    context_parts.append(f"Día más difícil para hábitos: {worst_habit_day}")
+    
+    # Emotional analysis
+    context_parts.append("\n=== ANÁLISIS EMOCIONAL (últimos 30 días) ===")
+    context_parts.append(f"Registros emocionales: {len(emotional_logs)}")
+    context_parts.append(f"Estado de ánimo promedio: {avg_mood:.1f}/10")
+    context_parts.append(f"Mejor momento: {max_mood}/10")
+    context_parts.append(f"Peor momento: {min_mood}/10")
+    context_parts.append(f"Tendencia actual: {mood_trend}")
+    context_parts.append(f"Mejor día anímicamente: {best_mood_day}")
+    context_parts.append(f"Día más difícil anímicamente: {worst_mood_day}")
+    if top_emotions:
+        emotions_str = ", ".join([f"{e[0]} ({e[1]} veces)" for e in top_emotions])
+        context_parts.append(f"Emociones más frecuentes: {emotions_str}")
+    
+    # Recent notes
+    if recent_notes:
+        context_parts.append("\n=== NOTAS RECIENTES DEL USUARIO ===")
+        for i, note in enumerate(recent_notes, 1):
+            context_parts.append(f"{i}. \"{note}\"")
+    
+    # Purpose analysis if available
+    purpose_analysis = data["purpose_analysis"]
+    
+    if purpose_analysis and purpose_analysis.get("analysis"):
+        analysis = purpose_analysis["analysis"]
+        context_parts.append("\n=== ANÁLISIS DE PROPÓSITO DE VIDA ===")
+        if analysis.get("purpose_statement"):
+            context_parts.append(f"Declaración de propósito: {analysis['purpose_statement']}")
+        if analysis.get("core_identity"):
+            context_parts.append(f"Identidad esencial: {analysis['core_identity'][:200]}...")
+        if analysis.get("affirmation"):
+            context_parts.append(f"Afirmación personal: {analysis['affirmation']}")
+        if analysis.get("key_insights"):
+            context_parts.append("Insights clave: " + "; ".join(analysis["key_insights"][:3]))
+        if analysis.get("how_recovery_connects"):
+            context_parts.append(f"Conexión con recuperación: {analysis['how_recovery_connects']}")
+    
+    # Also purpose test results for values/strengths
+    purpose_test = data["purpose_test"]
+    
+    if purpose_test and purpose_test.get("profile"):
+        profile_data = purpose_test["profile"]
+        if not purpose_analysis:  # Only add if we don't have full analysis
+            context_parts.append("\n=== PERFIL DE PROPÓSITO ===")
+        if profile_data.get("purpose_type"):
+            context_parts.append(f"Tipo de propósito: {profile_data['purpose_type']}")
+        if profile_data.get("top_values"):
+            context_parts.append(f"Valores principales: {', '.join(profile_data['top_values'])}")
+        if profile_data.get("top_strengths"):
+            context_parts.append(f"Fortalezas: {', '.join(profile_data['top_strengths'])}")
+    
+    # Patterns and insights
+    context_parts.append("\n=== PATRONES DETECTADOS ===")
+    if habit_completion_rate < 30:
+        context_parts.append("- Baja adherencia a hábitos, puede necesitar ajustar metas o motivación")
+    elif habit_completion_rate > 70:
+        context_parts.append("- Excelente adherencia a hábitos, celebrar este logro")
+    
+    if mood_trend == "empeorando":
+        context_parts.append("- El ánimo ha bajado esta semana, preguntar qué está pasando")
+    elif mood_trend == "mejorando":
+        context_parts.append("- El ánimo está mejorando, reconocer el progreso")
+    
+    if best_habit_day == worst_mood_day:
+        context_parts.append(f"- Curiosamente, {best_habit_day} es su mejor día para hábitos pero peor anímicamente")
+    
+    full_context = "\n".join(context_parts)
+    
+    return full_context, role_context
 
 @app.get("/api/nelson/conversation")
 async def get_nelson_conversation(current_user: User = Depends(get_current_user)):
@@ -6424,21 +9565,19 @@ async def get_nelson_summary(current_user: User = Depends(get_current_user)):
             for msg in recent_messages
         ])
         
-        client = await get_openai_client()
-        if not client:
+        if not llm_gateway.available:
             return {"summary": "No se pudo generar el resumen."}
         
-        response = await client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Eres un asistente que resume conversaciones terapéuticas. Genera un resumen breve (3-4 oraciones) de los temas principales, el estado emocional del usuario, y cualquier progreso o preocupación notable."},
-                {"role": "user", "content": f"Resume esta conversación:\n\n{conv_text}"}
-            ],
+        summary = await llm_gateway.ask(
+            "Eres un asistente que resume conversaciones terapéuticas. Genera un resumen breve (3-4 oraciones) de los temas principales, el estado emocional del usuario, y cualquier progreso o preocupación notable.",
+            f"Resume esta conversación:\n\n{conv_text}",
+            user_id=current_user.user_id,
+            purpose="nelson_summary",
             temperature=0.5,
             max_tokens=200
         )
         
-        return {"summary": response.choices[0].message.content}
+        return {"summary": summary}
         
     except Exception as e:
         print(f"Error generating Nelson summary: {e}")
@@ -6590,24 +9729,13 @@ async def get_today_notification(current_user: User = Depends(get_current_user))
 
 # Helper function to send push notification via Expo
 async def send_expo_push_notification(push_token: str, title: str, body: str, data: dict = None):
-    """Send a push notification via Expo Push API"""
+    """Send a push notification via Expo Push API; returns the push ticket (None on error)"""
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                "https://exp.host/--/api/v2/push/send",
-                json={
-                    "to": push_token,
-                    "title": title,
-                    "body": body,
-                    "data": data or {},
-                    "sound": "default"
-                },
-                headers={"Content-Type": "application/json"}
-            )
-            return response.json()
+        tickets = await push_dispatcher.send([push_message(push_token, title, body, data, badge=None)])
     except Exception as e:
         print(f"Error sending push notification: {e}")
         return None
+    return tickets[0] if tickets[0].get("status") == "ok" else None
 
 @app.post("/api/notifications/send-test")
 async def send_test_notification(current_user: User = Depends(get_current_user)):
@@ -6737,6 +9865,8 @@ async def setup_demo_user():
             },
             upsert=True
         )
+    await refresh_activity_counters([demo_user_id])
+    invalidate_dashboard(demo_user_id)
     
     return {
         "success": True,
@@ -6768,6 +9898,7 @@ async def setup_paciente_demo():
     await db.habit_logs.delete_many({"user_id": demo_user_id})
     await db.emotional_logs.delete_many({"user_id": demo_user_id})
     await db.purpose_tests.delete_many({"user_id": demo_user_id})
+    await db.user_daily_rollups.delete_many({"user_id": demo_user_id})
     
     # Create fresh user
     await db.users.insert_one({
@@ -6873,6 +10004,9 @@ async def setup_paciente_demo():
                     "date": log_date,
                     "logged_at": datetime.now(timezone.utc) - timedelta(days=i)
                 })
+    await refresh_activity_counters([demo_user_id])
+    await backfill_daily_rollups([demo_user_id])
+    invalidate_dashboard(demo_user_id)
     
     return {
         "success": True,
@@ -7000,6 +10134,7 @@ async def setup_demo_professional():
         },
         upsert=True
     )
+    invalidate_dashboard(demo_user_id, patient_demo_id)
     
     return {
         "success": True,
@@ -7066,6 +10201,7 @@ async def setup_admin_user():
         },
         upsert=True
     )
+    invalidate_dashboard(admin_user_id)
     
     return {
         "success": True,
@@ -7077,71 +10213,6 @@ async def setup_admin_user():
     }
 
 
-@app.get("/api/admin/stats")
-async def get_admin_stats(current_user: User = Depends(get_current_user)):
-    """Get global app statistics - Admin only"""
-    # Verify admin
-    profile = await db.user_profiles.find_one({"user_id": current_user.user_id})
-    if not profile or not profile.get("is_admin"):
-        raise HTTPException(status_code=403, detail="Solo administradores")
-    
-    # Get counts
-    total_users = await db.users.count_documents({})
-    total_patients = await db.user_profiles.count_documents({"role": "patient"})
-    total_professionals = await db.user_profiles.count_documents({"role": "professional"})
-    total_active_users = await db.user_profiles.count_documents({"role": "active_user"})
-    total_family = await db.user_profiles.count_documents({"role": "family"})
-    
-    # Emotional logs in last 7 days
-    week_ago = datetime.now(timezone.utc) - timedelta(days=7)
-    recent_emotional_logs = await db.emotional_logs.count_documents({
-        "logged_at": {"$gte": week_ago}
-    })
-    
-    # Habits logged in last 7 days
-    recent_habit_logs = await db.habit_logs.count_documents({
-        "logged_at": {"$gte": week_ago}
-    })
-    
-    # Push tokens registered
-    push_tokens = await db.push_tokens.count_documents({})
-    
-    return {
-        "success": True,
-        "stats": {
-            "total_users": total_users,
-            "by_role": {
-                "patients": total_patients,
-                "professionals": total_professionals,
-                "active_users": total_active_users,
-                "family": total_family
-            },
-            "activity_last_7_days": {
-                "emotional_logs": recent_emotional_logs,
-                "habit_logs": recent_habit_logs
-            },
-            "push_tokens_registered": push_tokens
-        }
-    }
-
-
-@app.get("/api/admin/users")
-async def get_admin_users(current_user: User = Depends(get_current_user)):
-    """Get all users list - Admin only (no sensitive data)"""
-    # Verify admin
-    profile = await db.user_profiles.find_one({"user_id": current_user.user_id})
-    if not profile or not profile.get("is_admin"):
-        raise HTTPException(status_code=403, detail="Solo administradores")
-    
-    users = await db.user_profiles.find(
-        {},
-        {"_id": 0, "user_id": 1, "name": 1, "email": 1, "role": 1, "days_clean": 1, "created_at": 1, "onboarding_completed": 1}
-    ).to_list(500)
-    
-    return {"success": True, "users": users, "total": len(users)}
-
-
-
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,43 @@
+"""
+Shared test fixtures
+with_database runs an async scenario against a scratch MongoDB database
+(MONGO_URL, defaults to localhost) and drops it afterwards. Tests that use
+it are skipped when MongoDB is not reachable.
+"""
+
+import asyncio
+import os
+
+import pytest
+from motor.motor_asyncio import AsyncIOMotorClient
+
+MONGO_URL = os.environ.get("MONGO_URL", "mongodb://localhost:27017")
+
+
+async def _run_with_database(scenario, name, client_options):
+    # The client is created inside the loop that uses it: Motor clients are
+    # bound to the event loop of their first operation
+    client = AsyncIOMotorClient(MONGO_URL, serverSelectionTimeoutMS=2000, **client_options)
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        client.close()
+        pytest.skip(f"MongoDB not reachable at {MONGO_URL}: {e}")
+
+    await client.drop_database(name)
+    try:
+        return await scenario(client[name])
+    finally:
+        await client.drop_database(name)
+        client.close()
+
+
+@pytest.fixture(scope="session")
+def with_database():
+    """Run scenario(database) on a scratch database and return its result
+
+    Extra keyword arguments go to AsyncIOMotorClient (e.g. event_listeners).
+    """
+    def run(scenario, name="sinadicciones_test", **client_options):
+        return asyncio.run(_run_with_database(scenario, name, client_options))
+    return run
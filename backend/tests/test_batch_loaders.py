@@ -0,0 +1,180 @@
+"""
+Batched loader tests
+Seeds a scratch database with a professional, N linked patients and N family
+link requests, then counts the MongoDB round-trips issued by each endpoint
+that enriches rows with user data. The count must not grow with N:
+- GET /api/professional/patients
+- scan_patient_alerts (user lookups per batch)
+- GET /api/patient/link-requests
+- GET /api/admin/users (a page aggregation and a count once activity counters
+  exist; one aggregation when searching)
+- GET /api/admin/activity
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+
+import pytest
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from server import RequestLoaders, User  # noqa: E402
+
+TEST_DB = "sinadicciones_loader_test"
+
+PROFESSIONAL = User(user_id="user_pro", email="pro@test.org", name="Pro", created_at=datetime.now(timezone.utc))
+PATIENT = User(user_id="user_patient_0", email="p0@test.org", name="P0", created_at=datetime.now(timezone.utc))
+ADMIN = User(user_id="user_admin", email=server.ADMIN_EMAIL, name="Admin", created_at=datetime.now(timezone.utc))
+
+SIZES = (3, 30)
+
+
+def _endpoint(path):
+    """Handler FastAPI dispatches GET path to (the first registered route)"""
+    for route in server.app.routes:
+        if getattr(route, "path", None) == path and "GET" in route.methods:
+            return route.endpoint
+    raise LookupError(path)
+
+
+class RoundTripCounter(monitoring.CommandListener):
+    """Count read commands sent to the server"""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name in ("find", "getMore", "aggregate", "count"):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def _seed(database, patients):
+    now = datetime.now(timezone.utc)
+    await database.users.insert_many(
+        [{"user_id": "user_pro", "name": "Pro", "email": "pro@test.org", "created_at": now}]
+        + [{"user_id": f"user_patient_{i}", "name": f"P{i}", "email": f"p{i}@test.org", "created_at": now} for i in range(patients)]
+        + [{"user_id": f"user_family_{i}", "name": f"F{i}", "email": f"f{i}@test.org", "created_at": now} for i in range(patients)]
+    )
+    await database.user_profiles.insert_many(
+        [{"user_id": "user_pro", "role": "professional"}]
+        + [{"user_id": f"user_patient_{i}", "role": "patient", "linked_therapist_id": "user_pro"} for i in range(patients)]
+        + [{"user_id": f"user_family_{i}", "role": "family", "relationship_to_addict": "madre"} for i in range(patients)]
+    )
+    await database.family_link_requests.insert_many([
+        {"request_id": f"req_{i}", "family_user_id": f"user_family_{i}", "patient_user_id": "user_patient_0", "status": "pending", "created_at": now}
+        for i in range(patients)
+    ])
+    await database.emotional_logs.insert_many([
+        {"log_id": f"elog_{i}", "user_id": f"user_patient_{i}", "mood_scale": 5, "date": now.strftime("%Y-%m-%d")}
+        for i in range(patients)
+    ])
+    await database.relapses.insert_many([
+        {"relapse_id": f"relapse_{i}", "user_id": f"user_patient_{i}", "date": now.strftime("%Y-%m-%d"), "reported_at": now}
+        for i in range(min(patients, 10))
+    ])
+
+
+async def _count_round_trips(database, counter):
+    original_db = server.db
+    server.db = database
+    calls = {
+        "patients": lambda loaders: _endpoint("/api/professional/patients")(PROFESSIONAL, loaders),
+        "link_requests": lambda loaders: _endpoint("/api/patient/link-requests")(PATIENT, loaders),
+        "admin_users": lambda loaders: _endpoint("/api/admin/users")(current_user=ADMIN, limit=50),
+        "admin_activity": lambda loaders: _endpoint("/api/admin/activity")(ADMIN, loaders),
+    }
+    results = {}
+    try:
+        for size in SIZES:
+            await database.client.drop_database(database.name)
+            await _seed(database, size)
+            for label, call in calls.items():
+                loaders = RequestLoaders(database)
+                counter.count = 0
+                await call(loaders)
+                results[(label, size)] = (counter.count, loaders.users.queries)
+
+            # Activity counters were backfilled by the first directory page
+            counter.count = 0
+            await calls["admin_users"](None)
+            results[("admin_users_warm", size)] = (counter.count, 0)
+            counter.count = 0
+            await _endpoint("/api/admin/users")(current_user=ADMIN, search="test.org", limit=50)
+            results[("admin_users_search", size)] = (counter.count, 0)
+
+            loaders = RequestLoaders(database)
+            patients = {f"user_patient_{i}": "user_pro" for i in range(size)}
+            await server.evaluate_patient_alerts(patients, await loaders.users.load_many(patients), datetime.now(timezone.utc))
+            results[("alerts_user_lookups", size)] = (loaders.users.queries, loaders.users.queries)
+        return results
+    finally:
+        server.db = original_db
+
+
+@pytest.fixture(scope="module")
+def round_trips(with_database):
+    counter = RoundTripCounter()
+    return with_database(lambda database: _count_round_trips(database, counter), TEST_DB, event_listeners=[counter])
+
+
+class TestBatchedEnrichment:
+    """Enrichment endpoints issue a fixed number of queries per request"""
+
+    @pytest.mark.parametrize("label", ["patients", "link_requests", "admin_users", "admin_activity"])
+    def test_round_trips_do_not_grow_with_rows(self, round_trips, label):
+        small, large = (round_trips[(label, size)][0] for size in SIZES)
+        assert small == large, f"{label}: {small} round-trips for {SIZES[0]} rows, {large} for {SIZES[1]}"
+
+    @pytest.mark.parametrize("label", ["patients", "link_requests", "admin_activity", "alerts_user_lookups"])
+    def test_users_resolved_with_one_query(self, round_trips, label):
+        for size in SIZES:
+            assert round_trips[(label, size)][1] == 1
+
+    def test_admin_directory_page_is_fixed_queries(self, round_trips):
+        for size in SIZES:
+            assert round_trips[("admin_users_warm", size)][0] == 2
+            assert round_trips[("admin_users_search", size)][0] == 1
+
+
+class TestBatchLoader:
+    """Loads in the same event loop turn are coalesced into one $in query"""
+
+    def test_coalesces_and_memoizes(self):
+        class FakeCursor:
+            def __init__(self, documents):
+                self.documents = documents
+
+            async def to_list(self, length):
+                return self.documents
+
+        class FakeCollection:
+            def __init__(self):
+                self.filters = []
+
+            def find(self, query, projection):
+                self.filters.append(query)
+                keys = query["user_id"]["$in"]
+                return FakeCursor([{"user_id": key} for key in keys if key != "missing"])
+
+        async def run():
+            collection = FakeCollection()
+            loader = server.BatchLoader(collection)
+            first = await asyncio.gather(loader.load("a"), loader.load("b"), loader.load("a"), loader.load("missing"))
+            again = await loader.load_many(["a", "b"])
+            return collection.filters, first, again, loader.queries
+
+        filters, first, again, queries = asyncio.run(run())
+        assert queries == 1
+        assert filters == [{"user_id": {"$in": ["a", "b", "missing"]}}]
+        assert first == [{"user_id": "a"}, {"user_id": "b"}, {"user_id": "a"}, None]
+        assert again == {"a": {"user_id": "a"}, "b": {"user_id": "b"}}
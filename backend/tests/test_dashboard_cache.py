@@ -0,0 +1,100 @@
+"""
+Integrated dashboard cache tests
+Entries are per user and day, dropped by writes, never refilled with a payload
+computed before a write, and validated with ETag / If-None-Match. Payloads
+built from fallback data are neither cached nor tagged.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+
+from fastapi import Response
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from server import DashboardCache, User, etag_matches  # noqa: E402
+
+USER = User(user_id="user_a", email="a@test.org", name="A", created_at=datetime.now(timezone.utc))
+
+
+class FakeRequest:
+    headers = {}
+
+
+class TestDashboardCache:
+    """Per-user entries keyed by date with write invalidation"""
+
+    def test_hit_until_invalidated(self):
+        cache = DashboardCache(max_size=10, ttl=60)
+        etag = cache.set("user_a", "2026-01-01", {"habits": 1}, time.monotonic())
+        assert cache.get("user_a", "2026-01-01") == ({"habits": 1}, etag)
+        assert cache.get("user_a", "2026-01-02") is None
+
+        cache.invalidate_user("user_a")
+        assert cache.get("user_a", "2026-01-01") is None
+
+    def test_payload_computed_before_a_write_is_not_cached(self):
+        cache = DashboardCache(max_size=10, ttl=60)
+        computed_since = time.monotonic()
+        cache.invalidate_user("user_a")
+        cache.set("user_a", "2026-01-01", {"habits": 1}, computed_since)
+        assert cache.get("user_a", "2026-01-01") is None
+
+    def test_size_is_bounded(self):
+        cache = DashboardCache(max_size=2, ttl=60)
+        for user_id in ("user_a", "user_b", "user_c"):
+            cache.set(user_id, "2026-01-01", {}, time.monotonic())
+        assert cache.get("user_a", "2026-01-01") is None
+        assert cache.stats()["size"] == 2
+
+    def test_etag_depends_on_content(self):
+        cache = DashboardCache(max_size=10, ttl=60)
+        first = cache.set("user_a", "2026-01-01", {"habits": 1}, time.monotonic())
+        same = cache.set("user_b", "2026-01-01", {"habits": 1}, time.monotonic())
+        other = cache.set("user_c", "2026-01-01", {"habits": 2}, time.monotonic())
+        assert first == same != other
+
+
+class TestEtagMatches:
+    """If-None-Match parsing"""
+
+    def test_matches(self):
+        assert etag_matches('"abc"', '"abc"')
+        assert etag_matches('W/"abc"', '"abc"')
+        assert etag_matches('"xyz", "abc"', '"abc"')
+        assert etag_matches("*", '"abc"')
+
+    def test_does_not_match(self):
+        assert not etag_matches(None, '"abc"')
+        assert not etag_matches('"xyz"', '"abc"')
+
+
+class TestIntegratedDashboard:
+    """Only complete payloads are cached and get an ETag"""
+
+    def _get(self, monkeypatch, complete):
+        async def build(current_user):
+            return {"habits": {"total": 0}}, complete
+        cache = DashboardCache(max_size=10, ttl=60)
+        monkeypatch.setattr(server, "dashboard_cache", cache)
+        monkeypatch.setattr(server, "build_integrated_dashboard", build)
+        response = Response()
+        payload = asyncio.run(server.get_integrated_dashboard(FakeRequest(), response, USER))
+        return payload, response, cache
+
+    def test_complete_payload_is_cached(self, monkeypatch):
+        payload, response, cache = self._get(monkeypatch, complete=True)
+        assert payload == {"habits": {"total": 0}}
+        assert "etag" in response.headers
+        assert cache.stats()["size"] == 1
+
+    def test_partial_payload_is_not_cached(self, monkeypatch):
+        payload, response, cache = self._get(monkeypatch, complete=False)
+        assert payload == {"habits": {"total": 0}}
+        assert "etag" not in response.headers
+        assert response.headers["cache-control"] == "no-store"
+        assert cache.stats()["size"] == 0
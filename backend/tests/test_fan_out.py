@@ -0,0 +1,51 @@
+"""
+Concurrent fan-out tests
+fan_out() runs independent branches concurrently, bounds each one with its own
+timeout and isolates failures so one slow or broken query does not take the
+whole response down.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import fan_out  # noqa: E402
+
+
+async def _value(value, delay):
+    await asyncio.sleep(delay)
+    return value
+
+
+async def _fail(delay=0):
+    await asyncio.sleep(delay)
+    raise ValueError("branch failed")
+
+
+class TestFanOut:
+    """Latency is the slowest branch, failures fall back to defaults"""
+
+    def test_branches_run_concurrently(self):
+        started = time.perf_counter()
+        result = asyncio.run(fan_out({name: _value(name, 0.2) for name in "abcde"}))
+        elapsed = time.perf_counter() - started
+        assert result == {name: name for name in "abcde"}
+        assert elapsed < 0.5
+
+    def test_timeout_and_error_use_defaults(self):
+        result = asyncio.run(fan_out(
+            {"slow": _value("late", 1), "broken": _fail(), "ok": _value([1], 0)},
+            defaults={"slow": [], "broken": 0},
+            timeout=0.1
+        ))
+        assert result == {"slow": [], "broken": 0, "ok": [1]}
+        assert result.fallbacks == {"slow", "broken"}
+
+    def test_required_branch_failure_is_raised(self):
+        with pytest.raises(ValueError):
+            asyncio.run(fan_out({"guard": _fail(), "ok": _value(1, 0)}, required=("guard",)))
@@ -0,0 +1,123 @@
+"""
+Index provisioning tests
+Runs ensure_indexes() against a scratch database and checks with explain()
+that the hot queries used by the endpoints are answered by an index (IXSCAN)
+instead of a collection scan:
+- GET /api/auth/* (get_current_user session + user lookup)
+- GET /api/habits, /api/dashboard/*, /api/professional/patient/{id} (streaks)
+- GET /api/emotional-logs, /api/professional/patients
+- GET /api/wellness/*, /api/habits/analysis/*, /api/emotional/analysis/* (daily rollups)
+- GET /api/notifications/*, /api/messages/conversation/{id}
+- GET /api/professional/alerts (persisted alerts) and alert auto-resolution
+- admin_stats snapshot refresh (7-day active users)
+"""
+
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import ensure_indexes, INDEX_SPECS  # noqa: E402
+
+TEST_DB = "sinadicciones_index_test"
+
+TODAY = "2026-01-15"
+
+# (label, collection, filter, sort) - mirrors the queries issued by server.py
+HOT_QUERIES = [
+    ("session_by_token", "user_sessions", {"session_token": "sess_test"}, None),
+    ("user_by_id", "users", {"user_id": "user_test"}, None),
+    ("profile_by_user", "user_profiles", {"user_id": "user_test"}, None),
+    ("patients_of_therapist", "user_profiles", {"linked_therapist_id": "user_pro"}, None),
+    ("active_habits", "habits", {"user_id": "user_test", "is_active": True}, [("created_at", -1)]),
+    ("habit_day_completed", "habit_logs", {"habit_id": "habit_test", "date": TODAY, "completed": True}, None),
+    ("habit_streak_logs", "habit_logs", {"habit_id": "habit_test", "completed": True}, [("date", -1)]),
+    ("habit_streaks_bulk", "habit_logs", {
+        "habit_id": {"$in": ["habit_a", "habit_b"]},
+        "completed": True
+    }, None),
+    ("user_logs_today", "habit_logs", {"user_id": "user_test", "date": TODAY, "completed": True}, None),
+    ("emotional_window", "emotional_logs", {"user_id": "user_test", "date": {"$gte": "2026-01-01"}}, [("date", 1)]),
+    ("emotional_latest", "emotional_logs", {"user_id": "user_test"}, [("date", -1)]),
+    ("relapses_recent", "relapses", {"user_id": "user_test"}, [("reported_at", -1)]),
+    ("notifications_unread", "notifications", {"user_id": "user_test", "read": False}, [("created_at", -1)]),
+    ("notifications_all", "notifications", {"user_id": "user_test"}, [("created_at", -1)]),
+    ("messages_conversation", "messages", {
+        "$or": [
+            {"from_user_id": "user_a", "to_user_id": "user_b"},
+            {"from_user_id": "user_b", "to_user_id": "user_a"}
+        ]
+    }, [("created_at", 1)]),
+    ("messages_unread", "messages", {"to_user_id": "user_test", "read": False}, None),
+    ("push_token_by_user", "push_tokens", {"user_id": "user_test"}, None),
+    ("push_tokens_prune", "push_tokens", {"push_token": {"$in": ["ExponentPushToken[a]"]}}, None),
+    ("push_receipts_due", "push_receipts", {"created_at": {"$lte": datetime(2026, 1, 8)}}, [("created_at", 1)]),
+    ("professional_alerts", "alerts", {"professional_id": "user_pro", "is_resolved": False}, [("severity_rank", 1), ("created_at", -1)]),
+    ("patient_open_alerts", "alerts", {"patient_id": "user_test", "is_resolved": False, "alert_type": "inactivity"}, None),
+    ("expired_alerts", "alerts", {"is_resolved": False, "expires_at": {"$lte": datetime(2026, 1, 8)}}, None),
+    ("daily_rollups_window", "user_daily_rollups", {"user_id": "user_test", "date": {"$gte": "2026-01-01"}}, [("date", 1)]),
+    ("active_emotional_window", "emotional_logs", {"logged_at": {"$gte": datetime(2026, 1, 8)}}, None),
+    ("active_habit_window", "habit_logs", {"logged_at": {"$gte": datetime(2026, 1, 8)}}, None),
+    ("goals_by_user", "purpose_goals", {"user_id": "user_test", "status": {"$ne": "deleted"}}, [("created_at", -1)]),
+]
+
+
+def _stages(plan):
+    """Yield every stage name in a (possibly nested) query plan"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from _stages(value)
+    elif isinstance(plan, list):
+        for item in plan:
+            yield from _stages(item)
+
+
+async def _collect_plans(database):
+    first = await ensure_indexes(database)
+    second = await ensure_indexes(database)
+
+    plans = {}
+    for label, collection, query, sort in HOT_QUERIES:
+        cursor = database[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        plans[label] = explain["queryPlanner"]["winningPlan"]
+    return (first, second), plans
+
+
+@pytest.fixture(scope="module")
+def index_run(with_database):
+    return with_database(_collect_plans, TEST_DB)
+
+
+class TestIndexProvisioning:
+    """ensure_indexes creates every declared index once and is idempotent"""
+
+    def test_creates_all_declared_indexes(self, index_run):
+        (first, _), _ = index_run
+        expected = sum(len(specs) for specs in INDEX_SPECS.values())
+        assert len(first["created"]) == expected, first["errors"]
+        assert first["errors"] == []
+
+    def test_second_run_is_noop(self, index_run):
+        (_, second), _ = index_run
+        assert second["created"] == []
+        assert second["drift"] == []
+        assert second["errors"] == []
+
+
+class TestQueryPlans:
+    """Hot endpoint queries must be served by an index"""
+
+    @pytest.mark.parametrize("label", [q[0] for q in HOT_QUERIES])
+    def test_query_uses_index(self, index_run, label):
+        _, plans = index_run
+        stages = list(_stages(plans[label]))
+        assert "IXSCAN" in stages, f"{label} plan has no IXSCAN: {stages}"
+        assert "COLLSCAN" not in stages, f"{label} falls back to COLLSCAN: {stages}"
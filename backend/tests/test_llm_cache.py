@@ -0,0 +1,121 @@
+"""
+LLM response cache tests
+Answers are keyed by (model, system message, prompt), served from the
+in-process LRU or the llm_cache collection, shared by concurrent identical
+requests, and only stored when they are valid JSON.
+"""
+
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import FakeLLMBackend, LLMGateway, LLMResponseCache, is_json_response, llm_cache_key  # noqa: E402
+
+TEST_DB = "sinadicciones_llm_cache_test"
+
+
+class TestKeys:
+    """Keys change with any part of the content"""
+
+    def test_key_is_content_addressed(self):
+        key = llm_cache_key("sys", "datos", "gpt-4o")
+        assert key == llm_cache_key("sys", "datos", "gpt-4o")
+        assert key != llm_cache_key("sys", "datos distintos", "gpt-4o")
+        assert key != llm_cache_key("otro sys", "datos", "gpt-4o")
+        assert key != llm_cache_key("sys", "datos", "gpt-4o-mini")
+
+    def test_json_detection(self):
+        assert is_json_response('```json\n{"resumen": "ok"}\n```')
+        assert not is_json_response("Lo siento, no puedo")
+
+    def test_disabled_cache_always_calls(self):
+        async def scenario():
+            cache = LLMResponseCache(ttl=0)
+            backend = FakeLLMBackend(["{}", "{}"])
+            gateway = LLMGateway(backend)
+            for _ in range(2):
+                await cache.get_or_call("k", lambda: gateway.ask("s", "p"), "gpt-4o", "test")
+            return len(backend.calls)
+
+        assert asyncio.run(scenario()) == 2
+
+    def test_request_during_the_upsert_is_served_from_memory(self):
+        class SlowCollection:
+            """llm_cache stand-in whose upsert waits until released"""
+
+            def __init__(self):
+                self.upserting = asyncio.Event()
+                self.release = asyncio.Event()
+
+            async def find_one(self, query, projection):
+                return None
+
+            async def update_one(self, query, update, upsert):
+                self.upserting.set()
+                await self.release.wait()
+
+        async def scenario():
+            collection = SlowCollection()
+            backend = FakeLLMBackend(['{"ok": true}', '{"ok": false}'])
+            gateway = LLMGateway(backend)
+            cache = LLMResponseCache(database=SimpleNamespace(llm_cache=collection))
+            first = asyncio.create_task(cache.get_or_call("k", _call(gateway), "gpt-4o", "test"))
+            await asyncio.wait_for(collection.upserting.wait(), timeout=1)
+            second = await cache.get_or_call("k", _call(gateway), "gpt-4o", "test")
+            collection.release.set()
+            return await first, second, len(backend.calls)
+
+        assert asyncio.run(scenario()) == ('{"ok": true}', '{"ok": true}', 1)
+
+
+def _call(gateway, prompt="datos"):
+    return lambda: gateway.ask("sys", prompt)
+
+
+class TestResponseCache:
+    """One model call per distinct content"""
+
+    def test_memory_then_database_hits(self, with_database):
+        async def scenario(database):
+            backend = FakeLLMBackend(['{"resumen": "uno"}'])
+            gateway = LLMGateway(backend)
+            cache = LLMResponseCache(database=database)
+            first = await cache.get_or_call("k", _call(gateway), "gpt-4o", "test")
+            second = await cache.get_or_call("k", _call(gateway), "gpt-4o", "test")
+            # A fresh process only has the collection
+            other_process = LLMResponseCache(database=database)
+            third = await other_process.get_or_call("k", _call(gateway), "gpt-4o", "test")
+            return [first, second, third], len(backend.calls), cache.stats, other_process.stats
+
+        answers, calls, stats, other_stats = with_database(scenario, TEST_DB)
+        assert answers == ['{"resumen": "uno"}'] * 3
+        assert calls == 1
+        assert stats["memory_hits"] == 1 and stats["misses"] == 1
+        assert other_stats["db_hits"] == 1
+
+    def test_concurrent_identical_requests_share_one_call(self, with_database):
+        async def scenario(database):
+            backend = FakeLLMBackend(['{"ok": true}'], delay=0.1)
+            gateway = LLMGateway(backend)
+            cache = LLMResponseCache(database=database)
+            answers = await asyncio.gather(*(cache.get_or_call("k", _call(gateway), "gpt-4o", "test") for _ in range(5)))
+            return answers, len(backend.calls), cache.stats["coalesced"]
+
+        answers, calls, coalesced = with_database(scenario, TEST_DB)
+        assert set(answers) == {'{"ok": true}'}
+        assert calls == 1
+        assert coalesced == 4
+
+    def test_invalid_answers_are_not_stored(self, with_database):
+        async def scenario(database):
+            backend = FakeLLMBackend(["no es json", '{"ok": true}'])
+            gateway = LLMGateway(backend)
+            cache = LLMResponseCache(database=database)
+            first = await cache.get_or_call("k", _call(gateway), "gpt-4o", "test", cacheable=is_json_response)
+            second = await cache.get_or_call("k", _call(gateway), "gpt-4o", "test", cacheable=is_json_response)
+            return first, second, await database.llm_cache.count_documents({})
+
+        assert with_database(scenario, TEST_DB) == ("no es json", '{"ok": true}', 1)
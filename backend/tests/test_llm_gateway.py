@@ -0,0 +1,195 @@
+"""
+LLM gateway tests
+LLMGateway bounds concurrency globally and per user, times out and retries
+backend calls with jitter, streams answers chunk by chunk, and accounts
+tokens and latency by purpose. All calls go to FakeLLMBackend.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+import openai
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import (  # noqa: E402
+    FakeLLMBackend, LLMError, LLMGateway, LLMUnavailableError, detect_nelson_mode, llm_error_retryable
+)
+
+
+def run(scenario):
+    return asyncio.run(scenario())
+
+
+class TestConcurrency:
+    """Global and per-user slots"""
+
+    def test_global_limit(self):
+        async def scenario():
+            backend = FakeLLMBackend(delay=0.05)
+            gateway = LLMGateway(backend, max_concurrency=2, max_per_user=10)
+            await asyncio.gather(*(gateway.ask("sys", f"hola {i}", user_id=f"user_{i}") for i in range(6)))
+            return backend.max_in_flight, gateway.stats["in_flight"]
+
+        assert run(scenario) == (2, 0)
+
+    def test_one_user_queues_behind_itself(self):
+        async def scenario():
+            gateway = LLMGateway(FakeLLMBackend(delay=0.1), max_concurrency=10, max_per_user=1)
+
+            async def timed(user_id):
+                started = time.perf_counter()
+                await gateway.ask("sys", "hola", user_id=user_id)
+                return time.perf_counter() - started
+
+            results = await asyncio.gather(*(timed("user_a") for _ in range(3)), timed("user_b"))
+            return max(results[:3]), results[3], gateway._user_slots
+
+        slowest_a, user_b, slots = run(scenario)
+        assert slowest_a >= 0.3
+        assert user_b < 0.2
+        assert slots == {}
+
+    def test_busy_gateway_rejects_after_queue_timeout(self):
+        async def scenario():
+            gateway = LLMGateway(FakeLLMBackend(delay=0.5), max_concurrency=1, queue_timeout=0.05)
+            first = asyncio.create_task(gateway.ask("sys", "uno"))
+            await asyncio.sleep(0.01)
+            with pytest.raises(LLMUnavailableError):
+                await gateway.ask("sys", "dos")
+            await first
+            return gateway.stats["rejected"]
+
+        assert run(scenario) == 1
+
+    def test_busy_user_rejects_after_queue_timeout(self):
+        async def scenario():
+            gateway = LLMGateway(FakeLLMBackend(delay=0.5), max_per_user=1, queue_timeout=0.05)
+            first = asyncio.create_task(gateway.ask("sys", "uno", user_id="user_a"))
+            await asyncio.sleep(0.01)
+            with pytest.raises(LLMUnavailableError):
+                await gateway.ask("sys", "dos", user_id="user_a")
+            await first
+            return gateway.stats["rejected"], gateway._user_slots
+
+        assert run(scenario) == (1, {})
+
+
+def _status_error(error_class, status_code, body=None):
+    response = httpx.Response(status_code, request=httpx.Request("POST", "https://api.test/v1/chat/completions"))
+    return error_class("error", response=response, body=body)
+
+
+class TestRetries:
+    """Timeouts and backend errors are retried, then surfaced"""
+
+    def test_transient_failures_are_retried(self):
+        async def scenario():
+            gateway = LLMGateway(FakeLLMBackend(["listo"], failures=2), retry_base_delay=0)
+            return await gateway.ask("sys", "hola"), gateway.stats["retries"]
+
+        assert run(scenario) == ("listo", 2)
+
+    def test_timeouts_raise_after_retries(self):
+        async def scenario():
+            gateway = LLMGateway(FakeLLMBackend(delay=1), timeout=0.05, max_retries=1, retry_base_delay=0)
+            with pytest.raises(LLMError):
+                await gateway.ask("sys", "hola", purpose="nelson_chat")
+            return gateway.stats
+
+        stats = run(scenario)
+        assert stats["timeouts"] == 2
+        assert stats["by_purpose"]["nelson_chat"]["errors"] == 1
+
+    def test_error_classification(self):
+        assert llm_error_retryable(_status_error(openai.RateLimitError, 429))
+        assert llm_error_retryable(_status_error(openai.InternalServerError, 500))
+        assert llm_error_retryable(ConnectionError("reset"))
+        assert not llm_error_retryable(_status_error(openai.AuthenticationError, 401))
+        assert not llm_error_retryable(_status_error(openai.BadRequestError, 400))
+        assert not llm_error_retryable(_status_error(openai.RateLimitError, 429, {"code": "insufficient_quota"}))
+        assert not llm_error_retryable(ValueError("bad prompt"))
+
+    def test_unconfigured_gateway_is_unavailable(self):
+        gateway = LLMGateway(None)
+        assert not gateway.available
+        with pytest.raises(LLMUnavailableError):
+            asyncio.run(gateway.ask("sys", "hola"))
+
+
+class BreaksMidStream(FakeLLMBackend):
+    """Sends one chunk, then fails"""
+
+    async def stream(self, messages, model, temperature, max_tokens, usage):
+        self.calls.append({"messages": messages, "model": model})
+        yield "Hola "
+        raise ConnectionError("stream cut")
+
+
+async def collect(gateway, **kwargs):
+    return [chunk async for chunk in gateway.stream([{"role": "user", "content": "hola"}], **kwargs)]
+
+
+class TestStreaming:
+    """Chunks arrive in order; only failures before the first chunk are retried"""
+
+    def test_chunks_join_into_the_answer(self):
+        async def scenario():
+            gateway = LLMGateway(FakeLLMBackend(["Estoy aquí contigo, respira."]))
+            chunks = await collect(gateway, purpose="nelson_chat")
+            return chunks, gateway.stats
+
+        chunks, stats = run(scenario)
+        assert len(chunks) == 4
+        assert "".join(chunks) == "Estoy aquí contigo, respira."
+        assert stats["by_purpose"]["nelson_chat"]["completion_tokens"] > 0
+        assert stats["in_flight"] == 0
+
+    def test_failure_before_first_chunk_is_retried(self):
+        async def scenario():
+            gateway = LLMGateway(FakeLLMBackend(["listo"], failures=1), retry_base_delay=0)
+            return await collect(gateway), gateway.stats["retries"]
+
+        assert run(scenario) == (["listo"], 1)
+
+    def test_failure_after_first_chunk_is_raised(self):
+        async def scenario():
+            backend = BreaksMidStream()
+            gateway = LLMGateway(backend, retry_base_delay=0)
+            received = []
+            with pytest.raises(LLMError):
+                async for chunk in gateway.stream([{"role": "user", "content": "hola"}]):
+                    received.append(chunk)
+            return received, len(backend.calls)
+
+        assert run(scenario) == (["Hola "], 1)
+
+
+class TestNelsonMode:
+    """Crisis detection is keyword based and needs no model call"""
+
+    def test_crisis_and_modes(self):
+        assert detect_nelson_mode("Ya no puedo más, quiero morir") == (True, "crisis")
+        assert detect_nelson_mode("Tengo mucha ansiedad") == (False, "anxiety")
+        assert detect_nelson_mode("Hola Nelson") == (False, "normal")
+
+
+class TestAccounting:
+    """Tokens and latency are accumulated per purpose"""
+
+    def test_tokens_by_purpose(self):
+        async def scenario():
+            backend = FakeLLMBackend(["respuesta de prueba"])
+            gateway = LLMGateway(backend)
+            text = await gateway.ask("sistema", "una pregunta bastante larga", purpose="wellness_analysis")
+            return text, backend.calls[0]["messages"], gateway.stats["by_purpose"]["wellness_analysis"]
+
+        text, messages, accounting = run(scenario)
+        assert text == "respuesta de prueba"
+        assert [m["role"] for m in messages] == ["system", "user"]
+        assert accounting["requests"] == 1
+        assert accounting["prompt_tokens"] > 0 and accounting["completion_tokens"] > 0
@@ -0,0 +1,71 @@
+"""
+Nelson context snapshot tests
+get_nelson_user_context serves the stored snapshot while it is fresh (same
+version, same day, within the TTL) and rebuilds it otherwise; writes bump
+the version so the next turn sees the new data.
+"""
+
+import asyncio
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from server import nelson_context_fresh  # noqa: E402
+
+TEST_DB = "sinadicciones_nelson_context_test"
+NOW = datetime(2026, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def snapshot(**overrides):
+    return {"version": 2, "built_version": 2, "date": "2026-03-10", "built_at": NOW - timedelta(minutes=5), **overrides}
+
+
+class TestFreshness:
+    """What makes a snapshot stale"""
+
+    def test_fresh_snapshot(self):
+        assert nelson_context_fresh(snapshot(), NOW)
+        assert nelson_context_fresh(snapshot(built_at=(NOW - timedelta(minutes=5)).replace(tzinfo=None)), NOW)
+
+    def test_stale_snapshots(self):
+        assert not nelson_context_fresh(snapshot(version=3), NOW)
+        assert not nelson_context_fresh(snapshot(date="2026-03-09"), NOW)
+        assert not nelson_context_fresh(snapshot(built_at=NOW - timedelta(seconds=server.NELSON_CONTEXT_TTL + 1)), NOW)
+        assert not nelson_context_fresh({"version": 0}, NOW)
+
+
+async def _chat_turns(database, monkeypatch):
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "NELSON_CONTEXT_REFRESH_DELAY", 0)
+    monkeypatch.setattr(server, "nelson_context_stats", dict.fromkeys(server.nelson_context_stats, 0))
+    await server.ensure_indexes(database)
+    await database.users.insert_one({"user_id": "user_test", "name": "Ana"})
+    await database.user_profiles.insert_one({"user_id": "user_test", "role": "patient", "addiction_type": "alcohol"})
+
+    first, _ = await server.get_nelson_user_context("user_test")
+    second, _ = await server.get_nelson_user_context("user_test")
+    stats_before_write = dict(server.nelson_context_stats)
+
+    # A write: new habit, then the hook every write endpoint calls
+    await database.habits.insert_one({"habit_id": "habit_1", "user_id": "user_test", "name": "Meditar", "is_active": True})
+    server.invalidate_dashboard("user_test")
+    await asyncio.gather(*server.nelson_context_tasks)
+    third, _ = await server.get_nelson_user_context("user_test")
+    stored = await database.nelson_contexts.find_one({"user_id": "user_test"}, {"_id": 0})
+    return first, second, third, stats_before_write, dict(server.nelson_context_stats), stored
+
+
+class TestSnapshots:
+    """One build, then reads; writes trigger a rebuild"""
+
+    def test_snapshot_is_reused_until_a_write(self, with_database, monkeypatch):
+        first, second, third, before, after, stored = with_database(lambda database: _chat_turns(database, monkeypatch), TEST_DB)
+        assert "Nombre: Ana" in first
+        assert second == first
+        assert before["rebuilds"] == 1 and before["hits"] == 1
+        assert "Meditar" in third
+        assert after["background_refreshes"] == 1 and after["hits"] == 2
+        assert stored["version"] == stored["built_version"] == 1
@@ -0,0 +1,98 @@
+"""
+Nelson streaming chat tests
+POST /api/nelson/chat/stream saves the turn to nelson_conversations once the
+answer is complete, and when the client disconnects mid-answer it still
+saves what was shown (plus the crisis log). The model is FakeLLMBackend and
+the collections are in-memory recorders.
+"""
+
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from server import FakeLLMBackend, LLMGateway, NelsonMessage, User  # noqa: E402
+
+USER = User(user_id="user_test", email="test@test.org", name="Ana", created_at=datetime.now(timezone.utc))
+
+
+class Recorder:
+    """Collection stand-in that records writes and finds nothing"""
+
+    def __init__(self):
+        self.writes = []
+
+    async def update_one(self, query, update, upsert=False):
+        self.writes.append(update)
+
+    async def insert_one(self, document):
+        self.writes.append(document)
+
+    async def find_one(self, *args, **kwargs):
+        return None
+
+
+def _setup(monkeypatch, answer):
+    async def build_prompt(user_id, user_message, crisis_detected):
+        return "sys", user_message
+
+    database = SimpleNamespace(nelson_conversations=Recorder(), crisis_logs=Recorder(), profiles=Recorder())
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "build_nelson_prompt", build_prompt)
+    monkeypatch.setattr(server, "llm_gateway", LLMGateway(FakeLLMBackend([answer])))
+    return database
+
+
+def _parse(event: str) -> tuple:
+    name, data = event.strip().split("\n")
+    return name[len("event: "):], json.loads(data[len("data: "):])
+
+
+def _saved_answer(database) -> str:
+    (update,) = database.nelson_conversations.writes
+    user_turn, assistant_turn = update["$push"]["messages"]["$each"]
+    return assistant_turn["content"]
+
+
+class TestNelsonStream:
+    """The turn is persisted on completion and on disconnect"""
+
+    def test_full_answer_is_saved(self, monkeypatch):
+        database = _setup(monkeypatch, "Estoy aquí contigo.")
+
+        async def scenario():
+            response = await server.nelson_chat_stream(NelsonMessage(message="Hola Nelson"), current_user=USER)
+            events = [_parse(event) async for event in response.body_iterator]
+            await asyncio.gather(*server.nelson_pending_saves)
+            return events
+
+        events = asyncio.run(scenario())
+        assert events[0] == ("meta", {"mode": "normal", "crisis_detected": False})
+        assert "".join(data["text"] for name, data in events if name == "token") == "Estoy aquí contigo."
+        assert events[-1] == ("done", {"response": "Estoy aquí contigo.", "mode": "normal", "crisis_detected": False})
+        assert _saved_answer(database) == "Estoy aquí contigo."
+        assert database.crisis_logs.writes == []
+
+    def test_disconnect_saves_partial_answer_and_crisis_log(self, monkeypatch):
+        database = _setup(monkeypatch, "Respira conmigo un momento, estoy aquí.")
+
+        async def scenario():
+            response = await server.nelson_chat_stream(NelsonMessage(message="Ya no puedo más, quiero morir"), current_user=USER)
+            events = response.body_iterator
+            received = [_parse(await events.__anext__()), _parse(await events.__anext__())]
+            await events.aclose()  # the client goes away after the first token
+            await asyncio.gather(*server.nelson_pending_saves)
+            return received
+
+        meta, token = asyncio.run(scenario())
+        assert meta == ("meta", {"mode": "crisis", "crisis_detected": True})
+        assert token == ("token", {"text": "Respira "})
+        assert _saved_answer(database) == "Respira "
+        (crisis_log,) = database.crisis_logs.writes
+        assert crisis_log["message"] == "Ya no puedo más, quiero morir"
+        assert crisis_log["response_given"] == "Respira "
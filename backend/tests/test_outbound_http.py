@@ -0,0 +1,77 @@
+"""
+Outbound HTTP layer tests
+OutboundHTTP keeps one pooled client per remote host, applies per-host
+profiles and records latency and errors per host. Requests are served by a
+local app through httpx.ASGITransport.
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import OutboundHTTP  # noqa: E402
+
+
+def remote():
+    app = FastAPI()
+
+    @app.get("/ok")
+    async def ok():
+        return {"ok": True}
+
+    @app.get("/broken")
+    async def broken():
+        return JSONResponse({"error": "down"}, status_code=503)
+
+    return app
+
+
+class FailingTransport(httpx.AsyncBaseTransport):
+    async def handle_async_request(self, request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+
+class TestOutboundHTTP:
+    """Pools are per host and reused; metrics are per host"""
+
+    def test_one_pool_per_host_reused_across_calls(self):
+        async def scenario():
+            http = OutboundHTTP(profiles={"slow.test": {"timeout": httpx.Timeout(30.0)}}, transport=httpx.ASGITransport(app=remote()))
+            await http.get("http://a.test/ok")
+            first = http.client_for("a.test")
+            await http.get("http://a.test/ok")
+            await http.get("http://b.test/ok")
+            same = http.client_for("a.test") is first
+            timeout = http.client_for("slow.test").timeout.read
+            stats = http.stats()
+            await http.close()
+            return same, timeout, stats
+
+        same, timeout, stats = asyncio.run(scenario())
+        assert same
+        assert timeout == 30.0
+        assert stats["hosts"]["a.test"]["requests"] == 2
+        assert stats["hosts"]["b.test"]["requests"] == 1
+        assert stats["open_pools"] == ["a.test", "b.test", "slow.test"]
+
+    def test_server_and_transport_errors_are_counted(self):
+        async def scenario():
+            http = OutboundHTTP(transport=httpx.ASGITransport(app=remote()))
+            response = await http.get("http://a.test/broken")
+            down = OutboundHTTP(transport=FailingTransport())
+            with pytest.raises(httpx.ConnectError):
+                await down.get("http://down.test/ok")
+            return response.status_code, http.stats()["hosts"]["a.test"], down.stats()["hosts"]["down.test"]
+
+        status_code, server_errors, transport_errors = asyncio.run(scenario())
+        assert status_code == 503
+        assert server_errors["status_5xx"] == 1 and server_errors["errors"] == 0
+        assert transport_errors["errors"] == 1
+        assert "ConnectError" in transport_errors["last_error"]
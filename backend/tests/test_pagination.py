@@ -0,0 +1,104 @@
+"""
+Keyset pagination tests
+Cursors round-trip the (sort value, _id) key, and walking every page of a
+collection with duplicate sort values returns each document exactly once, in
+order, without skip(). The admin user directory pages through every row
+under each sort, including rows whose sort field is null or missing.
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from server import ADMIN_USER_SORTS, User, decode_cursor, encode_cursor, paginate  # noqa: E402
+
+TEST_DB = "sinadicciones_pagination_test"
+
+ADMIN = User(user_id="user_admin", email=server.ADMIN_EMAIL, name="Admin", created_at=datetime.now(timezone.utc))
+
+
+class TestCursor:
+    """Cursors are opaque and carry dates, strings and ObjectIds"""
+
+    @pytest.mark.parametrize("value", ["2026-01-15", datetime(2026, 1, 15, 8, 30), None, 3])
+    def test_round_trip(self, value):
+        document_id = ObjectId()
+        assert decode_cursor(encode_cursor(value, document_id)) == (value, document_id)
+
+    def test_malformed_cursor_is_rejected(self):
+        with pytest.raises(HTTPException) as error:
+            decode_cursor("not-a-cursor")
+        assert error.value.status_code == 400
+
+
+async def _walk_pages(database, page_size):
+    collection = database.emotional_logs
+    # Three logs per date so pages split inside groups of equal sort values
+    await collection.insert_many([
+        {"user_id": "user_test", "date": f"2026-01-{i // 3 + 1:02d}", "n": i}
+        for i in range(20)
+    ])
+    pages, cursor = [], None
+    while True:
+        documents, cursor = await paginate(collection, {"user_id": "user_test"}, "date", page_size, cursor)
+        pages.append(documents)
+        if not cursor:
+            return pages
+
+
+class TestPaginate:
+    """Pages follow (date desc, _id desc) with no gaps or duplicates"""
+
+    def test_walks_every_document_once(self, with_database):
+        pages = with_database(lambda database: _walk_pages(database, 6), TEST_DB)
+        assert [len(page) for page in pages] == [6, 6, 6, 2]
+        seen = [document["n"] for page in pages for document in page]
+        assert seen == list(range(19, -1, -1))
+        assert all("_id" not in document for page in pages for document in page)
+
+
+async def _walk_admin_users(database, sort, order):
+    now = datetime.now(timezone.utc)
+    # Every other row lacks created_at, counters and role, a third lacks a name
+    await database.users.insert_many([
+        {"user_id": f"user_{i}", "name": f"U{i}" if i % 3 else None, "email": f"u{i}@test.org",
+         **({"created_at": now - timedelta(days=i)} if i % 2 else {})}
+        for i in range(8)
+    ])
+    await database.user_profiles.insert_many([
+        {"user_id": f"user_{i}",
+         **({"role": "patient", "activity_counts": {"emotional_logs": i, "habits": i}} if i % 2 else {})}
+        for i in range(8)
+    ])
+    original_db = server.db
+    server.db = database
+    try:
+        seen, cursor = [], None
+        while True:
+            page = await server.get_admin_users(
+                current_user=ADMIN, role=None, search=None, sort=sort, order=order,
+                limit=3, cursor=cursor, view="summary"
+            )
+            seen += [user["user_id"] for user in page["users"]]
+            cursor = page["next_cursor"]
+            if not cursor:
+                return seen
+    finally:
+        server.db = original_db
+
+
+class TestAdminUsers:
+    """Rows with a null or missing sort field are not skipped by the cursor"""
+
+    @pytest.mark.parametrize("order", ["asc", "desc"])
+    @pytest.mark.parametrize("sort", list(ADMIN_USER_SORTS))
+    def test_walks_every_user_once(self, with_database, sort, order):
+        seen = with_database(lambda database: _walk_admin_users(database, sort, order), TEST_DB)
+        assert sorted(seen) == [f"user_{i}" for i in range(8)]
@@ -0,0 +1,133 @@
+"""
+Push dispatcher tests
+PushDispatcher talks to a local stand-in for the Expo push service: messages
+go out in batches of at most 100, 5xx answers are retried, and tokens Expo
+reports as DeviceNotRegistered (in tickets or receipts) are pruned from
+push_tokens.
+"""
+
+import asyncio
+import os
+import sys
+
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import OutboundHTTP, PushDispatcher  # noqa: E402
+
+TEST_DB = "sinadicciones_push_test"
+DEAD_TOKEN = "ExponentPushToken[dead]"
+EXPIRED_TOKEN = "ExponentPushToken[expired]"
+
+
+def fake_expo(failures=0):
+    """Stand-in Expo push service; answers the first `failures` sends with 503"""
+    expo = FastAPI()
+    expo.state.batches = []
+    expo.state.failures = failures
+
+    @expo.post("/push/send")
+    async def send(request: Request):
+        if expo.state.failures:
+            expo.state.failures -= 1
+            return JSONResponse({"errors": [{"code": "INTERNAL"}]}, status_code=503)
+        messages = await request.json()
+        expo.state.batches.append(messages)
+        tickets = []
+        for message in messages:
+            if message["to"] == DEAD_TOKEN:
+                tickets.append({
+                    "status": "error",
+                    "message": "not a registered push notification recipient",
+                    "details": {"error": "DeviceNotRegistered"}
+                })
+            else:
+                tickets.append({"status": "ok", "id": f"receipt-{message['to']}"})
+        return {"data": tickets}
+
+    @expo.post("/push/getReceipts")
+    async def receipts(request: Request):
+        ids = (await request.json())["ids"]
+        return {"data": {
+            receipt_id: (
+                {"status": "error", "details": {"error": "DeviceNotRegistered"}}
+                if EXPIRED_TOKEN in receipt_id else {"status": "ok"}
+            )
+            for receipt_id in ids
+        }}
+
+    return expo
+
+
+def dispatcher_for(expo, database=None):
+    return PushDispatcher(
+        send_url="http://expo.test/push/send",
+        receipts_url="http://expo.test/push/getReceipts",
+        http=OutboundHTTP(transport=httpx.ASGITransport(app=expo)),
+        database=database,
+        retry_base_delay=0
+    )
+
+
+def message(token):
+    return {"to": token, "title": "Hola", "body": "Prueba", "data": {}}
+
+
+class TestDeliver:
+    """Batching, invalid tokens and retries against the stand-in service"""
+
+    def test_messages_are_sent_in_batches_of_100(self):
+        expo = fake_expo()
+        dispatcher = dispatcher_for(expo)
+        tickets = asyncio.run(dispatcher.deliver([message(f"ExponentPushToken[{i}]") for i in range(250)]))
+        assert sorted(len(batch) for batch in expo.state.batches) == [50, 100, 100]
+        assert [ticket["id"] for ticket in tickets] == [f"receipt-ExponentPushToken[{i}]" for i in range(250)]
+
+    def test_invalid_tokens_are_not_sent(self):
+        expo = fake_expo()
+        dispatcher = dispatcher_for(expo)
+        tickets = asyncio.run(dispatcher.deliver([message("not-a-token"), message("ExponentPushToken[a]")]))
+        assert tickets[0]["status"] == "error"
+        assert tickets[1]["status"] == "ok"
+        assert expo.state.batches == [[message("ExponentPushToken[a]")]]
+
+    def test_server_errors_are_retried(self):
+        expo = fake_expo(failures=2)
+        dispatcher = dispatcher_for(expo)
+        tickets = asyncio.run(dispatcher.deliver([message("ExponentPushToken[a]")]))
+        assert tickets[0]["status"] == "ok"
+        assert dispatcher.stats["retries"] == 2
+
+    def test_batch_fails_after_max_retries(self):
+        expo = fake_expo(failures=10)
+        dispatcher = dispatcher_for(expo)
+        tickets = asyncio.run(dispatcher.deliver([message("ExponentPushToken[a]")]))
+        assert tickets[0]["status"] == "error"
+        assert dispatcher.stats["failed_batches"] == 1
+
+
+async def _send_and_check_receipts(database):
+    tokens = ["ExponentPushToken[live]", DEAD_TOKEN, EXPIRED_TOKEN]
+    await database.push_tokens.insert_many([
+        {"user_id": f"user_{i}", "push_token": token} for i, token in enumerate(tokens)
+    ])
+    dispatcher = dispatcher_for(fake_expo(), database)
+    await dispatcher.send([message(token) for token in tokens])
+    after_send = sorted(t["push_token"] for t in await database.push_tokens.find().to_list(None))
+    await dispatcher.check_receipts(min_age=0)
+    after_receipts = sorted(t["push_token"] for t in await database.push_tokens.find().to_list(None))
+    pending = await database.push_receipts.count_documents({})
+    return after_send, after_receipts, pending
+
+
+class TestPruning:
+    """Dead tokens disappear from push_tokens"""
+
+    def test_tickets_and_receipts_prune_tokens(self, with_database):
+        after_send, after_receipts, pending = with_database(_send_and_check_receipts, TEST_DB)
+        assert after_send == [EXPIRED_TOKEN, "ExponentPushToken[live]"]
+        assert after_receipts == ["ExponentPushToken[live]"]
+        assert pending == 0
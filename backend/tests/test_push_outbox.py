@@ -0,0 +1,83 @@
+"""
+Push outbox tests
+notify_users() only writes notifications and push jobs; PushOutbox workers
+deliver them through the dispatcher, reschedule retryable failures with
+backoff and dead-letter the rest. Delivery runs against the stand-in Expo
+service from test_push_dispatcher.
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import PushOutbox, RateLimiter  # noqa: E402
+from test_push_dispatcher import DEAD_TOKEN, dispatcher_for, fake_expo, message  # noqa: E402
+
+TEST_DB = "sinadicciones_push_outbox_test"
+
+
+class TestRateLimiter:
+    """The token bucket spaces out work beyond its burst"""
+
+    def test_waits_when_bucket_is_empty(self):
+        async def take():
+            limiter = RateLimiter(rate=100, capacity=10)
+            started = time.perf_counter()
+            for _ in range(3):
+                await limiter.acquire(10)
+            return time.perf_counter() - started
+
+        assert asyncio.run(take()) >= 0.18
+
+
+def _with_outbox(with_database, scenario, failures=0):
+    async def run(database):
+        expo = fake_expo(failures)
+        outbox = PushOutbox(dispatcher=dispatcher_for(expo, database), database=database, retry_delay=0, max_attempts=2)
+        return await scenario(outbox, database, expo)
+    return with_database(run, TEST_DB)
+
+
+def _jobs(tokens):
+    return [{"user_id": f"user_{i}", "notification_id": f"notif_{i}", "message": message(token)} for i, token in enumerate(tokens)]
+
+
+class TestPushOutbox:
+    """Jobs are delivered once, retried on transient errors, dead-lettered otherwise"""
+
+    def test_jobs_are_delivered_and_removed(self, with_database):
+        async def scenario(outbox, database, expo):
+            await outbox.enqueue(_jobs([f"ExponentPushToken[{i}]" for i in range(150)] + [DEAD_TOKEN]))
+            handled = await outbox.drain()
+            return handled, await database.push_outbox.count_documents({}), [len(b) for b in expo.state.batches]
+
+        handled, remaining, batches = _with_outbox(with_database, scenario)
+        assert handled == 151
+        assert remaining == 0
+        assert sorted(batches) == [51, 100]
+
+    def test_transient_failures_retry_then_dead_letter(self, with_database):
+        async def scenario(outbox, database, expo):
+            await outbox.enqueue(_jobs(["ExponentPushToken[a]", "not-a-token"]))
+            await outbox.drain()
+            return await database.push_outbox.find({}, {"_id": 0}).sort("user_id", 1).to_list(None)
+
+        # Every send fails: "a" is retried once and dead-lettered, the invalid token is dead at once
+        result = _with_outbox(with_database, scenario, failures=100)
+        assert [(job["status"], job["attempts"], job["last_error"]) for job in result] == [
+            ("dead", 2, "DeliveryFailed"),
+            ("dead", 1, "InvalidPushToken"),
+        ]
+
+    def test_expired_lease_is_reclaimed(self, with_database):
+        async def scenario(outbox, database, expo):
+            await outbox.enqueue(_jobs(["ExponentPushToken[a]"]))
+            outbox.lease = -1  # the first claim expires immediately, as if its worker died
+            first = await outbox.claim()
+            second = await outbox.claim()
+            return len(first), len(second)
+
+        assert _with_outbox(with_database, scenario) == (1, 1)
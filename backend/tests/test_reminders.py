@@ -0,0 +1,101 @@
+"""
+Scheduled reminder tests
+Users are split into stable shards, the trigger only answers to the internal
+scheduler, and a run reminds each user at most once per day, at their own
+preferred hour or at REMINDER_DEFAULT_HOUR when they never chose one.
+"""
+
+import os
+import sys
+from collections import Counter
+
+import pytest
+from fastapi import HTTPException
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from server import reminder_shard, require_scheduler  # noqa: E402
+
+TEST_DB = "sinadicciones_reminders_test"
+
+
+class FakeRequest:
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class TestShards:
+    """Every user belongs to exactly one shard, spread evenly"""
+
+    def test_shards_are_stable_and_balanced(self):
+        user_ids = [f"user_{i}" for i in range(4000)]
+        counts = Counter(reminder_shard(user_id, 4) for user_id in user_ids)
+        assert set(counts) == {0, 1, 2, 3}
+        assert min(counts.values()) > 900
+        assert [reminder_shard(user_id, 4) for user_id in user_ids] == [reminder_shard(user_id, 4) for user_id in user_ids]
+
+
+class TestSchedulerAuth:
+    """The trigger needs the shared scheduler token"""
+
+    def test_rejects_missing_or_wrong_token(self, monkeypatch):
+        monkeypatch.setattr(server, "SCHEDULER_TOKEN", "secret")
+        for headers in ({}, {"X-Scheduler-Token": "wrong"}):
+            with pytest.raises(HTTPException) as error:
+                require_scheduler(FakeRequest(headers))
+            assert error.value.status_code == 403
+        require_scheduler(FakeRequest({"X-Scheduler-Token": "secret"}))
+
+    def test_rejects_everything_when_unconfigured(self, monkeypatch):
+        monkeypatch.setattr(server, "SCHEDULER_TOKEN", None)
+        with pytest.raises(HTTPException):
+            require_scheduler(FakeRequest({"X-Scheduler-Token": ""}))
+
+
+async def _run_twice(database, monkeypatch):
+    monkeypatch.setattr(server, "db", database)
+    await server.ensure_indexes(database)
+    today = server.datetime.now(server.timezone.utc).strftime("%Y-%m-%d")
+    await database.push_tokens.insert_many([
+        {"user_id": f"user_{i}", "push_token": f"ExponentPushToken[{i}]"} for i in range(25)
+    ])
+    await database.habits.insert_one({"habit_id": "habit_0", "user_id": "user_0", "name": "Caminar", "is_active": True})
+    await database.emotional_logs.insert_one({"user_id": "user_1", "date": today, "mood_scale": 7})
+    await database.notification_settings.insert_many([
+        {"user_id": "user_2", "motivational": False},
+        {"user_id": "user_3", "preferred_time": "14:30"},
+    ])
+    monkeypatch.setattr(server, "REMINDER_DEFAULT_HOUR", 9)
+
+    # The in-process loop reaches midnight first: nobody chose it, nobody is claimed
+    midnight = await server.run_reminders(0, 0, 1, chunk_size=4)
+    runs = []
+    for shard in range(3):
+        runs.append(await server.run_reminders(9, shard, 3, chunk_size=4))
+    rerun = await server.run_reminders(9, 0, 1, chunk_size=4)
+    preferred = await server.run_reminders(14, 0, 1, chunk_size=4)
+    notifications = await database.notifications.find({}, {"_id": 0, "user_id": 1, "type": 1}).to_list(None)
+    return midnight, runs, rerun, preferred, notifications
+
+
+class TestRunReminders:
+    """Shards cover every user once, reruns are no-ops and preferred hours are kept"""
+
+    def test_each_user_is_reminded_once_per_day(self, with_database, monkeypatch):
+        midnight, runs, rerun, preferred, notifications = with_database(
+            lambda database: _run_twice(database, monkeypatch), TEST_DB
+        )
+        assert midnight["users_processed"] == 0
+        assert sum(run["users_processed"] for run in runs) == 24
+        assert rerun["sent_count"] == 0 and rerun["skipped"] == 24
+        assert preferred["users_processed"] == 1 and preferred["sent_count"] == 2
+
+        by_user = {}
+        for notification in notifications:
+            by_user.setdefault(notification["user_id"], []).append(notification["type"])
+        assert sorted(by_user["user_0"]) == ["emotion_reminder", "habit_reminder", "motivational"]
+        assert by_user["user_1"] == ["motivational"]
+        assert by_user["user_2"] == ["emotion_reminder"]
+        # Motivational + emotion for everyone, plus user_0's habits, minus user_1's emotion and user_2's motivational
+        assert len(notifications) == 49
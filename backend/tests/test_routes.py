@@ -0,0 +1,26 @@
+"""
+Route table tests
+Every (method, path) pair must be registered once: with duplicates FastAPI
+silently serves the first handler and the later ones are dead code.
+"""
+
+import os
+import sys
+from collections import Counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import app  # noqa: E402
+
+
+class TestRouteTable:
+    """No ambiguous route registrations"""
+
+    def test_no_duplicate_method_and_path(self):
+        registrations = Counter(
+            (method, route.path)
+            for route in app.routes
+            for method in (getattr(route, "methods", None) or ())
+        )
+        duplicates = sorted(key for key, count in registrations.items() if count > 1)
+        assert not duplicates, f"Routes registered more than once: {duplicates}"